@@ -3,6 +3,7 @@ import os
 import tempfile
 import uuid
 import math
+import time
 import logging
 from collections import Counter
 import tarfile # Pra extrair o modelo
@@ -14,6 +15,14 @@ from music21 import converter, tempo, pitch, key, environment, stream, note, cho
 # Mido import
 from mido import MidiFile as MidoMidiFile
 
+import numpy as np
+
+from model_manager import ModelManager
+from batching import MicroBatcher, encode_batch, decode_batch
+from latent_cache import LatentCache, primer_cache_key
+import candidates
+from fast_inference import FrozenMusicVAE
+
 # --- Tenta importar TensorFlow e Magenta ---
 MAGENTA_AVAILABLE = False
 tf = None
@@ -46,12 +55,27 @@ GENERATED_MIDI_DIR = os.path.join(app.static_folder, 'generated_midi')
 os.makedirs(GENERATED_MIDI_DIR, exist_ok=True)
 
 MODEL_CONFIG_NAME = 'cat-mel_2bar_big'
-music_vae_model = None
 
 # Caminho pro cache de modelos do Magenta e URL de download
 MAGENTA_CACHE_DIR = os.path.expanduser(os.path.join("~", ".magenta", "models"))
 MODEL_DOWNLOAD_URL = f"http://download.magenta.tensorflow.org/models/music_vae/checkpoints/{MODEL_CONFIG_NAME}.tar.gz"
-MODEL_LOCAL_DIR = os.path.join(MAGENTA_CACHE_DIR, MODEL_CONFIG_NAME)
+MODEL_LOCAL_DIR = os.getenv("MUSIC_VAE_CHECKPOINT_DIR", os.path.join(MAGENTA_CACHE_DIR, MODEL_CONFIG_NAME))
+# O checkpoint deve estar no disco; o download só acontece se for explicitamente permitido
+MODEL_ALLOW_DOWNLOAD = os.getenv("MUSIC_VAE_ALLOW_DOWNLOAD", "0") == "1"
+# Quanto tempo uma requisição espera o modelo ficar pronto antes de responder 503
+MODEL_WAIT_SECONDS = float(os.getenv("MUSIC_VAE_WAIT_SECONDS", "0"))
+# Micro-batching de encode/decode entre requisições concorrentes (ver batching.py)
+MODEL_MAX_BATCH = int(os.getenv("MUSIC_VAE_MAX_BATCH", "8"))
+MODEL_BATCH_WAIT_MS = float(os.getenv("MUSIC_VAE_BATCH_WAIT_MS", "5"))
+# Cache de latentes por primer; com MUSIC_VAE_LATENT_CACHE_DIR ele sobrevive a reinícios
+MODEL_LATENT_CACHE_SIZE = int(os.getenv("MUSIC_VAE_LATENT_CACHE_SIZE", "1024"))
+MODEL_LATENT_CACHE_DIR = os.getenv("MUSIC_VAE_LATENT_CACHE_DIR") or None
+# Melhor de N: candidatos por requisição (campo 'candidates' do JSON) e o teto permitido
+MODEL_CANDIDATES = int(os.getenv("MUSIC_VAE_CANDIDATES", "1"))
+MODEL_MAX_CANDIDATES = 8
+# Artefato de inferência otimizado (ver export_model.py); sem ele, usa o TrainedModel do checkpoint
+MODEL_EXPORT_DIR = os.getenv("MUSIC_VAE_EXPORT_DIR") or None
+MODEL_USE_XLA = os.getenv("MUSIC_VAE_XLA", "0") == "1"
 
 EXPECTED_CHECKPOINT_FILE_IN_MODEL_DIR = os.path.join(MODEL_LOCAL_DIR, "checkpoint")
 
@@ -103,38 +127,73 @@ def _download_and_extract_model():
         return False
 
 
-def load_music_vae_model():
-    global music_vae_model
-    if not MAGENTA_AVAILABLE:
-        app.logger.error("Magenta/TensorFlow não disponíveis, não é possível carregar o modelo.")
-        music_vae_model = "ERROR"
-        return
+def _build_music_vae_model():
+    """Instancia o TrainedModel a partir do checkpoint local. Levanta exceção em caso de falha."""
+    if MODEL_EXPORT_DIR:
+        return _build_frozen_music_vae_model()
+
+    if not os.path.exists(EXPECTED_CHECKPOINT_FILE_IN_MODEL_DIR):
+        if not MODEL_ALLOW_DOWNLOAD:
+            raise FileNotFoundError(f"Checkpoint não encontrado em {MODEL_LOCAL_DIR} (defina MUSIC_VAE_CHECKPOINT_DIR ou MUSIC_VAE_ALLOW_DOWNLOAD=1).")
+        if not _download_and_extract_model():
+            raise FileNotFoundError(f"Falha ao garantir que o modelo {MODEL_CONFIG_NAME} esteja disponível localmente.")
+
+    if MODEL_CONFIG_NAME not in configs.CONFIG_MAP:
+        raise ValueError(f"Configuração MusicVAE desconhecida: {MODEL_CONFIG_NAME}")
+
+    config = configs.CONFIG_MAP[MODEL_CONFIG_NAME]
+    config.data_converter.max_input_length = 32
+
+    app.logger.info(f"Instanciando TrainedModel com checkpoint_dir_or_path='{MODEL_LOCAL_DIR}'")
+    model = TrainedModel(
+        config,
+        batch_size=MODEL_MAX_BATCH, # Lotes menores são completados com padding pelo próprio TrainedModel
+        checkpoint_dir_or_path=MODEL_LOCAL_DIR # Aponta pro DIRETÓRIO do checkpoint
+    )
+    app.logger.info("Modelo MusicVAE carregado com sucesso.")
+    return model
+
+
+def _build_frozen_music_vae_model():
+    """Carrega o artefato de export_model.py (grafo congelado, threads explícitas, XLA/TFLite opcionais)."""
+    model = FrozenMusicVAE(MODEL_EXPORT_DIR, use_xla=MODEL_USE_XLA)
+    if model.metadata["config_name"] != MODEL_CONFIG_NAME:
+        raise ValueError(f"Artefato exportado para {model.metadata['config_name']}, esperado {MODEL_CONFIG_NAME}.")
+    if model.batch_size != MODEL_MAX_BATCH:
+        app.logger.warning(f"Artefato exportado com batch_size={model.batch_size}, mas MUSIC_VAE_MAX_BATCH={MODEL_MAX_BATCH}.")
+    model.config.data_converter.max_input_length = 32
+    app.logger.info(f"Modelo MusicVAE otimizado carregado de {MODEL_EXPORT_DIR}.")
+    return model
+
+
+def _warmup_music_vae_model(model):
+    """
+    Roda uma geração curta com um primer sintético (escala de Dó maior), para que
+    a primeira requisição real encontre o grafo já inicializado.
+    """
+    warmup_ns = note_seq.protobuf.music_pb2.NoteSequence()
+    warmup_ns.tempos.add(qpm=120)
+    warmup_ns.ticks_per_quarter = note_seq.constants.STANDARD_PPQ
+    for i, midi_pitch in enumerate([60, 62, 64, 65, 67, 69, 71, 72]):
+        warmup_ns.notes.add(pitch=midi_pitch, velocity=80, start_time=i * 0.5, end_time=(i + 1) * 0.5)
+    warmup_ns.total_time = 4.0
+    try:
+        primer_ns = prepare_primer_sequence(warmup_ns)
+        if generate_continuation_sequence(model, primer_ns, warmup_ns, length_seconds=2) is None:
+            app.logger.warning("Aquecimento do MusicVAE não produziu notas (o modelo segue disponível).")
+    except Exception as e:
+        app.logger.warning(f"Falha no aquecimento do MusicVAE (o modelo segue disponível): {e}")
 
-    if music_vae_model is None:
-        app.logger.info(f"Carregando modelo MusicVAE: {MODEL_CONFIG_NAME}...")
-        try:
-            if not _download_and_extract_model():
-                raise FileNotFoundError(f"Falha ao garantir que o modelo {MODEL_CONFIG_NAME} esteja disponível localmente.")
-
-            if MODEL_CONFIG_NAME not in configs.CONFIG_MAP:
-                raise ValueError(f"Configuração MusicVAE desconhecida: {MODEL_CONFIG_NAME}")
-
-            config = configs.CONFIG_MAP[MODEL_CONFIG_NAME]
-            config.data_converter.max_input_length = 32
-            
-            app.logger.info(f"Instanciando TrainedModel com checkpoint_dir_or_path='{MODEL_LOCAL_DIR}'")
-            music_vae_model = TrainedModel(
-                config,
-                batch_size=1,
-                checkpoint_dir_or_path=MODEL_LOCAL_DIR # Aponta pro DIRETÓRIO do checkpoint
-            )
-            app.logger.info("Modelo MusicVAE carregado com sucesso.")
 
-        except Exception as e:
-            app.logger.error(f"Erro geral ao carregar modelo MusicVAE: {e}", exc_info=True)
-            music_vae_model = "ERROR"
-    elif music_vae_model == "ERROR":
-        app.logger.warning("Modelo MusicVAE falhou ao carregar anteriormente.")
+encode_batcher = MicroBatcher(encode_batch, MODEL_MAX_BATCH, MODEL_BATCH_WAIT_MS, name="music-vae-encode")
+decode_batcher = MicroBatcher(decode_batch, MODEL_MAX_BATCH, MODEL_BATCH_WAIT_MS, name="music-vae-decode")
+
+# Posterior (mu, sigma) por primer: regenerar o mesmo primer não passa pelo encoder (ver latent_cache.py)
+latent_cache = LatentCache(MODEL_LATENT_CACHE_SIZE, MODEL_LATENT_CACHE_DIR)
+
+
+# Carga em segundo plano com novas tentativas (ver model_manager.py)
+model_manager = ModelManager(_build_music_vae_model, warmup=_warmup_music_vae_model, available=MAGENTA_AVAILABLE)
 
 
 def convert_midi_to_notesequence(midi_file_path):
@@ -210,7 +269,67 @@ def prepare_primer_sequence(full_notesequence, num_bars_primer=2):
         app.logger.error(f"Erro ao preparar sequência primer: {e}", exc_info=True)
         return None
 
-def generate_continuation_sequence(model, primer_sequence, full_notesequence_ref, length_seconds=8, temperature=0.6):
+def _assemble_continuation(interpolated_sequences, primer_sequence, full_notesequence_ref, length_seconds, qpm):
+    """Monta uma continuação a partir dos chunks decodificados (o primeiro é o primer reconstruído)."""
+    if not interpolated_sequences or len(interpolated_sequences) < 2:
+         raise ValueError("Interpolação não retornou sequências suficientes.")
+
+    # O primeiro é o primer reconstruído, pegamos os
+    continuation_chunks = interpolated_sequences[1:] 
+
+    if not any(chunk.notes for chunk in continuation_chunks):
+        app.logger.warning("Nenhum dos chunks de continuação gerados continha notas.")
+        return None
+
+    final_continuation_ns = note_seq.concatenate_sequences(continuation_chunks)
+    if not final_continuation_ns.notes:
+        app.logger.warning("Concatenação dos chunks de continuação resultou em sequência sem notas.")
+        return None
+
+    # Desloca continuação pra começar pos primer
+    shifted_continuation_ns = note_seq.sequences_lib.shift_sequence_times(
+        final_continuation_ns, primer_sequence.total_time
+    )
+    
+    # Extrai duração desejada
+    target_end_time = primer_sequence.total_time + length_seconds
+    final_ns_trimmed = note_seq.extract_subsequence(
+        shifted_continuation_ns, 
+        start_time=primer_sequence.total_time, 
+        end_time=target_end_time
+    )
+
+    if not final_ns_trimmed.notes:
+        app.logger.warning("Continuação após trim não contém notas.")
+        return None
+
+    # Preserva QPM e TS do primer ou original
+    del final_ns_trimmed.tempos[:]; del final_ns_trimmed.time_signatures[:]
+    tempo_obj = final_ns_trimmed.tempos.add()
+    tempo_obj.qpm = qpm
+    tempo_obj.time = 0 # Relativo ao início nova sequência ja desloc
+
+    ts_obj = final_ns_trimmed.time_signatures.add()
+    if primer_sequence.time_signatures:
+        ts_obj.numerator = primer_sequence.time_signatures[0].numerator
+        ts_obj.denominator = primer_sequence.time_signatures[0].denominator
+    elif full_notesequence_ref and full_notesequence_ref.time_signatures:
+        ts_obj.numerator = full_notesequence_ref.time_signatures[0].numerator
+        ts_obj.denominator = full_notesequence_ref.time_signatures[0].denominator
+    else:
+        ts_obj.numerator = 4
+        ts_obj.denominator = 4
+    ts_obj.time = 0
+    final_ns_trimmed.ticks_per_quarter = primer_sequence.ticks_per_quarter or note_seq.constants.STANDARD_PPQ
+    return final_ns_trimmed
+
+
+def generate_continuation_sequence(model, primer_sequence, full_notesequence_ref, length_seconds=8, temperature=0.6, num_candidates=1):
+    """
+    Gera a continuação do primer. Com num_candidates > 1, decodifica N amostras da
+    posterior num único lote, pontua as continuações (ver candidates.py) e retorna a
+    melhor (as demais são descartadas).
+    """
     if not MAGENTA_AVAILABLE: return None
     if not primer_sequence or not primer_sequence.notes or model is None or model == "ERROR": return None
     try:
@@ -224,91 +343,53 @@ def generate_continuation_sequence(model, primer_sequence, full_notesequence_ref
         
         app.logger.info(f"Gerando {num_chunks_needed} chunks para approx {length_seconds}s de continuação.")
 
-        generated_sequences = model.sample(
-            n=num_chunks_needed,
-            length=model_output_steps,
-            temperature=temperature,
-            primer_sequence=primer_ns # Passar primer_ns aqui
-        )
-        
-        if not generated_sequences: raise ValueError("Sample falhou em retornar sequências.")
-        
-        # Concatena chunks gerados, ajustando os tempos
-        all_notes = []
-        current_time_offset = primer_sequence.total_time
-
-        for i, chunk_ns in enumerate(generated_sequences):
-            if not chunk_ns.notes: continue
-
         # ---- VOLTANDO PARA INTERPOLATE ----
         num_interpolate_steps = num_chunks_needed + 1 # Um a mais para o primer
         app.logger.info(f"Usando INTERPOLATE: {num_interpolate_steps} passos de interpolação.")
 
-        z_list, _, _ = model.encode([primer_sequence])
-        if not z_list.size > 0: raise ValueError("Encode falhou.")
-
-        interpolated_sequences = model.interpolate(
-            z_start=z_list, 
-            z_end=z_list, # Interpola primer para ele mesmo, pegando passos intermed
-            num_steps=num_interpolate_steps,
-            length=model_output_steps, 
-            temperature=temperature
-        )
-
-        if not interpolated_sequences or len(interpolated_sequences) < 2:
-             raise ValueError("Interpolação não retornou sequências suficientes.")
-
-        # O primeiro é o primer reconstruído, pegamos os
-        continuation_chunks = interpolated_sequences[1:] 
+        # Encode e decode passam pelos micro-batchers: requisições concorrentes
+        # compartilham uma única chamada ao modelo. Primers já vistos nem chegam ao encoder.
+        cache_key = primer_cache_key(primer_sequence, MODEL_CONFIG_NAME)
+        posterior = latent_cache.get(cache_key)
+        if posterior is None:
+            posterior = encode_batcher(primer_sequence, key=model)
+            latent_cache.put(cache_key, *posterior)
+        else:
+            app.logger.info(f"Latente do primer encontrado no cache ({cache_key}).")
+
+        # Amostra um z da posterior por candidato, como o próprio encode faria.
+        # Os pedidos são submetidos juntos e decodificados no mesmo lote.
+        mu, sigma = posterior
+        futures = []
+        for _ in range(num_candidates):
+            z = (mu + sigma * np.random.randn(*np.shape(mu))).astype(np.float32)
+            # Interpolar o primer para ele mesmo = decodificar o mesmo z repetido
+            futures.append(decode_batcher.submit(
+                (z, num_interpolate_steps),
+                key=(model, model_output_steps, temperature)
+            ))
         # ---- FIM DA LÓGICA DE INTERPOLATE ----
 
-        if not any(chunk.notes for chunk in continuation_chunks):
-            app.logger.warning("Nenhum dos chunks de continuação gerados continha notas.")
-            return None
-
-        final_continuation_ns = note_seq.concatenate_sequences(continuation_chunks)
-        if not final_continuation_ns.notes:
-            app.logger.warning("Concatenação dos chunks de continuação resultou em sequência sem notas.")
+        continuations = []
+        for future in futures:
+            continuation_ns = _assemble_continuation(future.result(), primer_sequence, full_notesequence_ref, length_seconds, qpm)
+            if continuation_ns is not None:
+                continuations.append(continuation_ns)
+        if not continuations:
             return None
 
-        # Desloca continuação pra começar pos primer
-        shifted_continuation_ns = note_seq.sequences_lib.shift_sequence_times(
-            final_continuation_ns, primer_sequence.total_time
-        )
-        
-        # Extrai duração desejada
-        target_end_time = primer_sequence.total_time + length_seconds
-        final_ns_trimmed = note_seq.extract_subsequence(
-            shifted_continuation_ns, 
-            start_time=primer_sequence.total_time, 
-            end_time=target_end_time
-        )
-
-        if not final_ns_trimmed.notes:
-            app.logger.warning("Continuação após trim não contém notas.")
-            return None
+        best_ns = continuations[0]
+        if len(continuations) > 1:
+            started = time.perf_counter()
+            order, scores = candidates.rank_continuations(
+                continuations, primer_sequence, full_notesequence_ref or primer_sequence, 60.0 / qpm
+            )
+            best_ns = continuations[order[0]]
+            app.logger.info(f"{len(continuations)} candidatos pontuados em {(time.perf_counter() - started) * 1000:.1f} ms; "
+                            f"melhor: {scores[order[0]]}")
 
-        # Preserva QPM e TS do primer ou original
-        del final_ns_trimmed.tempos[:]; del final_ns_trimmed.time_signatures[:]
-        tempo_obj = final_ns_trimmed.tempos.add()
-        tempo_obj.qpm = qpm
-        tempo_obj.time = 0 # Relativo ao início nova sequência ja desloc
-
-        ts_obj = final_ns_trimmed.time_signatures.add()
-        if primer_sequence.time_signatures:
-            ts_obj.numerator = primer_sequence.time_signatures[0].numerator
-            ts_obj.denominator = primer_sequence.time_signatures[0].denominator
-        elif full_notesequence_ref and full_notesequence_ref.time_signatures:
-            ts_obj.numerator = full_notesequence_ref.time_signatures[0].numerator
-            ts_obj.denominator = full_notesequence_ref.time_signatures[0].denominator
-        else:
-            ts_obj.numerator = 4
-            ts_obj.denominator = 4
-        ts_obj.time = 0
-        final_ns_trimmed.ticks_per_quarter = primer_sequence.ticks_per_quarter or note_seq.constants.STANDARD_PPQ
-        
-        app.logger.info(f"Sequência de continuação gerada com {len(final_ns_trimmed.notes)} notas.")
-        return final_ns_trimmed
+        app.logger.info(f"Sequência de continuação gerada com {len(best_ns.notes)} notas.")
+        return best_ns
     except Exception as e:
         app.logger.error(f"Erro durante a geração MusicVAE: {e}", exc_info=True)
         return None
@@ -496,9 +577,12 @@ def generate_continuation_route():
     if not MAGENTA_AVAILABLE:
         return jsonify({"status": "error", "message": "Funcionalidade de geração indisponível (Magenta/TF não carregado)."}), 501
     
-    load_music_vae_model() # Tenta (re)carregar modelo se precsar
-    if music_vae_model is None or music_vae_model == "ERROR":
-        return jsonify({"status": "error", "message": "Modelo MusicVAE não está disponível. Não é possível gerar."}), 503
+    music_vae_model = model_manager.get(timeout=MODEL_WAIT_SECONDS)
+    if music_vae_model is None:
+        model_status = model_manager.status()
+        response = jsonify({"status": "error", "message": "Modelo MusicVAE ainda não está pronto. Tente novamente em instantes.", "model": model_status})
+        response.headers["Retry-After"] = str(int(model_status["retry_in_seconds"] or 5))
+        return response, 503
     
     data = request.get_json()
     filename = data.get('filename') if data else None
@@ -524,10 +608,11 @@ def generate_continuation_route():
         temperature = float(data.get('temperature', 0.6))
         if not (0.1 <= temperature <= 1.5): temperature = 0.6
         if not (1.0 <= length_seconds <= 30.0): length_seconds = 8.0
+        num_candidates = max(1, min(MODEL_MAX_CANDIDATES, int(data.get('candidates', MODEL_CANDIDATES))))
     except ValueError:
         return jsonify({"status": "error", "message": "Parâmetros de geração inválidos (length/temperature devem ser números)."}), 400
 
-    continuation_ns = generate_continuation_sequence(music_vae_model, primer_ns, full_ns, length_seconds, temperature)
+    continuation_ns = generate_continuation_sequence(music_vae_model, primer_ns, full_ns, length_seconds, temperature, num_candidates)
     if not continuation_ns or not continuation_ns.notes:
         return jsonify({"status": "error", "message": "Geração MusicVAE falhou ou não produziu notas."}), 500
     
@@ -546,6 +631,19 @@ def generate_continuation_route():
         "midi_filename": os.path.basename(relative_midi_path), "midi_url": midi_url
     }), 200
 
+@app.route('/health/ready')
+def readiness():
+    """Prontidão do serviço: 200 quando o MusicVAE está carregado e aquecido, 503 caso contrário."""
+    model_status = model_manager.status()
+    http_status = 200 if model_manager.ready else 503
+    return jsonify({"ready": model_manager.ready, "model": model_status, "latent_cache": latent_cache.stats()}), http_status
+
+
+# Carrega o modelo em segundo plano já na inicialização.
+# Com o reloader do Flask, o processo monitor (sem WERKZEUG_RUN_MAIN) não precisa do modelo.
+if __name__ != '__main__' or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    model_manager.start()
+
 # --- Execução Principal ---
 if __name__ == '__main__':
     try:
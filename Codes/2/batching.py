@@ -0,0 +1,128 @@
+"""
+Micro-batching de chamadas ao modelo.
+
+Requisições concorrentes entregam itens ao MicroBatcher, que os acumula por
+uma janela curta (max_wait_ms) ou até max_batch_size itens, executa uma
+única chamada em lote e devolve a cada chamador o seu resultado (Future).
+
+Itens só são agrupados com outros de mesma chave (ex: mesmo modelo, mesmo
+comprimento e temperatura de decodificação).
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=5.0, name="batcher"):
+        """
+        batch_fn(key, items) deve retornar uma lista de resultados na mesma ordem de items.
+        Um resultado que seja uma exceção é repassado só ao chamador correspondente.
+        """
+        self._batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._cond = threading.Condition()
+        self._pending = OrderedDict() # chave -> lista de (item, Future, instante de chegada)
+
+        # Métricas simples para benchmark/observabilidade
+        self.batches = 0
+        self.items = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item, key=None):
+        """Enfileira um item e retorna um Future com o seu resultado."""
+        future = Future()
+        with self._cond:
+            self._pending.setdefault(key, []).append((item, future, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def __call__(self, item, key=None, timeout=None):
+        """Atalho síncrono: submete e espera o resultado."""
+        return self.submit(item, key).result(timeout)
+
+    def _next_batch(self):
+        """Espera até haver um lote pronto (cheio ou com o prazo do item mais antigo vencido)."""
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                # A chave com o item mais antigo é atendida primeiro
+                key, queue = min(self._pending.items(), key=lambda kv: kv[1][0][2])
+                deadline = queue[0][2] + self.max_wait
+                if len(queue) >= self.max_batch_size or now >= deadline:
+                    batch = queue[:self.max_batch_size]
+                    del queue[:self.max_batch_size]
+                    if not queue:
+                        del self._pending[key]
+                    return key, batch
+                self._cond.wait(deadline - now)
+
+    def _run(self):
+        while True:
+            key, batch = self._next_batch()
+            items = [item for item, _, _ in batch]
+            try:
+                results = self._batch_fn(key, items)
+                if len(results) != len(items):
+                    raise ValueError(f"Lote com {len(items)} itens retornou {len(results)} resultados.")
+                for (_, future, _), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            except Exception as e:
+                logger.error(f"Erro na execução do lote ({len(items)} itens): {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.batches += 1
+            self.items += len(items)
+
+
+# Funções de lote do MusicVAE (app.py e bench_batching.py usam estas mesmas)
+
+def encode_batch(model, primer_sequences):
+    """Codifica vários primers numa única chamada; retorna (mu, sigma) da posterior de cada primer."""
+    try:
+        _, mu, sigma = model.encode(primer_sequences)
+        return list(zip(mu, sigma))
+    except Exception:
+        if len(primer_sequences) == 1:
+            raise
+        # Um primer inválido não deve derrubar o lote inteiro: refaz um a um
+        results = []
+        for primer in primer_sequences:
+            try:
+                _, mu, sigma = model.encode([primer])
+                results.append((mu[0], sigma[0]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def decode_batch(key, items):
+    """
+    Decodifica os pedidos de várias requisições numa única chamada.
+    Cada item é (z, num_steps): o z do primer repetido num_steps vezes.
+    """
+    model, length, temperature = key
+    z_batch = np.concatenate([np.repeat(np.asarray(z)[None, :], num_steps, axis=0) for z, num_steps in items])
+    sequences = model.decode(z_batch, length=length, temperature=temperature)
+    results, start = [], 0
+    for _, num_steps in items:
+        results.append(sequences[start:start + num_steps])
+        start += num_steps
+    return results
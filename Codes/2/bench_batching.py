@@ -0,0 +1,99 @@
+"""
+Benchmark do micro-batching com um modelo falso de mesma interface do TrainedModel.
+
+O FakeMusicVAE simula o custo de uma chamada ao TensorFlow: um custo fixo por
+chamada (sessão, montagem de tensores) mais um custo pequeno por item do lote.
+O benchmark dispara N requisições concorrentes (encode + decode, como em
+generate_continuation_sequence) com e sem o MicroBatcher. O caminho com
+batching usa as mesmas funções de lote do app (batching.encode_batch e
+batching.decode_batch).
+
+Uso:
+    python bench_batching.py [--requests 64] [--concurrency 16] [--max-batch 8] [--wait-ms 5]
+"""
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from batching import MicroBatcher, encode_batch, decode_batch
+
+
+class FakeMusicVAE:
+    """Mesma interface de encode/decode do TrainedModel, com latência simulada."""
+
+    def __init__(self, call_overhead_ms=20.0, per_item_ms=1.5, z_size=512):
+        self.call_overhead = call_overhead_ms / 1000.0
+        self.per_item = per_item_ms / 1000.0
+        self.z_size = z_size
+        self._lock = threading.Lock() # Uma sessão TF por vez, como no CPU do servidor
+
+    def _run(self, n):
+        with self._lock:
+            time.sleep(self.call_overhead + self.per_item * n)
+
+    def encode(self, note_sequences):
+        self._run(len(note_sequences))
+        z = np.random.randn(len(note_sequences), self.z_size).astype(np.float32)
+        return z, z, np.ones_like(z)
+
+    def decode(self, z, length=None, temperature=1.0):
+        self._run(len(z))
+        return [f"seq-{i}" for i in range(len(z))]
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) * 1000
+
+
+def run(model, requests, concurrency, steps, batched, max_batch, wait_ms):
+    if batched:
+        encoder = MicroBatcher(encode_batch, max_batch, wait_ms, name="bench-encode")
+        decoder = MicroBatcher(decode_batch, max_batch, wait_ms, name="bench-decode")
+
+    def one_request(i):
+        started = time.perf_counter()
+        if batched:
+            mu, sigma = encoder(f"primer-{i}", key=model)
+            z = (mu + sigma * np.random.randn(*np.shape(mu))).astype(np.float32)
+            decoder((z, steps), key=(model, 32, 0.6))
+        else:
+            z, _, _ = model.encode([f"primer-{i}"])
+            model.decode(np.repeat(z, steps, axis=0), 32, 0.6)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    label = f"micro-batching (lote<={max_batch}, janela {wait_ms} ms)" if batched else "sem batching"
+    print(f"{label:45s} {requests / elapsed:7.1f} req/s   "
+          f"p50 {_percentile(latencies, 50):7.1f} ms   p95 {_percentile(latencies, 95):7.1f} ms")
+    if batched:
+        print(f"{'':45s} lotes encode: {encoder.batches} (média {encoder.items / max(encoder.batches, 1):.1f} itens), "
+              f"decode: {decoder.batches} (média {decoder.items / max(decoder.batches, 1):.1f} itens)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do micro-batching com modelo falso.")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=3, help="Sequências decodificadas por requisição")
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--wait-ms", type=float, default=5.0)
+    parser.add_argument("--overhead-ms", type=float, default=20.0)
+    parser.add_argument("--per-item-ms", type=float, default=1.5)
+    args = parser.parse_args()
+
+    model = FakeMusicVAE(args.overhead_ms, args.per_item_ms)
+    print(f"{args.requests} requisições, concorrência {args.concurrency}, modelo falso: "
+          f"{args.overhead_ms} ms/chamada + {args.per_item_ms} ms/item")
+    run(model, args.requests, args.concurrency, args.steps, False, args.max_batch, args.wait_ms)
+    run(model, args.requests, args.concurrency, args.steps, True, args.max_batch, args.wait_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmark de precisão e latência: TrainedModel (checkpoint) x artefato otimizado.
+
+Compara, nos mesmos primers (melodias sintéticas de 2 compassos, ou os MIDIs
+de --midi-dir):
+  - encoder: similaridade de cosseno e erro máximo de mu/sigma;
+  - decoder: concordância das notas decodificadas do mesmo z com temperatura
+    quase nula (amostragem praticamente determinística);
+  - latência p50/p95 de um lote (o batch_size do export) de encode e de decode.
+
+Uso:
+    python bench_inference.py --export exported_model [--repeats 20] [--xla] [--no-tflite]
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+
+from fast_inference import FrozenMusicVAE
+
+
+def synthetic_primers(count, seed=0):
+    """Melodias aleatórias (passeio em Dó maior, colcheias) de 2 compassos, quantizadas."""
+    import note_seq
+    rng = np.random.default_rng(seed)
+    scale = np.array([0, 2, 4, 5, 7, 9, 11])
+    primers = []
+    for _ in range(count):
+        ns = note_seq.protobuf.music_pb2.NoteSequence()
+        ns.tempos.add(qpm=120)
+        ns.ticks_per_quarter = note_seq.constants.STANDARD_PPQ
+        degree = int(rng.integers(7, 14))
+        for i in range(16):
+            degree = int(np.clip(degree + rng.integers(-2, 3), 0, 20))
+            midi_pitch = 60 + 12 * (degree // 7 - 1) + scale[degree % 7]
+            ns.notes.add(pitch=int(midi_pitch), velocity=80, start_time=i * 0.25, end_time=(i + 1) * 0.25)
+        ns.total_time = 4.0
+        primers.append(note_seq.quantize_note_sequence(ns, steps_per_quarter=4))
+    return primers
+
+
+def midi_primers(midi_dir, count):
+    """Primeiros 2 compassos (a 120 qpm) de cada MIDI de midi_dir, quantizados."""
+    import note_seq
+    primers = []
+    for name in sorted(os.listdir(midi_dir)):
+        if not name.lower().endswith(('.mid', '.midi')):
+            continue
+        ns = note_seq.midi_file_to_note_sequence(os.path.join(midi_dir, name))
+        ns = note_seq.extract_subsequence(ns, 0.0, 4.0)
+        if ns.notes:
+            primers.append(note_seq.quantize_note_sequence(ns, steps_per_quarter=4))
+        if len(primers) >= count:
+            break
+    return primers
+
+
+def _timed(fn, repeats):
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def _note_agreement(seqs_a, seqs_b):
+    """Fração das notas (altura, passo inicial) em comum entre pares de sequências."""
+    matches, total = 0, 0
+    for a, b in zip(seqs_a, seqs_b):
+        notes_a = {(n.pitch, round(n.start_time, 3)) for n in a.notes}
+        notes_b = {(n.pitch, round(n.start_time, 3)) for n in b.notes}
+        matches += len(notes_a & notes_b)
+        total += max(len(notes_a | notes_b), 1)
+    return matches / max(total, 1)
+
+
+def report(label, model, primers, reference, repeats, length):
+    mu_ref, sigma_ref = reference["mu"], reference["sigma"]
+    _, mu, sigma = model.encode(primers)
+    cosine = np.sum(mu * mu_ref, axis=1) / (np.linalg.norm(mu, axis=1) * np.linalg.norm(mu_ref, axis=1))
+    decoded = model.decode(reference["z"], length=length, temperature=1e-4)
+
+    encode_p50, encode_p95 = _timed(lambda: model.encode(primers), repeats)
+    decode_p50, decode_p95 = _timed(lambda: model.decode(reference["z"], length=length, temperature=0.6), repeats)
+    print(f"{label:28s} encode p50 {encode_p50:7.1f} ms p95 {encode_p95:7.1f} ms | "
+          f"decode p50 {decode_p50:7.1f} ms p95 {decode_p95:7.1f} ms")
+    print(f"{'':28s} cos(mu) mín {cosine.min():.4f} | erro máx mu {np.abs(mu - mu_ref).max():.4f} "
+          f"sigma {np.abs(sigma - sigma_ref).max():.4f} | notas iguais no decode {_note_agreement(decoded, reference['decoded']):.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precisão e latência do MusicVAE otimizado x TrainedModel.")
+    parser.add_argument("--export", required=True, help="Diretório gerado por export_model.py")
+    parser.add_argument("--checkpoint", default=os.getenv("MUSIC_VAE_CHECKPOINT_DIR",
+                        os.path.expanduser(os.path.join("~", ".magenta", "models", "cat-mel_2bar_big"))))
+    parser.add_argument("--midi-dir", default=None)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--length", type=int, default=32)
+    parser.add_argument("--intra-op", type=int, default=None)
+    parser.add_argument("--inter-op", type=int, default=None)
+    parser.add_argument("--xla", action="store_true")
+    parser.add_argument("--no-tflite", action="store_true")
+    args = parser.parse_args()
+
+    from magenta.models.music_vae import configs
+    from magenta.models.music_vae.trained_model import TrainedModel
+
+    optimized = FrozenMusicVAE(args.export, args.intra_op, args.inter_op, args.xla, use_tflite_encoder=False)
+    config = configs.CONFIG_MAP[optimized.metadata["config_name"]]
+    batch_size = optimized.batch_size
+    primers = midi_primers(args.midi_dir, batch_size) if args.midi_dir else synthetic_primers(batch_size)
+    print(f"{len(primers)} primers, lote {batch_size}, {args.repeats} repetições, "
+          f"threads intra-op {optimized.intra_op_threads} / inter-op {optimized.inter_op_threads}")
+
+    baseline = TrainedModel(config=config, batch_size=batch_size, checkpoint_dir_or_path=args.checkpoint)
+    z, mu, sigma = baseline.encode(primers)
+    reference = {"z": z, "mu": mu, "sigma": sigma,
+                 "decoded": baseline.decode(z, length=args.length, temperature=1e-4)}
+
+    report("TrainedModel (checkpoint)", baseline, primers, reference, args.repeats, args.length)
+    report("grafo congelado" + (" + XLA" if args.xla else ""), optimized, primers, reference, args.repeats, args.length)
+    if not args.no_tflite and optimized.metadata.get("tflite_encoder"):
+        with_tflite = FrozenMusicVAE(args.export, args.intra_op, args.inter_op, args.xla, use_tflite_encoder=True)
+        label = "encoder TFLite" + (" int8" if optimized.metadata.get("quantized") else "")
+        report(label, with_tflite, primers, reference, args.repeats, args.length)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Pontuação vetorizada de continuações candidatas do MusicVAE (melhor de N).
+
+As notas de todos os candidatos são concatenadas numa única tabela e os
+critérios são agregados por candidato com np.bincount / ufunc.at:
+
+  - key_fit:    fração da duração das notas dentro da escala da tonalidade do original;
+  - continuity: a continuação deve começar logo após o primer (sem silêncio inicial longo);
+  - range:      sobreposição da tessitura do candidato com a do primer;
+  - density:    notas por segundo comparadas com as do primer;
+  - cadence:    as notas finais devem criar expectativa (dominante), não repousar na tônica.
+
+Os candidatos são NoteSequences já deslocados para começar em 0 (ver generate_continuation_sequence).
+"""
+import numpy as np
+
+# Perfis de Krumhansl-Kessler para estimar a tonalidade
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+MINOR_SCALE = (0, 2, 3, 5, 7, 8, 10, 11)
+DOMINANT_DEGREES = (7, 11, 2)
+
+WEIGHTS = {"key_fit": 0.3, "continuity": 0.2, "range": 0.2, "density": 0.15, "cadence": 0.15}
+
+
+def note_arrays(ns):
+    """(pitch, start, end) das notas não percussivas de um NoteSequence."""
+    notes = [(n.pitch, n.start_time, n.end_time) for n in ns.notes if not n.is_drum]
+    if not notes:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    arr = np.array(notes, dtype=np.float64)
+    return arr[:, 0].astype(np.int64), arr[:, 1], arr[:, 2]
+
+
+def estimate_key(ns):
+    """Tonalidade por correlação do histograma de classes de altura com os 24 perfis. Retorna (tônica, menor)."""
+    pitch, start, end = note_arrays(ns)
+    histogram = np.bincount(pitch % 12, weights=end - start, minlength=12)
+    if not histogram.any():
+        return 0, False
+    # Matriz 24x12 com todas as rotações dos dois perfis
+    rotations = np.arange(12)[None, :] - np.arange(12)[:, None] # rotations[t, pc] = pc - t
+    profiles = np.concatenate((MAJOR_PROFILE[rotations % 12], MINOR_PROFILE[rotations % 12]))
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    centered = histogram - histogram.mean()
+    best = int(np.argmax(profiles @ centered))
+    return best % 12, best >= 12
+
+
+def score_continuations(sequences, reference_ns, tonic, minor, seconds_per_beat):
+    """Pontua todos os candidatos de uma vez; retorna um dict de arrays (um valor por candidato)."""
+    n = len(sequences)
+    tables = [note_arrays(ns) for ns in sequences]
+    counts = np.array([len(t[0]) for t in tables])
+    idx = np.repeat(np.arange(n), counts)
+    pitch = np.concatenate([t[0] for t in tables])
+    start = np.concatenate([t[1] for t in tables])
+    end = np.maximum(np.concatenate([t[2] for t in tables]), start + 1e-3)
+    degree = (pitch - tonic) % 12
+
+    ref_pitch, ref_start, ref_end = note_arrays(reference_ns)
+    ref_low, ref_high = (int(ref_pitch.min()), int(ref_pitch.max())) if len(ref_pitch) else (48, 84)
+    ref_density = len(ref_pitch) / max(float(ref_end.max() - ref_start.min()), 1e-3) if len(ref_pitch) else 2.0
+
+    scale = np.zeros(12, dtype=bool)
+    scale[list(MINOR_SCALE if minor else MAJOR_SCALE)] = True
+    total_duration = np.bincount(idx, weights=end - start, minlength=n)
+    key_fit = np.bincount(idx, weights=(end - start) * scale[degree], minlength=n) / np.maximum(total_duration, 1e-9)
+
+    first = np.full(n, np.inf)
+    np.minimum.at(first, idx, start)
+    last_end = np.zeros(n)
+    np.maximum.at(last_end, idx, end)
+    continuity = np.exp(-first / seconds_per_beat)
+
+    low = np.full(n, 127)
+    np.minimum.at(low, idx, pitch)
+    high = np.zeros(n, dtype=np.int64)
+    np.maximum.at(high, idx, pitch)
+    overlap = np.minimum(high, ref_high) - np.maximum(low, ref_low) + 1
+    union = np.maximum(high, ref_high) - np.minimum(low, ref_low) + 1
+    range_fit = np.clip(overlap, 0, None) / union
+
+    density = counts / np.maximum(last_end - first, 1e-3)
+    density_fit = np.minimum(density, ref_density) / np.maximum(np.maximum(density, ref_density), 1e-9)
+
+    final = end >= last_end[idx] - seconds_per_beat / 4
+    dominant = np.zeros(12, dtype=bool)
+    dominant[list(DOMINANT_DEGREES)] = True
+    final_count = np.bincount(idx, weights=final, minlength=n)
+    cadence = np.bincount(idx, weights=final & dominant[degree], minlength=n) / np.maximum(final_count, 1)
+    final_bass = np.full(n, 127)
+    np.minimum.at(final_bass, idx[final], pitch[final])
+    cadence = np.where((final_bass - tonic) % 12 == 0, cadence * 0.25, cadence)
+
+    scores = {"key_fit": key_fit, "continuity": continuity, "range": range_fit,
+              "density": density_fit, "cadence": cadence}
+    total = sum(WEIGHTS[name] * values for name, values in scores.items())
+    scores["score"] = np.where(counts > 0, total, 0.0)
+    return scores
+
+
+def rank_continuations(sequences, reference_ns, key_source_ns, seconds_per_beat):
+    """Ordena os candidatos do melhor para o pior. Retorna (ordem, pontuações por candidato)."""
+    tonic, minor = estimate_key(key_source_ns)
+    scores = score_continuations(sequences, reference_ns, tonic, minor, seconds_per_beat)
+    order = [int(i) for i in np.argsort(-scores["score"], kind='stable')]
+    details = [{name: round(float(values[i]), 3) for name, values in scores.items()} for i in range(len(sequences))]
+    return order, details
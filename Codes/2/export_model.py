@@ -0,0 +1,113 @@
+"""
+Exporta o MusicVAE para um artefato de inferência otimizado (ver fast_inference.py).
+
+Carrega o checkpoint com o TrainedModel do Magenta e grava em --output:
+  - music_vae_frozen.pb: grafo de encoder + decoder com as variáveis convertidas
+    em constantes e os nós de treino removidos (sem Saver, sem restore na carga);
+  - music_vae_encoder.tflite (opcional, --tflite-encoder): só o encoder, com
+    quantização dos pesos em int8 se --quantize;
+  - export.json: configuração, batch_size e nomes dos tensores de entrada/saída.
+
+O decoder continua no grafo TF: a amostragem autoregressiva (while_loop com
+amostragem categórica) não converte bem para TFLite.
+
+Uso:
+    python export_model.py --output exported_model [--batch-size 8] [--tflite-encoder] [--quantize]
+"""
+import os
+import json
+import argparse
+import logging
+
+from fast_inference import FROZEN_GRAPH_FILE, TFLITE_ENCODER_FILE, EXPORT_METADATA_FILE
+
+logger = logging.getLogger(__name__)
+
+
+def _tensor_names(model):
+    """Nomes dos tensores do grafo do TrainedModel (atributos internos do Magenta)."""
+    def name(tensor):
+        return tensor.name if tensor is not None else None
+    return {
+        "inputs": name(model._inputs),
+        "controls": name(model._controls) if model._config.data_converter.control_depth else None,
+        "inputs_length": name(model._inputs_length),
+        "z_input": name(model._z_input),
+        "temperature": name(model._temperature),
+        "max_length": name(model._max_length),
+        "outputs": name(model._outputs),
+        "z": name(model._z),
+        "mu": name(model._mu),
+        "sigma": name(model._sigma),
+    }
+
+
+def export(checkpoint_dir, config_name, output_dir, batch_size=8, tflite_encoder=False, quantize=False):
+    import tensorflow.compat.v1 as tf
+    from magenta.models.music_vae import configs
+    from magenta.models.music_vae.trained_model import TrainedModel
+
+    os.makedirs(output_dir, exist_ok=True)
+    config = configs.CONFIG_MAP[config_name]
+    model = TrainedModel(config=config, batch_size=batch_size, checkpoint_dir_or_path=checkpoint_dir)
+    sess = model._sess
+    names = _tensor_names(model)
+
+    input_nodes = [names[k].split(":")[0] for k in ("inputs", "controls", "inputs_length", "z_input", "temperature", "max_length") if names[k]]
+    output_nodes = [names[k].split(":")[0] for k in ("outputs", "z", "mu", "sigma")]
+
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_nodes)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=input_nodes + output_nodes)
+    graph_path = os.path.join(output_dir, FROZEN_GRAPH_FILE)
+    with open(graph_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    logger.info(f"Grafo congelado gravado em {graph_path} ({os.path.getsize(graph_path) / 1e6:.1f} MB, {len(graph_def.node)} nós).")
+
+    tflite_file = None
+    if tflite_encoder:
+        try:
+            graph = sess.graph
+            converter = tf.lite.TFLiteConverter.from_session(
+                sess,
+                [graph.get_tensor_by_name(names["inputs"]), graph.get_tensor_by_name(names["inputs_length"])],
+                [graph.get_tensor_by_name(names["mu"]), graph.get_tensor_by_name(names["sigma"])],
+            )
+            # O encoder bidirecional usa while_loop; ops sem equivalente TFLite caem no TF (Flex)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+            if quantize:
+                converter.optimizations = [tf.lite.Optimize.DEFAULT] # Pesos em int8 (quantização de faixa dinâmica)
+            tflite_path = os.path.join(output_dir, TFLITE_ENCODER_FILE)
+            with open(tflite_path, 'wb') as f:
+                f.write(converter.convert())
+            tflite_file = TFLITE_ENCODER_FILE
+            logger.info(f"Encoder TFLite gravado em {tflite_path} ({os.path.getsize(tflite_path) / 1e6:.1f} MB).")
+        except Exception as e:
+            # O grafo congelado continua utilizável sozinho
+            logger.warning(f"Falha ao converter o encoder para TFLite: {e}")
+
+    metadata = {
+        "config_name": config_name, "batch_size": batch_size, "z_size": config.hparams.z_size,
+        "tensors": names, "tflite_encoder": tflite_file, "quantized": bool(tflite_file and quantize),
+    }
+    with open(os.path.join(output_dir, EXPORT_METADATA_FILE), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta o MusicVAE para inferência otimizada em CPU.")
+    parser.add_argument("--checkpoint", default=os.getenv("MUSIC_VAE_CHECKPOINT_DIR",
+                        os.path.expanduser(os.path.join("~", ".magenta", "models", "cat-mel_2bar_big"))))
+    parser.add_argument("--config", default="cat-mel_2bar_big")
+    parser.add_argument("--output", default="exported_model")
+    parser.add_argument("--batch-size", type=int, default=8, help="Deve ser igual a MUSIC_VAE_MAX_BATCH do app")
+    parser.add_argument("--tflite-encoder", action="store_true")
+    parser.add_argument("--quantize", action="store_true", help="Pesos do encoder TFLite em int8")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export(args.checkpoint, args.config, args.output, args.batch_size, args.tflite_encoder, args.quantize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Inferência otimizada do MusicVAE em CPU a partir do artefato de export_model.py.
+
+FrozenMusicVAE carrega o grafo congelado (encoder + decoder, pesos como
+constantes) numa sessão com número de threads explícito e, opcionalmente,
+XLA e o encoder em TFLite. Tem a mesma interface usada pelo app do
+TrainedModel (config, encode, decode), então os micro-batchers e o cache de
+latentes funcionam sem mudanças.
+
+Threads: com vários workers (gunicorn) no mesmo host, cada processo deve usar
+só a sua fatia dos núcleos. Por padrão intra-op = núcleos / workers e
+inter-op = 2 (encode e decode podem rodar ao mesmo tempo, um lote de cada).
+"""
+import os
+import copy
+import json
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FROZEN_GRAPH_FILE = "music_vae_frozen.pb"
+TFLITE_ENCODER_FILE = "music_vae_encoder.tflite"
+EXPORT_METADATA_FILE = "export.json"
+
+
+def default_thread_counts():
+    """(intra_op, inter_op) para este processo, dividindo os núcleos entre os workers."""
+    workers = int(os.getenv("MUSIC_VAE_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+    intra = int(os.getenv("MUSIC_VAE_INTRA_OP_THREADS", "0")) or max(1, (os.cpu_count() or 1) // max(workers, 1))
+    inter = int(os.getenv("MUSIC_VAE_INTER_OP_THREADS", "0")) or 2
+    return intra, inter
+
+
+class FrozenMusicVAE:
+
+    def __init__(self, export_dir, intra_op_threads=None, inter_op_threads=None, use_xla=False, use_tflite_encoder=True):
+        import tensorflow.compat.v1 as tf
+        from magenta.models.music_vae import configs
+
+        with open(os.path.join(export_dir, EXPORT_METADATA_FILE), encoding='utf-8') as f:
+            self.metadata = json.load(f)
+        # Cópia, como no TrainedModel: o CONFIG_MAP é global e outros modelos usam a mesma configuração
+        self.config = copy.deepcopy(configs.CONFIG_MAP[self.metadata["config_name"]])
+        self.config.data_converter.set_mode('infer')
+        self.config.hparams.batch_size = self.metadata["batch_size"]
+        self.batch_size = self.metadata["batch_size"]
+
+        default_intra, default_inter = default_thread_counts()
+        self.intra_op_threads = intra_op_threads or default_intra
+        self.inter_op_threads = inter_op_threads or default_inter
+
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, FROZEN_GRAPH_FILE), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+
+        session_config = tf.ConfigProto(
+            intra_op_parallelism_threads=self.intra_op_threads,
+            inter_op_parallelism_threads=self.inter_op_threads,
+        )
+        if use_xla:
+            session_config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        self._sess = tf.Session(graph=self._graph, config=session_config)
+
+        names = self.metadata["tensors"]
+        self._t = {key: (self._graph.get_tensor_by_name(name) if name else None) for key, name in names.items()}
+
+        # Encoder em TFLite (pesos int8 quando exportado com --quantize), se disponível
+        self._interpreter = None
+        tflite_file = self.metadata.get("tflite_encoder")
+        if use_tflite_encoder and tflite_file:
+            self._interpreter = tf.lite.Interpreter(
+                model_path=os.path.join(export_dir, tflite_file), num_threads=self.intra_op_threads
+            )
+            self._tflite_inputs = {d["name"].split(":")[0]: d["index"] for d in self._interpreter.get_input_details()}
+            self._tflite_outputs = [d["index"] for d in self._interpreter.get_output_details()]
+            self._tflite_shape = None
+
+        logger.info(f"MusicVAE congelado carregado de {export_dir} (intra-op {self.intra_op_threads}, "
+                    f"inter-op {self.inter_op_threads}, XLA {'sim' if use_xla else 'não'}, "
+                    f"encoder {'TFLite' if self._interpreter else 'TF'}).")
+
+    def _pad_batch(self, array, n):
+        """Completa com zeros até um múltiplo do batch_size do grafo (como o TrainedModel)."""
+        pad = -n % self.batch_size
+        if pad:
+            array = np.pad(array, [(0, pad)] + [(0, 0)] * (array.ndim - 1), mode='constant')
+        return array
+
+    def encode(self, note_sequences):
+        """Mesmo contrato (e mesmas exceções) do TrainedModel.encode: retorna (z, mu, sigma)."""
+        from magenta.models.music_vae.trained_model import NoExtractedExamplesError, MultipleExtractedExamplesError
+
+        converter = self.config.data_converter
+        inputs, controls, lengths = [], [], []
+        # to_tensors recebe uma NoteSequence por vez, como no TrainedModel
+        for note_sequence in note_sequences:
+            tensors = converter.to_tensors(note_sequence)
+            if not tensors.inputs:
+                raise NoExtractedExamplesError(f"Nenhum exemplo extraído de NoteSequence: {note_sequence}")
+            if len(tensors.inputs) > 1:
+                raise MultipleExtractedExamplesError(f"Mais de um exemplo extraído de NoteSequence: {note_sequence}")
+            inputs.append(tensors.inputs[0])
+            controls.append(tensors.controls[0])
+            lengths.append(tensors.lengths[0])
+
+        n = len(inputs)
+        max_length = max(len(t) for t in inputs)
+        inputs_array = np.zeros([n, max_length, converter.input_depth], dtype=np.float32)
+        controls_array = np.zeros([n, max_length, converter.control_depth], dtype=np.float32)
+        for i, (t, c) in enumerate(zip(inputs, controls)):
+            inputs_array[i, :len(t)] = t
+            if converter.control_depth:
+                controls_array[i, :len(c)] = c
+        inputs_array = self._pad_batch(inputs_array, n)
+        controls_array = self._pad_batch(controls_array, n)
+        length_array = self._pad_batch(np.array(lengths, dtype=np.int32), n)
+
+        outputs = []
+        for start in range(0, len(inputs_array), self.batch_size):
+            batch = slice(start, start + self.batch_size)
+            if self._interpreter is not None:
+                mu, sigma = self._encode_tflite(inputs_array[batch], length_array[batch])
+                z = mu + sigma * np.random.randn(*mu.shape).astype(np.float32)
+                outputs.append((z, mu, sigma))
+            else:
+                feed = {self._t["inputs"]: inputs_array[batch], self._t["inputs_length"]: length_array[batch]}
+                if self._t["controls"] is not None:
+                    feed[self._t["controls"]] = controls_array[batch]
+                outputs.append(self._sess.run([self._t["z"], self._t["mu"], self._t["sigma"]], feed))
+        return tuple(np.vstack(v)[:n] for v in zip(*outputs))
+
+    def _encode_tflite(self, inputs, lengths):
+        interpreter = self._interpreter
+        inputs_index = self._tflite_inputs[self.metadata["tensors"]["inputs"].split(":")[0]]
+        lengths_index = self._tflite_inputs[self.metadata["tensors"]["inputs_length"].split(":")[0]]
+        # O comprimento da sequência varia entre lotes: redimensiona a entrada quando preciso
+        if self._tflite_shape != inputs.shape:
+            interpreter.resize_tensor_input(inputs_index, inputs.shape)
+            interpreter.resize_tensor_input(lengths_index, lengths.shape)
+            interpreter.allocate_tensors()
+            self._tflite_shape = inputs.shape
+        interpreter.set_tensor(inputs_index, inputs.astype(np.float32))
+        interpreter.set_tensor(lengths_index, lengths.astype(np.int32))
+        interpreter.invoke()
+        mu, sigma = (interpreter.get_tensor(i) for i in self._tflite_outputs)
+        return mu, sigma
+
+    def decode(self, z, length=None, temperature=1.0):
+        """Mesmo contrato do TrainedModel.decode: retorna uma lista de NoteSequences."""
+        z = np.asarray(z, dtype=np.float32)
+        n = len(z)
+        length = length or self.config.hparams.max_seq_len
+        z = self._pad_batch(z, n)
+        outputs = []
+        for start in range(0, len(z), self.batch_size):
+            feed = {
+                self._t["temperature"]: temperature,
+                self._t["z_input"]: z[start:start + self.batch_size],
+                self._t["max_length"]: length,
+            }
+            outputs.extend(self._sess.run(self._t["outputs"], feed))
+        return self.config.data_converter.from_tensors(outputs[:n])
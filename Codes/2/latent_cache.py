@@ -0,0 +1,111 @@
+"""
+Cache de vetores latentes do MusicVAE por conteúdo do primer.
+
+A chave é um hash do conteúdo quantizado do primer (alturas, velocities,
+passos de início/fim, instrumento), da quantização, do andamento/compasso
+e do nome da configuração do modelo. Assim, regenerar o mesmo arquivo com
+outra temperatura ou duração não passa de novo pelo encoder.
+
+Guardamos a distribuição posterior (mu, sigma) em vez de um z amostrado, para
+que cada geração continue sorteando um z diferente (z = mu + sigma * eps).
+As entradas ficam numa única matriz float32 pré-alocada (max_entries x 2 x z_size),
+com despejo LRU e, opcionalmente, persistência em disco (um .npy por chave).
+"""
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def primer_cache_key(primer_sequence, config_name):
+    """Hash canônico de um NoteSequence quantizado + configuração do modelo."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(config_name.encode('utf-8'))
+    info = primer_sequence.quantization_info
+    h.update(f"|q:{info.steps_per_quarter}:{info.steps_per_second}".encode('utf-8'))
+    for t in primer_sequence.tempos:
+        h.update(f"|t:{t.time:.4f}:{t.qpm:.4f}".encode('utf-8'))
+    for ts in primer_sequence.time_signatures:
+        h.update(f"|ts:{ts.time:.4f}:{ts.numerator}/{ts.denominator}".encode('utf-8'))
+    notes = sorted(
+        (n.quantized_start_step, n.quantized_end_step, n.pitch, n.velocity, n.instrument, n.program, n.is_drum)
+        for n in primer_sequence.notes
+    )
+    h.update(repr(notes).encode('utf-8'))
+    return h.hexdigest()
+
+
+class LatentCache:
+
+    def __init__(self, max_entries=1024, persist_dir=None):
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._slots = OrderedDict() # chave -> índice na matriz (ordem = recência)
+        self._free = list(range(max_entries))
+        self._matrix = None         # Alocada no primeiro put, quando z_size é conhecido
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.npy")
+
+    def get(self, key):
+        """Retorna (mu, sigma) para a chave ou None."""
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._slots.move_to_end(key)
+                self.hits += 1
+                entry = self._matrix[slot]
+                return entry[0].copy(), entry[1].copy()
+        if self.persist_dir and os.path.exists(self._disk_path(key)):
+            try:
+                entry = np.load(self._disk_path(key))
+                self._store(key, entry)
+                with self._lock:
+                    self.hits += 1
+                return entry[0], entry[1]
+            except Exception as e:
+                logger.warning(f"Falha ao ler latente do disco ({key}): {e}")
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, mu, sigma):
+        entry = np.stack((np.asarray(mu, dtype=np.float32), np.asarray(sigma, dtype=np.float32)))
+        self._store(key, entry)
+        if self.persist_dir:
+            try:
+                tmp_path = self._disk_path(key) + ".tmp.npy"
+                np.save(tmp_path, entry)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError as e:
+                logger.warning(f"Falha ao gravar latente no disco ({key}): {e}")
+
+    def _store(self, key, entry):
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries,) + entry.shape, dtype=np.float32)
+            slot = self._slots.get(key)
+            if slot is None:
+                if not self._free:
+                    _, slot = self._slots.popitem(last=False) # Despeja o menos usado recentemente
+                else:
+                    slot = self._free.pop()
+                self._slots[key] = slot
+            else:
+                self._slots.move_to_end(key)
+            self._matrix[slot] = entry
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._slots), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses}
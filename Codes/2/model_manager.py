@@ -0,0 +1,116 @@
+"""
+Ciclo de vida do modelo MusicVAE: carga em segundo plano, aquecimento e
+novas tentativas com backoff exponencial.
+
+O ModelManager recebe duas funções:
+  - loader(): constrói e retorna o modelo (levanta exceção em caso de falha);
+  - warmup(model): roda uma inferência de aquecimento (opcional).
+
+Estados: "idle" -> "loading" -> "warming" -> "ready"; em caso de falha,
+"retrying" (aguardando o próximo backoff) ou "failed" (tentativas esgotadas).
+"unavailable" indica que as dependências não estão instaladas.
+"""
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ModelManager:
+
+    def __init__(self, loader, warmup=None, available=True, max_attempts=None,
+                 initial_backoff=2.0, max_backoff=300.0):
+        self._loader = loader
+        self._warmup = warmup
+        self._available = available
+        self._max_attempts = max_attempts # None = tenta indefinidamente
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._ready_event = threading.Event()
+        self._thread = None
+        self._model = None
+        self._state = "idle" if available else "unavailable"
+        self._attempts = 0
+        self._last_error = None
+        self._next_retry_at = None
+        self._load_seconds = None
+        self._warmup_seconds = None
+
+    def start(self):
+        """Inicia a carga em uma thread daemon (idempotente)."""
+        with self._lock:
+            if not self._available or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="music-vae-loader", daemon=True)
+            self._thread.start()
+
+    def _set_state(self, state):
+        with self._lock:
+            self._state = state
+
+    def _run(self):
+        backoff = self._initial_backoff
+        while True:
+            self._attempts += 1
+            try:
+                self._set_state("loading")
+                started = time.perf_counter()
+                model = self._loader()
+                self._load_seconds = round(time.perf_counter() - started, 2)
+
+                if self._warmup is not None:
+                    self._set_state("warming")
+                    started = time.perf_counter()
+                    self._warmup(model)
+                    self._warmup_seconds = round(time.perf_counter() - started, 2)
+
+                with self._lock:
+                    self._model = model
+                    self._state = "ready"
+                    self._last_error = None
+                    self._next_retry_at = None
+                self._ready_event.set()
+                logger.info(f"Modelo pronto (carga {self._load_seconds}s, aquecimento {self._warmup_seconds}s).")
+                return
+            except Exception as e:
+                self._last_error = str(e)
+                if self._max_attempts is not None and self._attempts >= self._max_attempts:
+                    logger.error(f"Falha ao carregar o modelo após {self._attempts} tentativas: {e}", exc_info=True)
+                    self._set_state("failed")
+                    self._ready_event.set() # Libera quem estiver esperando em get()
+                    return
+                # Backoff exponencial com jitter para não sincronizar vários workers
+                delay = min(self._max_backoff, backoff) * random.uniform(0.8, 1.2)
+                backoff *= 2
+                with self._lock:
+                    self._state = "retrying"
+                    self._next_retry_at = time.time() + delay
+                logger.warning(f"Falha ao carregar o modelo (tentativa {self._attempts}): {e}. Nova tentativa em {delay:.1f}s.")
+                time.sleep(delay)
+
+    def get(self, timeout=0):
+        """Retorna o modelo se estiver pronto (aguardando até 'timeout' segundos); senão None."""
+        if timeout:
+            self._ready_event.wait(timeout)
+        with self._lock:
+            return self._model if self._state == "ready" else None
+
+    @property
+    def ready(self):
+        return self._state == "ready"
+
+    def status(self):
+        """Resumo do estado para o endpoint de prontidão."""
+        with self._lock:
+            retry_in = None
+            if self._next_retry_at is not None:
+                retry_in = max(0.0, round(self._next_retry_at - time.time(), 1))
+            return {
+                "state": self._state, "attempts": self._attempts, "last_error": self._last_error,
+                "retry_in_seconds": retry_in, "load_seconds": self._load_seconds,
+                "warmup_seconds": self._warmup_seconds,
+            }
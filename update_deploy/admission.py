@@ -0,0 +1,220 @@
+"""
+Controle de admissão das chamadas ao modelo generativo.
+
+Sem limite, uma rajada de uploads dispara chamadas simultâneas sem fim ao
+modelo, que estouram a cota e falham depois de toda a análise já feita. Aqui
+cada chamada passa por três portas:
+  - balde de fichas por cliente (rate por segundo, rajada de até burst): quem
+    esgota as fichas é adiado com o tempo até a próxima ficha (retry_after);
+  - semáforo global: no máximo max_concurrent chamadas ao modelo ao mesmo tempo,
+    contando cada tentativa (ver hedging.py): a vaga só é liberada quando a
+    chamada termina de fato, mesmo se abandonada depois do prazo, e a tentativa
+    de reserva só sai se houver vaga livre na hora (try_admit);
+  - fila de espera limitada (max_queue), em ordem de chegada e ciente do prazo: o
+    pedido é descartado na hora se a fila está cheia ou se a espera prevista mais
+    a duração prevista da chamada passam do prazo; na fila, desiste quando já não
+    dá tempo de começar a chamada.
+Quem não é admitido recebe GenerationDeferred: o upload responde só com a
+análise e a geração "adiada".
+
+A duração prevista é a média móvel das chamadas já feitas. Serve às threads do
+Flask (admit) e ao event loop do asgi_app.py (admit_async), com a mesma fila: a
+vaga liberada vai direto para o primeiro da fila.
+"""
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+
+
+class GenerationDeferred(Exception):
+    """A geração não foi admitida (limite do cliente, fila cheia ou prazo); tentar após retry_after s."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+
+
+class _Slot:
+    """Vaga de uma chamada ao modelo; ao sair do 'with', registra a duração e libera a vaga."""
+
+    def __init__(self, admission):
+        self._admission = admission
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self._admission._release(time.monotonic() - self._started)
+        return False
+
+
+class GenerationAdmission:
+
+    def __init__(self, max_concurrent=4, max_queue=16, rate=0.2, burst=3, expected_latency=10.0, max_clients=10000):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._latency = expected_latency   # Média móvel da duração das chamadas (segundos)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+        self._buckets = OrderedDict()      # cliente -> (fichas, instante), ordem = recência
+        self.stats_counters = {"admitted": 0, "admitted_after_wait": 0, "admitted_extra": 0, "rate_limited": 0,
+                               "shed_queue_full": 0, "shed_deadline": 0, "shed_wait_timeout": 0, "peak_waiting": 0}
+        self._wait_seconds = 0.0
+
+    # --- Balde de fichas por cliente ---
+
+    def _take_token(self, client):
+        """Gasta uma ficha do cliente; retorna 0 ou os segundos até a próxima ficha."""
+        if client is None or self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, last = self._buckets.pop(client, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    # --- Semáforo e fila ---
+
+    def _enter(self, client, deadline, loop=None):
+        """Decide na hora: retorna (_Slot, None) se admitido, (None, _Waiter) para esperar, ou levanta GenerationDeferred."""
+        with self._lock:
+            free_slot = self._in_flight < self.max_concurrent and not self._waiters
+            if not free_slot:
+                # Descartes antes de gastar a ficha do cliente
+                if len(self._waiters) >= self.max_queue:
+                    self.stats_counters["shed_queue_full"] += 1
+                    raise GenerationDeferred("queue_full", self._latency)
+                expected_wait = (len(self._waiters) + 1) / self.max_concurrent * self._latency
+                if deadline is not None and time.monotonic() + expected_wait + self._latency > deadline:
+                    self.stats_counters["shed_deadline"] += 1
+                    raise GenerationDeferred("deadline", expected_wait)
+            retry_after = self._take_token(client)
+            if retry_after:
+                self.stats_counters["rate_limited"] += 1
+                raise GenerationDeferred("rate_limited", retry_after)
+            if free_slot:
+                self._in_flight += 1
+                self.stats_counters["admitted"] += 1
+                return _Slot(self), None
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            self.stats_counters["peak_waiting"] = max(self.stats_counters["peak_waiting"], len(self._waiters))
+            return None, waiter
+
+    def _wait_timeout(self, deadline):
+        """Quanto esperar na fila: até o último instante em que a chamada ainda termina no prazo."""
+        if deadline is None:
+            return None
+        return max(0.0, deadline - self._latency - time.monotonic())
+
+    def _leave(self, waiter, waited):
+        """Fim da espera na fila: _Slot se a vaga chegou, senão GenerationDeferred."""
+        with self._lock:
+            self._wait_seconds += waited
+            if waiter.granted:
+                self.stats_counters["admitted"] += 1
+                self.stats_counters["admitted_after_wait"] += 1
+                return _Slot(self)
+            self._waiters.remove(waiter)
+            self.stats_counters["shed_wait_timeout"] += 1
+        raise GenerationDeferred("deadline", self._latency)
+
+    def admit(self, client=None, deadline=None):
+        """
+        Admissão de uma chamada ao modelo (threads). 'deadline' (time.monotonic) é o instante
+        até o qual a resposta ainda serve; None espera na fila sem prazo. Retorna a vaga, para
+        usar com 'with', ou levanta GenerationDeferred.
+        """
+        slot, waiter = self._enter(client, deadline)
+        if slot is not None:
+            return slot
+        started = time.monotonic()
+        waiter.event.wait(self._wait_timeout(deadline))
+        return self._leave(waiter, time.monotonic() - started)
+
+    def try_admit(self):
+        """
+        Vaga imediata para uma tentativa extra da mesma chamada (reserva): sem fila e sem ficha
+        do cliente, e só se ninguém está esperando. Retorna a vaga ou None.
+        """
+        with self._lock:
+            if self._in_flight >= self.max_concurrent or self._waiters:
+                return None
+            self._in_flight += 1
+            self.stats_counters["admitted_extra"] += 1
+            return _Slot(self)
+
+    async def admit_async(self, client=None, deadline=None):
+        """admit() para o event loop: espera a vaga sem prender uma thread."""
+        slot, waiter = self._enter(client, deadline, asyncio.get_running_loop())
+        if slot is not None:
+            return slot
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self._wait_timeout(deadline))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Requisição cancelada na fila: sai dela, ou devolve a vaga se ela já tinha chegado
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                self._release(None)
+            raise
+        return self._leave(waiter, time.monotonic() - started)
+
+    def _release(self, duration):
+        with self._lock:
+            if duration is not None:
+                self._latency = 0.8 * self._latency + 0.2 * duration
+            if self._waiters:
+                # A vaga passa direto para o primeiro da fila
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self._in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            waited = self.stats_counters["admitted_after_wait"] + self.stats_counters["shed_wait_timeout"]
+            return {
+                "max_concurrent": self.max_concurrent, "max_queue": self.max_queue,
+                "rate_per_client": self.rate, "burst_per_client": self.burst,
+                "in_flight": self._in_flight, "waiting": len(self._waiters),
+                "expected_latency_seconds": round(self._latency, 3),
+                "avg_wait_seconds": round(self._wait_seconds / waited, 3) if waited else 0.0,
+                **self.stats_counters,
+            }
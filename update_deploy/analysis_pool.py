@@ -0,0 +1,288 @@
+"""
+Pool de processos para a análise com o music21, fora da thread da requisição.
+
+Sob o GIL, uma análise pesada (chordify de um MIDI com centenas de milhares de
+eventos) trava todas as requisições do mesmo processo; no pool ela roda em
+outro processo e a thread da requisição só espera no pipe.
+
+  - Processos pré-aquecidos: criados pelo forkserver com o __main__ e o
+    music_analysis (e o music21) já importados, então repor um processo custa um fork.
+  - Limites por tarefa: tempo de parede (task_timeout) e memória residente
+    (max_rss_mb, via psutil). Estourou, o processo é morto e substituído.
+  - Reciclagem: cada processo é substituído depois de max_tasks_per_worker
+    tarefas, contendo vazamentos de memória.
+
+As tarefas são as funções de music_analysis.TASKS. Se a tarefa é um gerador, cada
+valor produzido chega como resultado parcial (ex: a etapa 1 da análise, para a
+geração começar) e o valor retornado é o resultado final. Se a tarefa é morta,
+AnalysisAborted informa o motivo e o último resultado parcial, para o chamador
+montar um resultado degradado. Com submit(..., profile=opções), a tarefa roda sob
+o profiler (profiling.WorkerProfiler) e o perfil chega em AnalysisTask.profile.
+"""
+import time
+import inspect
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+_POLL_INTERVAL = 0.05 # Segundos entre as verificações de tempo e memória
+
+
+class AnalysisAborted(Exception):
+    """A tarefa foi interrompida (tempo, memória, fila cheia ou processo morto)."""
+
+    def __init__(self, reason, partial=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.partial = partial
+
+
+def _worker_main(conn):
+    """Laço de um processo do pool: recebe (tarefa, args, profiling), envia parciais, o perfil e o resultado."""
+    import music_analysis # Já importado pelo forkserver; garante o import com 'spawn'
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        task_name, args, profile = message
+        profiler = None
+        if profile is not None:
+            from profiling import WorkerProfiler
+            profiler = WorkerProfiler(profile["mode"], profile["interval"]).start()
+        try:
+            result = music_analysis.TASKS[task_name](*args)
+            if inspect.isgenerator(result):
+                while True:
+                    conn.send(("partial", next(result)))
+            outcome = ("ok", result)
+        except StopIteration as stop:
+            outcome = ("ok", stop.value)
+        except Exception as e:
+            outcome = ("error", f"{type(e).__name__}: {e}")
+        if profiler is not None:
+            conn.send(("profile", profiler.stop()))
+        conn.send(outcome)
+
+
+class _Worker:
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def rss_mb(self):
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return 0.0
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class AnalysisTask:
+    """Tarefa em andamento: partial() espera o primeiro resultado parcial, result() o final."""
+
+    def __init__(self):
+        self._partial = Future()
+        self._result = Future()
+        self.last_partial = None
+        self.profile = None # Perfil da tarefa, se pedido (chega antes do resultado final)
+
+    def partial(self, timeout=None):
+        return self._partial.result(timeout)
+
+    def result(self, timeout=None):
+        return self._result.result(timeout)
+
+    def _deliver_partial(self, value):
+        self.last_partial = value
+        if not self._partial.done():
+            self._partial.set_result(value)
+
+    def _finish(self, value=None, error=None):
+        for future in (self._partial, self._result):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif future is self._partial:
+                future.set_result(None) # Terminou sem parcial (ex: arquivo vazio)
+            else:
+                future.set_result(value)
+
+
+class AnalysisPool:
+
+    def __init__(self, workers=2, task_timeout=60.0, max_rss_mb=1024, max_tasks_per_worker=50, queue_timeout=30.0):
+        self.size = workers
+        self.task_timeout = task_timeout
+        self.max_rss_mb = max_rss_mb
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = []
+        self._starting = 0
+        self._context = None
+        self.stats_counters = {"completed": 0, "failed": 0, "timeouts": 0, "memory_kills": 0,
+                               "crashes": 0, "recycled": 0, "queue_timeouts": 0}
+
+    def start(self):
+        """Cria os processos (idempotente). Chamar depois do import do app, não no import."""
+        with self._lock:
+            if self._context is not None:
+                return self
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                self._context = multiprocessing.get_context("forkserver")
+                # O forkserver importa o __main__ (ex: app.py) e o módulo de análise uma vez;
+                # sem o __main__ no preload, cada processo criado o reimportaria ao iniciar.
+                # O __main__ precisa da guarda 'if __name__ == "__main__"'.
+                self._context.set_forkserver_preload(["__main__", "music_analysis"])
+            else:
+                self._context = multiprocessing.get_context("spawn")
+            self._starting = self.size
+        for _ in range(self.size):
+            self._spawn()
+        return self
+
+    def _spawn(self):
+        """Cria um processo novo em segundo plano e o disponibiliza quando estiver pronto."""
+        def spawn():
+            try:
+                worker = _Worker(self._context)
+            except Exception as e:
+                logger.error(f"Falha ao criar processo de análise: {e}")
+                worker = None
+            with self._lock:
+                self._starting -= 1
+                if worker is not None:
+                    self._idle.append(worker)
+                self._available.notify()
+        threading.Thread(target=spawn, daemon=True, name="analysis-pool-spawn").start()
+
+    def _replace(self, worker, kill):
+        (worker.kill if kill else worker.stop)()
+        with self._lock:
+            self._starting += 1
+        self._spawn()
+
+    def submit(self, task_name, *args, profile=None, timeout=None):
+        """
+        Envia a tarefa ao primeiro processo livre (espera até queue_timeout) e retorna um
+        AnalysisTask; um supervisor (thread) aplica os limites e recicla o processo.
+        'profile' (RequestProfile.worker_options) roda a tarefa sob o profiler; 'timeout'
+        substitui o task_timeout do pool só para esta tarefa.
+        """
+        self.start()
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            with self._lock:
+                while not self._idle:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats_counters["queue_timeouts"] += 1
+                        raise AnalysisAborted("Nenhum processo de análise livre a tempo.")
+                    self._available.wait(remaining)
+                worker = self._idle.pop()
+            try:
+                worker.conn.send((task_name, args, profile))
+                break
+            except (EOFError, OSError) as e:
+                # O processo morreu enquanto estava livre: repõe e tenta o próximo (mesmo prazo)
+                logger.warning(f"Processo de análise livre estava morto ({e}); substituindo.")
+                with self._lock:
+                    self.stats_counters["crashes"] += 1
+                self._replace(worker, kill=True)
+        task = AnalysisTask()
+        threading.Thread(target=self._supervise, args=(worker, task, timeout or self.task_timeout), daemon=True,
+                         name="analysis-pool-supervisor").start()
+        return task
+
+    def run(self, task_name, *args, profile=None, timeout=None):
+        """Executa a tarefa e espera o resultado final (AnalysisAborted se for interrompida)."""
+        return self.submit(task_name, *args, profile=profile, timeout=timeout).result()
+
+    def _supervise(self, worker, task, task_timeout):
+        started = time.monotonic()
+        kill_reason, counter = None, None
+        while True:
+            try:
+                ready = worker.conn.poll(_POLL_INTERVAL)
+                message = worker.conn.recv() if ready else None
+            except (EOFError, OSError):
+                kill_reason, counter = "O processo de análise terminou inesperadamente.", "crashes"
+                break
+            if message is not None:
+                kind, value = message
+                if kind == "partial":
+                    task._deliver_partial(value)
+                    continue
+                if kind == "profile":
+                    task.profile = value
+                    continue
+                worker.tasks += 1
+                with self._lock:
+                    self.stats_counters["completed" if kind == "ok" else "failed"] += 1
+                if kind == "ok":
+                    task._finish(value)
+                else:
+                    task._finish(error=AnalysisAborted(f"Erro na análise: {value}", task.last_partial))
+                break
+            if time.monotonic() - started > task_timeout:
+                kill_reason, counter = f"Análise excedeu {task_timeout:g} s.", "timeouts"
+                break
+            if self.max_rss_mb and worker.rss_mb() > self.max_rss_mb:
+                kill_reason, counter = f"Análise excedeu {self.max_rss_mb} MB de memória.", "memory_kills"
+                break
+
+        if kill_reason is not None:
+            logger.warning(f"Matando o processo de análise {worker.process.pid}: {kill_reason}")
+            with self._lock:
+                self.stats_counters[counter] += 1
+            self._replace(worker, kill=True)
+            task._finish(error=AnalysisAborted(kill_reason, task.last_partial))
+        elif worker.tasks >= self.max_tasks_per_worker:
+            with self._lock:
+                self.stats_counters["recycled"] += 1
+            self._replace(worker, kill=False)
+        else:
+            with self._lock:
+                self._idle.append(worker)
+                self._available.notify()
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.size, "idle": len(self._idle), "starting": self._starting,
+                    "task_timeout": self.task_timeout, "max_rss_mb": self.max_rss_mb,
+                    "max_tasks_per_worker": self.max_tasks_per_worker, **self.stats_counters}
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
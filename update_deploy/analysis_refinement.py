@@ -0,0 +1,99 @@
+"""
+Refinamento em segundo plano das análises que saíram aproximadas.
+
+Com orçamento de tempo (ANALYSIS_BUDGET_SECONDS), a análise de um arquivo grande
+responde com as características harmônicas de uma amostra de compassos. O
+refinamento roda a análise completa depois da resposta e guarda o resultado por
+hash do arquivo, para o cliente buscá-lo (GET /analysis/<hash>/refined) ou
+esperá-lo num evento SSE (GET /analysis/<hash>/events).
+
+O módulo não conhece Flask nem o music21: refine_fn(*args) retorna a análise
+completa (dict) ou levanta uma exceção; on_ready(chave, análise) é chamado
+quando ela fica pronta (ex: para atualizar o cache de respostas).
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class _Refinement:
+
+    def __init__(self):
+        self.status = "pending"    # pending -> ready | failed
+        self.analysis = None
+        self.error = None
+        self.started = time.time()
+        self.seconds = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        return {"status": self.status, "analysis": self.analysis, "error": self.error, "seconds": self.seconds}
+
+
+class AnalysisRefinements:
+
+    def __init__(self, refine_fn, on_ready=None, workers=1, max_entries=100):
+        self._refine_fn = refine_fn
+        self._on_ready = on_ready
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # chave -> _Refinement (ordem = recência, para despejo)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-refine")
+
+    def schedule(self, key, *args):
+        """Agenda o refinamento de 'key' (nada a fazer se já estiver pendente ou pronto)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.status != "failed":
+                self._entries.move_to_end(key)
+                return False
+            entry = self._entries[key] = _Refinement()
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._executor.submit(self._run, key, entry, args)
+        return True
+
+    def _run(self, key, entry, args):
+        try:
+            analysis = self._refine_fn(*args)
+        except Exception as e:
+            logger.warning(f"Refinamento da análise {key} falhou: {e}")
+            with self._lock:
+                entry.status, entry.error = "failed", str(e)
+        else:
+            with self._lock:
+                entry.status, entry.analysis = "ready", analysis
+            if self._on_ready is not None:
+                try:
+                    self._on_ready(key, analysis)
+                except Exception as e:
+                    logger.warning(f"Falha ao aplicar o refinamento da análise {key}: {e}")
+        finally:
+            entry.seconds = round(time.time() - entry.started, 3)
+            entry.done.set()
+
+    def get(self, key):
+        """Estado do refinamento ({"status", "analysis", "error", "seconds"}) ou None se desconhecido."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.as_dict() if entry is not None else None
+
+    def wait(self, key, timeout=None):
+        """Espera o refinamento terminar (até 'timeout' segundos) e retorna o estado, como get()."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry.done.wait(timeout)
+        return self.get(key)
+
+    def stats(self):
+        with self._lock:
+            statuses = [entry.status for entry in self._entries.values()]
+        return {"entries": len(statuses), "max_entries": self.max_entries,
+                **{status: statuses.count(status) for status in ("pending", "ready", "failed")}}
@@ -1,21 +1,51 @@
-from flask import Flask, render_template, request, jsonify, url_for
+from flask import Flask, Response, render_template, request, jsonify, url_for, send_file, abort, g
+from flask.logging import default_handler
+import io
 import random
 import os
 import tempfile
 import google.generativeai as genai
 import json
-import re
 import hashlib
 import copy
+import glob
+import functools
 import statistics 
 import math
+import time
+import logging
+import threading
 
-from music21 import converter, tempo, pitch, key, environment, stream, note, chord, roman, common, meter, duration as m21duration
+from music21 import tempo, pitch, key, environment, stream, note, chord, common
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from music21 import analysis as m21analysis
 
 from mido import MidiFile as MidoMidiFile
 
+import corpus
+from similarity import SimilarityIndex, CORPUS_INDEX_DIR
+from phrase_index import PhraseIndex, PHRASE_INDEX_DIR
+from markov import MarkovContinuationEngine, MARKOV_MODEL_DIR
+import candidates
+from variations import VariationPool
+from sessions import CompositionSession, SessionStore
+from bar_analysis import BarAnalysis, AnalysisVersions, DERIVED_FIELDS, ESTIMATED_FIELDS
+from prompt_cache import PromptCache, prompt_cache_key
+from fake_backend import FakeGenerativeModel
+from music_analysis import (
+    separate_piano_parts, midi_stream_to_text, analyze_prompt_features, build_analysis_text,
+    analyze_detailed_features, analyze_midi_with_music21, empty_analysis_results, refine_analysis_task,
+)
+from analysis_pool import AnalysisPool, AnalysisAborted
+from analysis_refinement import AnalysisRefinements
+from batch_upload import collect_batch_files, BatchDeduper
+from admission import GenerationAdmission, GenerationDeferred
+from hedging import HedgedCaller, CallDeadlineExceeded
+from json_repair import repair_generation, RepairStats
+from structured_logging import configure_logging, PayloadLog
+from profiling import RequestProfile, MODES as PROFILE_MODES, profile_stage, prune_profiles
+
 # Conexão utilizando key da API
 try:
     genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
@@ -24,94 +54,170 @@ except Exception as e:
 
 app = Flask(__name__)
 
+# Logs estruturados e assíncronos (ver structured_logging.py): LOG_FORMAT "json" (padrão) ou "text",
+# LOG_LEVEL, LOG_FILE (padrão: stderr) e até LOG_QUEUE_SIZE registros na fila antes de descartar
+LOG_HANDLER = configure_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"), fmt=os.getenv("LOG_FORMAT", "json"), log_file=os.getenv("LOG_FILE") or None,
+    queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
+)
+app.logger.removeHandler(default_handler) # O logger do app propaga para o handler assíncrono da raiz
+
+# Payloads grandes (respostas do modelo, JSON gerado): só uma fração LOG_PAYLOAD_SAMPLE_RATE vai ao log
+# (avisos e erros sempre), truncada em LOG_PAYLOAD_MAX_CHARS; os últimos LOG_PAYLOAD_BUFFER completos ficam
+# em memória, em GET /debug/payloads (liberada com o cabeçalho X-Debug-Token = DEBUG_PAYLOADS_TOKEN, ou em modo debug)
+PAYLOAD_LOG = PayloadLog(
+    capacity=int(os.getenv("LOG_PAYLOAD_BUFFER", "50")),
+    sample_rate=float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01")),
+    max_chars=int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000")),
+)
+DEBUG_PAYLOADS_TOKEN = os.getenv("DEBUG_PAYLOADS_TOKEN")
+
+# Profiling sob demanda do upload (ver profiling.py): cabeçalho X-Profile ("sample" ou "cprofile"; exige o
+# acesso de depuração) ou uma fração PROFILE_SAMPLE_RATE dos uploads (alterável em POST /debug/profiling).
+# Os perfis vão para PROFILE_DIR (ficam os últimos PROFILE_KEEP), com uma amostra a cada PROFILE_INTERVAL_MS.
+PROFILING = {"sample_rate": float(os.getenv("PROFILE_SAMPLE_RATE", "0")), "mode": os.getenv("PROFILE_MODE", "sample")}
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+
 # Cache para armazenar os resultados das gerações de MIDI
 MIDI_GENERATION_CACHE = {}
 
+# Índice de similaridade do corpus (carregado sob demanda, ver similarity.py)
+SIMILARITY_INDEX = None
+SIMILARITY_MAX_K = 50
+
+# Recuperação de frases do corpus como exemplos few-shot no prompt (ver phrase_index.py)
+PROMPT_RETRIEVAL_ENABLED = os.getenv("PROMPT_RETRIEVAL_ENABLED", "1") == "1"
+PROMPT_RETRIEVAL_TOKEN_BUDGET = int(os.getenv("PROMPT_RETRIEVAL_TOKEN_BUDGET", "600"))
+PHRASE_INDEX = None
+
+# Backend de geração: "gemini" (padrão, com o motor Markov local como fallback), "markov" (somente local)
+# ou "fake" (modelo falso com latência simulada para testes de carga, ver fake_backend.py)
+GENERATION_BACKEND = os.getenv("GENERATION_BACKEND", "gemini")
+GEMINI_MODEL_NAME = 'models/gemini-pro-latest'
+REMOTE_GENERATION_SOURCE = "fake" if GENERATION_BACKEND == "fake" else "gemini"
+MARKOV_ENGINE = None
+
+# Cache das respostas do Gemini por prompt renderizado (+ modelo e configurações), ver prompt_cache.py.
+# Por requisição, 'fresh=1' ignora o cache e pede uma resposta nova.
+PROMPT_CACHE = PromptCache(
+    max_entries=int(os.getenv("PROMPT_CACHE_SIZE", "256")),
+    ttl_seconds=int(os.getenv("PROMPT_CACHE_TTL_SECONDS", str(24 * 3600))),
+)
+
+# Modo de múltiplos candidatos: N continuações numa única chamada, escolhe a melhor (ver candidates.py).
+# O padrão pode ser sobrescrito por requisição com o campo 'candidates' do formulário.
+GENERATION_CANDIDATES = int(os.getenv("GENERATION_CANDIDATES", "1"))
+GENERATION_MAX_CANDIDATES = 5
+
+# Threads da etapa de geração do pipeline de upload (a análise detalhada roda em paralelo)
+GENERATION_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("GENERATION_WORKERS", "4")), thread_name_prefix="generation")
+
+# Controle de admissão das chamadas ao modelo (ver admission.py): no máximo GENERATION_MAX_CONCURRENT
+# chamadas ao mesmo tempo, fila de GENERATION_MAX_QUEUE pedidos e um balde de fichas por cliente
+# (GENERATION_RATE_PER_CLIENT fichas por segundo, rajada de GENERATION_BURST_PER_CLIENT). Quem não
+# couber até GENERATION_DEADLINE_SECONDS depois do início do upload recebe só a análise, com a
+# geração adiada.
+GENERATION_ADMISSION = GenerationAdmission(
+    max_concurrent=int(os.getenv("GENERATION_MAX_CONCURRENT", "4")),
+    max_queue=int(os.getenv("GENERATION_MAX_QUEUE", "16")),
+    rate=float(os.getenv("GENERATION_RATE_PER_CLIENT", "0.2")),
+    burst=int(os.getenv("GENERATION_BURST_PER_CLIENT", "5")),
+    expected_latency=float(os.getenv("GENERATION_EXPECTED_LATENCY_SECONDS", "10")),
+)
+GENERATION_DEADLINE_SECONDS = float(os.getenv("GENERATION_DEADLINE_SECONDS", "45"))
+# Prazo de cada chamada ao modelo e reserva (ver hedging.py): passou do quantil GENERATION_HEDGE_QUANTILE
+# das latências recentes sem resposta, uma segunda tentativa é disparada (no máximo uma fração
+# GENERATION_HEDGE_BUDGET das chamadas). A chamada termina até GENERATION_CALL_TIMEOUT_SECONDS, ou antes,
+# deixando GENERATION_FALLBACK_RESERVE_SECONDS do prazo do upload para o gerador local.
+GENERATION_CALL_TIMEOUT_SECONDS = float(os.getenv("GENERATION_CALL_TIMEOUT_SECONDS", "30"))
+GENERATION_FALLBACK_RESERVE_SECONDS = float(os.getenv("GENERATION_FALLBACK_RESERVE_SECONDS", "2"))
+# Consertos do JSON das respostas do modelo (json_repair.py): limpas, consertadas e perdidas
+GENERATION_REPAIR_STATS = RepairStats()
+GENERATION_HEDGER = HedgedCaller(
+    max_workers=int(os.getenv("GENERATION_CALL_WORKERS", "16")),
+    hedge_quantile=float(os.getenv("GENERATION_HEDGE_QUANTILE", "0.9")),
+    hedge_budget=float(os.getenv("GENERATION_HEDGE_BUDGET", "0.1")),
+)
+
+# Pool de variações pré-geradas por arquivo (ver variations.py e a rota /variations/<hash>/next)
+VARIATION_POOL_SIZE = int(os.getenv("VARIATION_POOL_SIZE", "3"))
+VARIATION_MAX_PER_FILE = int(os.getenv("VARIATION_MAX_PER_FILE", "12"))
+VARIATION_MAX_PER_USER_HOUR = int(os.getenv("VARIATION_MAX_PER_USER_HOUR", "30"))
+# Cliente dos limites de gasto e de geração: o IP. O cabeçalho X-User-Id só vale com TRUST_USER_ID_HEADER=1,
+# atrás de um proxy que autentica o usuário e define o cabeçalho (descartando o que vier do cliente)
+TRUST_USER_ID_HEADER = os.getenv("TRUST_USER_ID_HEADER", "0") == "1"
+
+
+def get_phrase_index():
+    """Carrega o índice de frases uma única vez; retorna None se ainda não foi construído."""
+    global PHRASE_INDEX
+    if PHRASE_INDEX is None:
+        try:
+            PHRASE_INDEX = PhraseIndex(PHRASE_INDEX_DIR)
+            app.logger.info(f"Índice de frases carregado: {len(PHRASE_INDEX)} frases.")
+        except FileNotFoundError:
+            app.logger.warning(f"Índice de frases não encontrado em {PHRASE_INDEX_DIR}. Recuperação desativada.")
+            return None
+    return PHRASE_INDEX
+
 
-def separate_piano_parts(s):
+def retrieve_style_examples(music_text_rh, music_text_lh):
     """
-    Separa uma stream music21 em partes de mão direita (aguda) e mão esquerda (grave).
-    Retorna (rh_part, lh_part). lh_part pode ser None se for uma stream de parte única.
+    Etapa opcional de recuperação: busca frases do corpus parecidas com o final
+    da música para servirem de exemplos de estilo. Retorna "" se desativada ou indisponível.
     """
-    # Se o arquivo já possui partes, tenta usá-las
-    if len(s.parts) > 1:
-        # Um caso comum para MIDI de piano são duas partes
-        part1 = s.parts[0]
-        part2 = s.parts[1]
+    if not PROMPT_RETRIEVAL_ENABLED:
+        return ""
+    index = get_phrase_index()
+    if index is None:
+        return ""
+    try:
+        start = time.perf_counter()
+        examples = index.style_examples(music_text_rh, music_text_lh, PROMPT_RETRIEVAL_TOKEN_BUDGET)
+        app.logger.info(f"Recuperação de exemplos de estilo em {(time.perf_counter() - start) * 1000:.1f} ms.")
+        return examples
+    except Exception as e:
+        app.logger.warning(f"Falha na recuperação de exemplos de estilo: {e}")
+        return ""
 
-        avg_pitch1 = 0
-        avg_pitch2 = 0
-        
-        notes1 = list(part1.flatten().pitches)
-        notes2 = list(part2.flatten().pitches)
 
-        if not notes1 and not notes2: return (None, None)
-        if not notes1: return (part2, None)
-        if not notes2: return (part1, None)
+def build_generation_prompt(analysis_data, music_text_rh, music_text_lh, style_examples="", num_candidates=1):
+    """
+    Monta o prompt da continuação.
+    'style_examples' são frases do corpus (notação compacta) usadas como referência de estilo.
+    Com num_candidates > 1, pede no mesmo prompt várias variantes ({"variants": [...]}).
+    """
 
-        avg_pitch1 = sum(p.ps for p in notes1) / len(notes1)
-        avg_pitch2 = sum(p.ps for p in notes2) / len(notes2)
-        
-        # Compara as alturas médias para definir mão direita (RH) e esquerda (LH)
-        if avg_pitch1 > avg_pitch2:
-            return (part1, part2) # part1 é RH, part2 é LH
-        else:
-            return (part2, part1) # part2 é RH, part1 é LH
-            
-    # Se for uma stream 'flat' (sem partes), temos que criar as partes dividindo o alcance das notas
-    else:
-        # Por enquanto, se não houver partes, trata como uma única parte (mão direita).
-        return (s, None)
+    # Seção opcional com exemplos recuperados do corpus
+    examples_section = ""
+    if style_examples:
+        examples_section = f"""
+    # EXEMPLOS DE ESTILO (FRASES SEMELHANTES DE OUTRAS PEÇAS, JÁ NA MESMA TONALIDADE) #
+    Notação compacta: altura/duração em quarterLength, acordes entre colchetes, r = pausa. Use apenas como referência de estilo; não copie.
+    {style_examples}
+"""
 
+    # Formato da resposta: um objeto, ou várias variantes no mesmo objeto
+    if num_candidates > 1:
+        response_format = f"""Responda APENAS com um único objeto JSON contendo a chave "variants": uma lista com {num_candidates} continuações DIFERENTES entre si (contorno melódico, ritmo e encadeamento harmônico distintos). Cada variante é um objeto com duas chaves: "right_hand" e "left_hand", cada uma com uma lista de objetos de nota/acorde/pausa. O JSON deve começar estritamente com `{{` e terminar com `}}`.
 
-def midi_stream_to_text(s, limit=64):
-    """
-    Converte uma stream music21 (ou parte) em uma representação de texto (JSON).
-    O limite aumentado fornece mais contexto para a geração.
-    """
-    if not s:
-        return "[]" # Retorna um array JSON vazio se a parte for None
-        
-    components = []
-    # Itera sobre os últimos 'limit' elementos da stream
-    for element in s.flatten().notesAndRests[-limit:]:
-        velocity = 80 # Velocity padrão
-        if hasattr(element, 'volume') and element.volume.velocity is not None:
-            velocity = element.volume.velocity
-
-        if isinstance(element, note.Note):
-            components.append({
-                "type": "note",
-                "pitch": element.pitch.nameWithOctave,
-                "offset": float(element.offset),
-                "quarterLength": float(element.duration.quarterLength),
-                "velocity": velocity
-            })
-        elif isinstance(element, chord.Chord):
-            # Calcula a velocidade média para acordes
-            avg_velocity = round(sum(n.volume.velocity for n in element if n.volume.velocity is not None) / len(element)) if len(element) > 0 else 80
-            components.append({
-                "type": "chord",
-                "pitches": [p.nameWithOctave for p in element.pitches],
-                "offset": float(element.offset),
-                "quarterLength": float(element.duration.quarterLength),
-                "velocity": avg_velocity
-            })
-        elif isinstance(element, note.Rest):
-            components.append({
-                "type": "rest",
-                "offset": float(element.offset),
-                "quarterLength": float(element.duration.quarterLength),
-            })
-    return json.dumps(components, indent=2)
-
-def generate_music_continuation_with_gemini(analysis_data, music_text_rh, music_text_lh):
-    """
-    Gera a continuação da música usando o modelo generativo.
-    """
-    
-    # Define o modelo generativo
-    model = genai.GenerativeModel('models/gemini-pro-latest')
+    Exemplo de formato de resposta:
+    {{
+      "variants": [
+        {{ "right_hand": [ {{ "type": "note", ... }} ], "left_hand": [ {{ "type": "chord", ... }} ] }},
+        ...
+      ]
+    }}"""
+    else:
+        response_format = """Responda APENAS com um único objeto JSON contendo duas chaves: "right_hand" e "left_hand". Cada chave deve conter uma lista de objetos de nota/acorde/pausa. O JSON deve começar estritamente com `{` e terminar com `}`.
+
+    Exemplo de formato de resposta:
+    {
+      "right_hand": [ { "type": "note", ... } ],
+      "left_hand": [ { "type": "chord", ... } ]
+    }"""
 
     # Instruções para a geração da continuação
     prompt = f"""
@@ -133,7 +239,7 @@ def generate_music_continuation_with_gemini(analysis_data, music_text_rh, music_
     ```json
     {music_text_lh}
     ```
-
+{examples_section}
     # SUA TAREFA: COMPOR UMA CONTINUAÇÃO PARA AMBAS AS MÃOS #
     Crie uma continuação de 4 a 8 compassos que se integre perfeitamente. A continuação deve ser uma frase de desenvolvimento, não uma conclusão.
 
@@ -151,39 +257,172 @@ def generate_music_continuation_with_gemini(analysis_data, music_text_rh, music_
     5.  **PONTO DE PARTIDA (OFFSET):** O primeiro evento em ambas as mãos deve começar no ou após o "Último offset" fornecido.
 
     # FORMATO DA RESPOSTA #
-    Responda APENAS com um único objeto JSON contendo duas chaves: "right_hand" e "left_hand". Cada chave deve conter uma lista de objetos de nota/acorde/pausa. O JSON deve começar estritamente com `{{` e terminar com `}}`.
+    {response_format}
+    """
+    return prompt
 
-    Exemplo de formato de resposta:
-    {{
-      "right_hand": [ {{ "type": "note", ... }} ],
-      "left_hand": [ {{ "type": "chord", ... }} ]
-    }}
+
+def get_generative_model():
+    """Cliente do modelo generativo (o falso de fake_backend.py com GENERATION_BACKEND=fake)."""
+    if GENERATION_BACKEND == "fake":
+        return FakeGenerativeModel(GEMINI_MODEL_NAME)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+
+def model_call_deadline(deadline=None):
+    """Prazo (time.monotonic) da chamada ao modelo: o timeout da chamada, limitado pelo prazo do pedido menos a reserva do fallback."""
+    call_deadline = time.monotonic() + GENERATION_CALL_TIMEOUT_SECONDS
+    if deadline is not None:
+        call_deadline = min(call_deadline, deadline - GENERATION_FALLBACK_RESERVE_SECONDS)
+    return call_deadline
+
+
+def model_request_options(call_deadline):
+    """Timeout do cliente do modelo para uma tentativa, para ela não ficar pendurada depois do prazo."""
+    return {"timeout": max(1.0, call_deadline - time.monotonic())}
+
+
+def extract_generated_json(text_response):
     """
+    Extração robusta do objeto JSON da resposta (com ou sem cercas de markdown). JSON truncado
+    ou malformado é consertado (json_repair.py), aproveitando os eventos completos; retorna o
+    JSON normalizado ou None se nada se aproveitar.
+    """
+    generated_text, report = repair_generation(text_response)
+    GENERATION_REPAIR_STATS.record(report)
+    if report["status"] == "repaired":
+        PAYLOAD_LOG.log(app.logger, "model_response_repaired", text_response, "Resposta do modelo consertada.",
+                        fixes=report["fixes"], dropped=report["dropped"], dropped_variants=report["dropped_variants"])
+    if generated_text is None:
+        # Nada aproveitável: registra a falha (com a resposta no buffer de payloads) e retorna None
+        PAYLOAD_LOG.log(app.logger, "model_response", text_response,
+                        "Nenhum JSON aproveitável (com ou sem markdown) encontrado na resposta.", level=logging.ERROR)
+    return generated_text
+
+
+def lookup_prompt_cache(prompt, generation_config, use_cache):
+    """(chave, resposta em cache ou None) para o prompt; sem use_cache, só conta o desvio."""
+    cache_key = prompt_cache_key(GEMINI_MODEL_NAME, prompt, generation_config)
+    if not use_cache:
+        PROMPT_CACHE.record_bypass()
+        return cache_key, None
+    cached = PROMPT_CACHE.get(cache_key)
+    if cached is not None:
+        app.logger.info(f"Prompt já respondido ({cache_key[:12]}); reaproveitando a resposta em cache.")
+    return cache_key, cached
+
+
+def generate_music_continuation_with_gemini(analysis_data, music_text_rh, music_text_lh, style_examples="", num_candidates=1, temperature=None, use_cache=True, client=None, deadline=None):
+    """
+    Gera a continuação da música usando o modelo generativo (prompt de build_generation_prompt).
+    'temperature' (opcional) sobrescreve a temperatura padrão do modelo.
+    Com use_cache, um prompt idêntico já respondido reaproveita a resposta (PROMPT_CACHE).
+    A chamada ao modelo passa pelo controle de admissão (GENERATION_ADMISSION) com o cliente e o
+    prazo (time.monotonic) dados; se não for admitida, levanta GenerationDeferred. Admitida, roda
+    com prazo e reserva (GENERATION_HEDGER); sem resposta a tempo, retorna None (fallback local).
+    Cada tentativa (inclusive a reserva) ocupa uma vaga da admissão até terminar de fato.
+    """
+    prompt = build_generation_prompt(analysis_data, music_text_rh, music_text_lh, style_examples, num_candidates)
+    generation_config = {"temperature": temperature} if temperature is not None else None
+    cache_key, cached = lookup_prompt_cache(prompt, generation_config, use_cache)
+    if cached is not None:
+        return cached
 
+    model = get_generative_model()
+    call_deadline = model_call_deadline(deadline)
+
+    def attempt():
+        response = model.generate_content(prompt, generation_config=generation_config,
+                                          request_options=model_request_options(call_deadline))
+        return extract_generated_json(response.text)
+
+    slot = GENERATION_ADMISSION.admit(client, deadline)
     try:
-        response = model.generate_content(prompt)
-        text_response = response.text
-        
-        # Extração robusta de JSON para lidar com markdown e texto conversacional.
-        # Primeiro, tenta encontrar um bloco JSON dentro de cercas de markdown
-        match = re.search(r'```json\s*(\{.*?\})\s*```', text_response, re.DOTALL)
-        if match:
-            return match.group(1) # Retorna apenas o conteúdo dentro das cercas
-
-        # Se não houver cercas de markdown, procura o primeiro objeto JSON bruto
-        match = re.search(r'\{.*\}', text_response, re.DOTALL)
-        if match:
-            return match.group(0)
-
-        # Se ainda assim não houver correspondência, registra a falha e retorna None
-        app.logger.error("Nenhum JSON válido (com ou sem markdown) encontrado na resposta.")
-        app.logger.error(f"Resposta recebida: {text_response}")
+        generated_text = GENERATION_HEDGER.call(attempt, call_deadline, slot, GENERATION_ADMISSION.try_admit)
+        if generated_text:
+            PROMPT_CACHE.put(cache_key, generated_text)
+        return generated_text
+
+    except CallDeadlineExceeded:
+        app.logger.warning("A API de geração não respondeu dentro do prazo.")
         return None
-        
     except Exception as e:
         app.logger.error(f"Erro ao chamar a API de geração: {e}")
         return None
 
+def get_markov_engine():
+    """Carrega o motor Markov local uma única vez; retorna None se ainda não foi treinado."""
+    global MARKOV_ENGINE
+    if MARKOV_ENGINE is None:
+        try:
+            MARKOV_ENGINE = MarkovContinuationEngine(MARKOV_MODEL_DIR)
+            app.logger.info(f"Motor Markov carregado: {len(MARKOV_ENGINE.tokens)} tokens.")
+        except FileNotFoundError:
+            app.logger.warning(f"Modelo Markov não encontrado em {MARKOV_MODEL_DIR}. Execute 'python markov.py train'.")
+            return None
+    return MARKOV_ENGINE
+
+
+def key_tonic_pitch_class(key_text):
+    """Classe de altura da tônica a partir do texto da análise (ex: 'F♯ Menor'); None se indefinida."""
+    try:
+        tonic_name = key_text.split()[0].replace('♯', '#').replace('♭', '-')
+        return corpus.pitch_number(tonic_name) % 12
+    except (AttributeError, IndexError, KeyError, ValueError):
+        return None
+
+
+def generate_music_continuation_locally(analysis_data, music_text_rh, music_text_lh, num_candidates=1, temperature=1.0):
+    """
+    Gera a continuação com o motor Markov local (sem rede), no mesmo formato JSON da resposta do Gemini
+    (com num_candidates > 1, {"variants": [...]} com amostras independentes).
+    Retorna None se o motor não estiver disponível.
+    """
+    engine = get_markov_engine()
+    if engine is None:
+        return None
+    try:
+        samples = [
+            engine.generate(
+                music_text_rh, music_text_lh,
+                last_offset=analysis_data.get('last_offset', 0.0),
+                temperature=temperature,
+                tonic=key_tonic_pitch_class(analysis_data.get('key')),
+            )
+            for _ in range(num_candidates)
+        ]
+        if num_candidates == 1:
+            return samples[0]
+        return json.dumps({"variants": [json.loads(sample) for sample in samples]})
+    except Exception as e:
+        app.logger.error(f"Erro na geração local (Markov): {e}")
+        return None
+
+
+def select_best_candidate(generated_text, analysis_data, music_text_rh, music_text_lh):
+    """
+    Pontua as variantes de uma resposta multi-candidato e retorna (JSON do melhor, pontuações,
+    JSON dos demais candidatos do melhor para o pior). Quem chama decide o que fazer com os demais.
+    """
+    variants = candidates.parse_candidates(generated_text)
+    if not variants:
+        return generated_text, None, []
+    reference = candidates.reference_profile(music_text_rh, music_text_lh)
+    tonic = key_tonic_pitch_class(analysis_data.get('key'))
+    if tonic is None:
+        tonic = corpus.dominant_pitch_class(reference["notes"])
+    minor = "Menor" in str(analysis_data.get('key', ''))
+
+    start = time.perf_counter()
+    order, scores = candidates.rank_candidates(variants, reference, analysis_data.get('last_offset', 0.0), tonic, minor)
+    app.logger.info(f"{len(variants)} candidatos pontuados em {(time.perf_counter() - start) * 1000:.1f} ms; "
+                    f"melhor: {scores[order[0]]['score']}")
+
+    for rank, i in enumerate(order):
+        scores[i]["rank"] = rank
+    return json.dumps(variants[order[0]]), scores, [json.dumps(variants[i]) for i in order[1:]]
+
+
 def text_to_midi_stream(text_data, original_bpm=120):
     """Converte a representação JSON de texto de volta para um stream do music21."""
     new_stream = stream.Part() # Gera uma stream 'Part' (Parte), não uma Stream geral
@@ -220,13 +459,225 @@ def text_to_midi_stream(text_data, original_bpm=120):
         return new_stream
     
     except json.JSONDecodeError as e:
-        app.logger.error(f"Erro de decodificação de JSON ao converter texto para stream MIDI: {e}")
-        app.logger.error(f"--- Resposta (JSON) que causou o erro\n{text_data}\n------------------------------------")
+        PAYLOAD_LOG.log(app.logger, "midi_json", text_data,
+                        f"Erro de decodificação de JSON ao converter texto para stream MIDI: {e}", level=logging.ERROR)
         return None # Crítico: retorna None em caso de falha
     except Exception as e:
         app.logger.error(f"Erro ao converter texto para stream MIDI: {e}")
         return None # Crítico: retorna None em caso de falha
 
+def write_continuation_midi(generated_text, bpm, continuation_filename):
+    """
+    Converte a resposta JSON ({"right_hand", "left_hand"}) num MIDI só da continuação,
+    gravado em static/generated/. Retorna o caminho relativo a static/.
+    """
+    generated_parts_json = json.loads(generated_text)
+    generated_text_rh = json.dumps(generated_parts_json.get("right_hand", []))
+    generated_text_lh = json.dumps(generated_parts_json.get("left_hand", []))
+
+    if not isinstance(bpm, (int, float)): bpm = 120
+    
+    # Cria duas streams separadas para as partes geradas
+    # text_to_midi_stream é robusto e retorna None em caso de falha de JSON
+    raw_generated_part_rh = text_to_midi_stream(generated_text_rh, bpm)
+    if raw_generated_part_rh is None:
+        app.logger.error("Falha ao converter RH text_to_midi_stream. Criando parte vazia.")
+        raw_generated_part_rh = stream.Part() # Cria uma parte vazia como fallback
+
+    raw_generated_part_lh = text_to_midi_stream(generated_text_lh, bpm)
+    if raw_generated_part_lh is None:
+        app.logger.error("Falha ao converter LH text_to_midi_stream. Criando parte vazia.")
+        raw_generated_part_lh = stream.Part() # Cria uma parte vazia como fallback
+
+    # Constrói o arquivo MIDI "somente da continuação"
+    continuation_stream = stream.Stream()
+    continuation_stream.insert(0, tempo.MetronomeMark(number=bpm)) # Adiciona o BPM
+
+    # Normaliza os offsets para começar do 0 para o player independente
+    first_offset_rh = raw_generated_part_rh.flatten().notesAndRests.first().offset if raw_generated_part_rh.flatten().notesAndRests else float('inf')
+    first_offset_lh = raw_generated_part_lh.flatten().notesAndRests.first().offset if raw_generated_part_lh.flatten().notesAndRests else float('inf')
+    min_first_offset = min(first_offset_rh, first_offset_lh)
+    
+    # Só faz o shift se houver notas e o offset não for infinito
+    if min_first_offset != float('inf') and min_first_offset > 0:
+        raw_generated_part_rh.shiftElements(-min_first_offset)
+        raw_generated_part_lh.shiftElements(-min_first_offset)
+    
+    # Insere as partes na stream de continuação
+    if list(raw_generated_part_rh.flatten().notesAndRests):
+        continuation_stream.insert(0, raw_generated_part_rh)
+    if list(raw_generated_part_lh.flatten().notesAndRests):
+        continuation_stream.insert(0, raw_generated_part_lh)
+    
+    # Salva o arquivo MIDI gerado
+    output_dir = os.path.join('static', 'generated')
+    os.makedirs(output_dir, exist_ok=True)
+    continuation_filepath = os.path.join(output_dir, continuation_filename)
+    continuation_stream.write('midi', fp=continuation_filepath)
+    return f'generated/{continuation_filename}'
+
+
+def generate_continuation(analysis_data, music_text_rh, music_text_lh, style_examples="", num_candidates=1, temperature=None, use_cache=True, client=None, deadline=None):
+    """
+    Gera com o backend configurado (Gemini com fallback local, ou só Markov). Retorna (texto JSON, origem).
+    use_cache=False ignora o cache de prompts e pede uma resposta nova ao Gemini.
+    GenerationDeferred (controle de admissão) não cai no fallback: a geração fica adiada.
+    """
+    if GENERATION_BACKEND == "markov":
+        generated_text = generate_music_continuation_locally(analysis_data, music_text_rh, music_text_lh, num_candidates, temperature or 1.0)
+        return generated_text, "markov"
+    generated_text = generate_music_continuation_with_gemini(analysis_data, music_text_rh, music_text_lh, style_examples, num_candidates, temperature, use_cache, client, deadline)
+    if generated_text:
+        return generated_text, REMOTE_GENERATION_SOURCE
+    # Fallback: API fora do ar ou resposta inválida -> motor local
+    app.logger.warning("Geração remota falhou. Usando o motor Markov local.")
+    generated_text = generate_music_continuation_locally(analysis_data, music_text_rh, music_text_lh, num_candidates, temperature or 1.0)
+    return generated_text, "markov"
+
+
+def run_generation_stage(analysis_data, music_text_rh, music_text_lh, num_candidates=1, use_cache=True, client=None, deadline=None):
+    """
+    Etapa de geração do pipeline de upload (roda numa thread de GENERATION_EXECUTOR):
+    recupera os exemplos de estilo e gera. Retorna (texto JSON, origem, exemplos de estilo).
+    Levanta GenerationDeferred se o controle de admissão adiar a geração.
+    """
+    style_examples = retrieve_style_examples(music_text_rh, music_text_lh) if GENERATION_BACKEND == "gemini" else ""
+    generated_text, generation_source = generate_continuation(
+        analysis_data, music_text_rh, music_text_lh, style_examples, num_candidates, use_cache=use_cache,
+        client=client, deadline=deadline
+    )
+    return generated_text, generation_source, style_examples
+
+
+def collect_generation(generation_future):
+    """Resultado da etapa de geração: (texto JSON, origem, exemplos de estilo, GenerationDeferred ou None)."""
+    try:
+        generated_text, generation_source, style_examples = generation_future.result()
+    except GenerationDeferred as e:
+        app.logger.warning(f"Geração adiada ({e.reason}); respondendo só com a análise.")
+        return None, None, "", e
+    return generated_text, generation_source, style_examples, None
+
+
+def produce_variation(context, temperature, generated_text=None):
+    """
+    Produz uma variação para o pool (em segundo plano): gera com a temperatura dada,
+    ou apenas renderiza um texto já gerado (candidatos do melhor de N).
+    Não usa o cache de prompts: as temperaturas se repetem e as variações devem ser novas.
+    """
+    generation_source = context["generation_source"]
+    if generated_text is None:
+        try:
+            generated_text, generation_source = generate_continuation(
+                context["analysis"], context["rh"], context["lh"], context["style_examples"], temperature=temperature,
+                use_cache=False, deadline=time.monotonic() + GENERATION_DEADLINE_SECONDS
+            )
+        except GenerationDeferred as e:
+            # Variação em segundo plano cede a vez aos uploads
+            app.logger.info(f"Variação adiada pelo controle de admissão ({e.reason}).")
+            return None
+        if not generated_text:
+            return None
+    variation_id = hashlib.md5(generated_text.encode('utf-8')).hexdigest()[:12]
+    midi_path = write_continuation_midi(
+        generated_text, context["analysis"].get('bpm', 120), f"variation_{context['file_hash']}_{variation_id}.mid"
+    )
+    return {"midi_path": midi_path, "temperature": temperature, "generation_source": generation_source}
+
+
+VARIATION_POOL = VariationPool(
+    produce_variation, pool_size=VARIATION_POOL_SIZE, max_per_file=VARIATION_MAX_PER_FILE,
+    max_per_user=VARIATION_MAX_PER_USER_HOUR, user_window=3600,
+)
+
+# Sessões de composição para extensões sucessivas sem reenvio (ver sessions.py)
+SESSION_STORE = SessionStore(
+    max_sessions=int(os.getenv("SESSION_MAX", "100")),
+    ttl_seconds=int(os.getenv("SESSION_TTL_SECONDS", str(6 * 3600))),
+)
+
+
+# Reanálise incremental de versões editadas: casa o upload com a versão anterior do mesmo
+# usuário (nome do arquivo ou sobreposição de compassos) e recalcula só os compassos alterados
+ANALYSIS_DIFF_ENABLED = os.getenv("ANALYSIS_DIFF_ENABLED", "1") == "1"
+ANALYSIS_VERSIONS = AnalysisVersions(
+    per_user=int(os.getenv("ANALYSIS_VERSIONS_PER_USER", "5")),
+    min_overlap=float(os.getenv("ANALYSIS_DIFF_MIN_OVERLAP", "0.5")),
+)
+
+
+def wants_fresh_output(params=None):
+    """Opção por requisição 'fresh=1' (formulário, JSON ou query string): ignora os caches e gera de novo."""
+    value = (params or {}).get('fresh') or request.form.get('fresh') or request.args.get('fresh')
+    return str(value).lower() in ("1", "true", "yes")
+
+
+# Pool de processos para a análise com music21 (ver analysis_pool.py): limites de tempo e memória
+# por tarefa e reciclagem dos processos. ANALYSIS_POOL_WORKERS=0 analisa na thread da requisição.
+ANALYSIS_POOL_WORKERS = int(os.getenv("ANALYSIS_POOL_WORKERS", "2"))
+ANALYSIS_POOL = AnalysisPool(
+    workers=ANALYSIS_POOL_WORKERS,
+    task_timeout=float(os.getenv("ANALYSIS_TASK_TIMEOUT_SECONDS", "60")),
+    max_rss_mb=int(os.getenv("ANALYSIS_MAX_RSS_MB", "1024")),
+    max_tasks_per_worker=int(os.getenv("ANALYSIS_MAX_TASKS_PER_WORKER", "50")),
+) if ANALYSIS_POOL_WORKERS > 0 else None
+
+# Orçamento de tempo da análise, em segundos desde o início (0 = sem limite): se o chordify da peça
+# inteira não couber, as características harmônicas vêm de até ANALYSIS_SAMPLE_BARS compassos
+# amostrados e a análise completa roda depois, em segundo plano (ver analysis_refinement.py)
+ANALYSIS_BUDGET_SECONDS = float(os.getenv("ANALYSIS_BUDGET_SECONDS", "10"))
+ANALYSIS_SAMPLE_BARS = int(os.getenv("ANALYSIS_SAMPLE_BARS", "32"))
+# A análise completa em segundo plano é justamente a dos arquivos lentos: tem o seu próprio limite de
+# tempo no pool, maior que o ANALYSIS_TASK_TIMEOUT_SECONDS dos uploads (passou dele, fica "failed")
+ANALYSIS_REFINE_TIMEOUT_SECONDS = float(os.getenv("ANALYSIS_REFINE_TIMEOUT_SECONDS", "600"))
+ANALYSIS_EVENTS_KEEPALIVE_SECONDS = 15
+
+
+def refine_upload_analysis(file_content):
+    """Análise completa, sem orçamento de tempo (no pool de processos, se houver, com ANALYSIS_REFINE_TIMEOUT_SECONDS)."""
+    if ANALYSIS_POOL is not None:
+        return ANALYSIS_POOL.run("refine", file_content, timeout=ANALYSIS_REFINE_TIMEOUT_SECONDS)
+    return refine_analysis_task(file_content)
+
+
+def apply_refined_analysis(analysis_data, refined):
+    """Substitui os campos aproximados de 'analysis_data' pelos da análise completa (no lugar)."""
+    approximate = analysis_data.pop("approximate", None)
+    if not approximate:
+        return analysis_data
+    for field in approximate["fields"]:
+        if field in refined:
+            analysis_data[field] = refined[field]
+    analysis_data["ai_analysis_text"] = refined.get("ai_analysis_text", analysis_data["ai_analysis_text"])
+    return analysis_data
+
+
+def update_cached_analysis(file_hash, refined):
+    """Refinamento pronto: a resposta em cache deixa de ser aproximada."""
+    cached_response = MIDI_GENERATION_CACHE.get(file_hash)
+    if cached_response is not None:
+        apply_refined_analysis(cached_response["analysis"], refined)
+        cached_response["refinement"] = None
+
+
+ANALYSIS_REFINEMENTS = AnalysisRefinements(
+    refine_upload_analysis, on_ready=update_cached_analysis,
+    max_entries=int(os.getenv("ANALYSIS_REFINEMENTS_MAX", "100")),
+)
+
+
+def client_identity(user_id_header, remote_addr):
+    """Identificação do cliente para os limites: o IP, ou o X-User-Id se TRUST_USER_ID_HEADER."""
+    if TRUST_USER_ID_HEADER and user_id_header:
+        return user_id_header
+    return remote_addr or "anonymous"
+
+
+def current_user_id():
+    """Identificação do usuário da requisição Flask (ver client_identity)."""
+    return client_identity(request.headers.get('X-User-Id'), request.remote_addr)
+
+
 def is_initial_midi_valid(file_stream):
     """Verifica se o stream do arquivo é um MIDI válido usando o Mido."""
     try:
@@ -250,270 +701,42 @@ def humanize_stream(music_stream):
         n.volume.velocity = max(0, min(127, new_velocity)) # Garante que fique entre 0 e 127
     return music_stream
 
-def analyze_midi_with_music21(file_path):
-    """
-    Função de análise de MIDI robusta, com tratamento de exceções 
-    e validação de sanidade para BPM, Compasso e Tonalidade.
-    """
-    results = {
-        "bpm": "N/A", "key": "N/A", "time_signature": "N/A", "num_bars": "N/A",
-        "melodic_range": "N/A", "chord_complexity": "N/A", "rhythmic_density": "N/A",
-        "form_structure": "Ainda não implementado", "harmonic_progression_preview": "N/A",
-        "rhythmic_pattern_summary": "N/A", "ai_analysis_text": "Aguardando dados da análise..."
-    }
-    s = None
-    
-    try:
-        s = converter.parse(file_path)
-        if not s:
-            results["ai_analysis_text"] = "Não foi possível carregar o arquivo com music21."
-            return results, s 
-        
-        # TRATAMENTO DE EXCEÇÃO: MIDI VAZIO (sem notas) 
-        if not s.flat.notesAndRests:
-            results["ai_analysis_text"] = "O arquivo MIDI foi carregado, mas não contém notas ou pausas."
-            return results, s
-
-        # TRATAMENTO DE EXCEÇÃO: BPM 
-        bpm_values = []
-        MIN_BPM = 30  # Limite mínimo razoável
-        MAX_BPM = 280 # Limite máximo razoável
-
-        for el in s.flat.getElementsByClass(tempo.MetronomeMark):
-            if MIN_BPM <= el.number <= MAX_BPM:
-                bpm_values.append(el.number)
-
-        if bpm_values:
-            # Usa a MEDIANA (resistente a outliers)
-            results["bpm"] = round(statistics.median(bpm_values))
-        else:
-            try:
-                # Tenta estimar o tempo se não houver marcação explícita
-                estimated_tempo = s.estimateTempo()
-                if estimated_tempo:
-                    # "Prende" (clamp) o valor estimado dentro dos limites
-                    results["bpm"] = round(max(MIN_BPM, min(MAX_BPM, estimated_tempo.number)))
-                else:
-                    results["bpm"] = 120 # Fallback
-            except Exception:
-                results["bpm"] = 120 # Fallback final
-        
-        # TRATAMENTO DE EXCEÇÃO: Compasso (Inferência e Fallback)
-        ts_obj = None
-        ts_search = s.flat.getElementsByClass(meter.TimeSignature)
-        suspicious_ts_flag = False
-        original_ts_str = ""
-        
-        if ts_search:
-            ts_obj = ts_search[0]
-        else:
-            try:
-                # 1. Tenta INFERIR o compasso
-                app.logger.info("Compasso não encontrado. Tentando inferir...")
-                ts_obj = meter.bestTimeSignature(s)
-                app.logger.info(f"Compasso inferido: {ts_obj.ratioString}")
-            except Exception as e:
-                # 2. Se a inferência falhar, usa um FALLBACK
-                app.logger.warning(f"Falha ao inferir compasso ({e}). Usando 4/4.")
-                ts_obj = meter.TimeSignature('4/4') # Padrão mais comum
-            
-           # 3. Insere o compasso (inferido ou padrão) na stream
-            s.insert(0, ts_obj)
-
-        # NOVO TRATAMENTO: Simplificação de Compasso (Ex: 12/16 -> 3/4) 
-        # Adicionado para tratar compassos com numeradores/denominadores > 8
-        try:
-            num = ts_obj.numerator
-            den = ts_obj.denominator
-            
-            # Se o numerador OU denominador for maior que 8, tenta simplificar
-            if num > 8 or den > 8:
-                common_divisor = math.gcd(num, den)
-                if common_divisor > 1:
-                    new_num = num // common_divisor
-                    new_den = den // common_divisor
-                    simplified_ts_str = f'{new_num}/{new_den}'
-                    app.logger.info(f"Simplificando compasso de {ts_obj.ratioString} para {simplified_ts_str}")
-                    ts_obj = meter.TimeSignature(simplified_ts_str)
-                    
-                    # Remove o compasso antigo e insere o novo simplificado
-                    s.removeByClass(meter.TimeSignature)
-                    s.insert(0, ts_obj)
-        except Exception as e:
-            app.logger.warning(f"Falha ao tentar simplificar o compasso: {e}")
-        # FIM DA SIMPLIFICAÇÃO
-
-
-        # NOVO TRATAMENTO: Compassos "Suspeitos" (1/4, 2/4)
-        original_ts_str = ts_obj.ratioString # Guarda o compasso original (ex: "3/4")
-
-        if original_ts_str in ['1/4', '2/4']:
-            app.logger.warning(f"Compasso musicalmente incomum detectado: {original_ts_str}. Usando 4/4 como padrão de análise.")
-            suspicious_ts_flag = True
-            ts_obj = meter.TimeSignature('4/4') # Define um padrão mais seguro
-            s.insert(0, ts_obj) # Sobrescreve o compasso na stream para os cálculos
-        
-        results["time_signature"] = ts_obj.ratioString # Armazena o compasso SEGURO (ex: 4/4)
-
-        # TRATAMENTO DE EXCEÇÃO: Tonalidade (Validação de Confiança)
-        key_obj = s.analyze('key')
-        
-        # Verifica se a análise de tonalidade é confiável
-        if key_obj and key_obj.correlationCoefficient > 0.70:
-            mode_pt = "Maior" if key_obj.mode == 'major' else "Menor" if key_obj.mode == 'minor' else key_obj.mode
-            results["key"] = f"{key_obj.tonic.name.replace('-', '♭').replace('#', '♯')} {mode_pt}"
-        else:
-            # Se a confiança for baixa (música atonal, curta, etc.), não afirma a tonalidade
-            results["key"] = "Indefinido"
-            key_obj = None # Anula para que a análise de Graus Romanos não seja usada
+def analysis_meta_key(meta):
+    """Andamentos e compassos do arquivo: só versões com a mesma grade de compassos são comparáveis."""
+    return (tuple((round(offset, 3), round(bpm, 2)) for offset, bpm in meta["tempos"]),
+            tuple(meta["time_signatures"]))
 
-        # INÍCIO DA ANÁLISE DETALHADA
 
-        if s.highestTime:
-            results["last_offset"] = float(s.highestTime) # Offset final da música
+def bar_length_from_meta(meta):
+    """Duração do compasso em quarterLength pelo primeiro compasso do arquivo (4/4 se não houver)."""
+    time_signatures = meta["time_signatures"]
+    numerator, denominator = (time_signatures[0][1], time_signatures[0][2]) if time_signatures else (4, 4)
+    return numerator * 4.0 / denominator
 
-        chord_stream_list = list(s.chordify().flat.getElementsByClass(chord.Chord))
-        last_chord = chord_stream_list[-1] if chord_stream_list else None
-        
-        if last_chord:
-            # Só tenta análise de Graus Romanos se a tonalidade for confiável
-            if key_obj:
-                try:
-                    rn = roman.romanNumeralFromChord(last_chord, key_obj)
-                    results["final_chord_analysis"] = f"A música termina em um acorde {last_chord.pitchedCommonName}, que funciona como um grau {rn.figure}."
-                except Exception:
-                    results["final_chord_analysis"] = f"A música termina no acorde {last_chord.pitchedCommonName}."
-            else:
-                results["final_chord_analysis"] = f"A música termina no acorde {last_chord.pitchedCommonName}."
-            
-            last_melodic_note = last_chord.pitches[-1] # Nota mais aguda do último acorde
-            if key_obj:
-                scale_degree = key_obj.getScaleDegreeFromPitch(last_melodic_note)
-                degree_names = ["Tônica", "Supertônica", "Mediante", "Subdominante", "Dominante", "Superdominante", "Sensível"]
-                if scale_degree and 1 <= scale_degree <= 7:
-                    degree_name = degree_names[scale_degree-1]
-                    results["final_melody_analysis"] = f"A melodia termina na nota {last_melodic_note.name} ({degree_name})."
-                else:
-                    results["final_melody_analysis"] = f"A melodia termina na nota {last_melodic_note.name}."
-        
-        # Cálculo de número de compassos
-        last_measure_number = 0
-        for p in s.parts:
-            measures_in_part = p.getElementsByClass(stream.Measure)
-            if measures_in_part:
-                m_numbers = [m.number for m in measures_in_part if m.number is not None]
-                if m_numbers:
-                    last_measure_number = max(last_measure_number, max(m_numbers))
-                elif measures_in_part:
-                    # Fallback para partes sem números de compasso explícitos
-                    last_measure_number = max(last_measure_number, len(measures_in_part))
-        
-        if last_measure_number > 0:
-            results["num_bars"] = last_measure_number
-        elif s.highestTime and ts_obj: # Fallback
-            try:
-                measure_duration_ql = ts_obj.barDuration.quarterLength
-                if measure_duration_ql > 0:
-                    results["num_bars"] = int(round(s.highestTime / measure_duration_ql))
-            except Exception:
-                pass # num_bars permanece "N/A"
-
-        # Análise da extensão melódica
-        all_pitches = s.flat.pitches
-        if all_pitches:
-            min_pitch_val = min(p.ps for p in all_pitches)
-            max_pitch_val = max(p.ps for p in all_pitches)
-            octave_span = (max_pitch_val - min_pitch_val) / 12.0
-            if octave_span < 1.5: results["melodic_range"] = "1-2 Oitavas"
-            elif octave_span < 3: results["melodic_range"] = "2-3 Oitavas"
-            else: results["melodic_range"] = f"~ {round(octave_span)} Oitavas"
-        
-        # Análise de complexidade harmônica
-        if chord_stream_list:
-            chord_qualities = list(set(c.quality for c in chord_stream_list))
-            if len(chord_qualities) <= 2: results["chord_complexity"] = "Simples"
-            elif len(chord_qualities) <= 4: results["chord_complexity"] = "Moderada"
-            else: results["chord_complexity"] = "Complexa"
-            
-            
-            prog_preview_roman = []
-            
-            
-            distinct_chords_for_preview = []
-            seen_chord_names = set() # Usamos um set para rastrear nomes (ex: "C major triad")
-
-            for ch in chord_stream_list:
-                if len(distinct_chords_for_preview) >= 4:
-                    break # Já temos 4 acordes para a prévia
-
-                current_chord_name = ch.pitchedCommonName
-                if current_chord_name not in seen_chord_names:
-                    # Se for um nome de acorde que ainda não vimos, adiciona
-                    distinct_chords_for_preview.append(ch)
-                    seen_chord_names.add(current_chord_name)
-            
-
-            for ch_preview in distinct_chords_for_preview:
-                if key_obj:
-                    try:
-                        # Tenta obter o grau romano
-                        rn = roman.romanNumeralFromChord(ch_preview, key_obj)
-                        prog_preview_roman.append(rn.figure)
-                    except Exception:
-                        prog_preview_roman.append(ch_preview.pitchedCommonName.replace('-', '♭').replace('#', '♯'))
-                else:
-                    # Se a tonalidade é indefinida, usa o nome do acorde
-                    prog_preview_roman.append(ch_preview.pitchedCommonName.replace('-', '♭').replace('#', '♯'))
-            
-            if prog_preview_roman:
-                results["harmonic_progression_preview"] = " -> ".join(prog_preview_roman)
-
-        # Análise de densidade rítmica
-        notes_and_rests_count = len(s.flat.notesAndRests)
-        num_bars_for_density = results["num_bars"]
-        if isinstance(num_bars_for_density, int) and num_bars_for_density > 0:
-            elements_per_measure = notes_and_rests_count / num_bars_for_density
-            if elements_per_measure < 8: results["rhythmic_density"] = "Baixa"
-            elif elements_per_measure < 20: results["rhythmic_density"] = "Média"
-            else: results["rhythmic_density"] = "Alta"
-        
-        # Análise de padrões rítmicos (duração mais comum)
-        note_durations_ql = [n.duration.quarterLength for n in s.flat.notes]
-        if note_durations_ql:
-            common_durations = Counter(note_durations_ql).most_common(1)
-            if common_durations:
-                most_common_ql = common_durations[0][0]
-                try:
-                    d_obj = m21duration.Duration(most_common_ql)
-                    results["rhythmic_pattern_summary"] = f"Predominância de {d_obj.type}s"
-                except Exception:
-                    results["rhythmic_pattern_summary"] = f"Duração QL: {most_common_ql}"
-
-        # Geração do texto de análise
-        analysis_parts = []
-        if results["key"] != "N/A": analysis_parts.append(f"A tonalidade principal parece ser {results['key']}.")
-        if results["bpm"] != "N/A": analysis_parts.append(f"O andamento médio é de aproximadamente {results['bpm']} BPM.")
-        if suspicious_ts_flag:
-            # Caso o compasso seja muito distoante e sem sentido
-            analysis_parts.append(f"Detectado compasso de {original_ts_str}. A estrutura rítmica é provavelmente 3/4 ou 4/4.")
-        elif results["time_signature"] != "N/A":
-            # Caso contrário, usa o compasso normal
-            analysis_parts.append(f"Utiliza um compasso de {results['time_signature']}.")
-        if results["harmonic_progression_preview"] != "N/A" and results["harmonic_progression_preview"]: analysis_parts.append(f"A progressão harmônica inicial observada é: {results['harmonic_progression_preview']}.")
-        if results["rhythmic_pattern_summary"] != "N/A": analysis_parts.append(f"{results['rhythmic_pattern_summary']}.")
-        if results["melodic_range"] != "N/A": analysis_parts.append(f"A melodia se estende por {results['melodic_range'].lower()}.")
-        if analysis_parts:
-            results["ai_analysis_text"] = " ".join(analysis_parts)
-        else:
-            results["ai_analysis_text"] = "Não foi possível extrair informações detalhadas."
-    
-        # FIM DA ANÁLISE DETALHADA
 
-    except Exception as e:
-        app.logger.error(f"Erro na análise com music21: {e}")
-        results["ai_analysis_text"] = f"Erro ao processar o arquivo MIDI: {str(e)}"
-    
-    return results, s
+def incremental_analysis(previous, notes):
+    """
+    Análise de uma versão editada a partir da anterior, sem music21: recalcula só os
+    compassos e janelas alterados (ver bar_analysis.py). Um campo só troca o valor da
+    análise anterior quando o valor derivado dos compassos mudou entre as versões. Os campos
+    que os compassos só estimam (ESTIMATED_FIELDS) mantêm o valor anterior e ficam em
+    results["approximate"], para o refinamento em segundo plano recalcular com o music21.
+    Retorna (resultados, BarAnalysis nova, resumo do diff).
+    """
+    bars, diff = previous["bars"].updated(notes)
+    derived = bars.derived()
+    results = copy.deepcopy(previous["results"])
+    changed_fields = [field for field in DERIVED_FIELDS if derived.get(field, "N/A") != previous["derived"].get(field, "N/A")]
+    for field in changed_fields:
+        results[field] = derived.get(field, "N/A")
+    stale_fields = [field for field in ESTIMATED_FIELDS if derived.get(field, "N/A") != previous["derived"].get(field, "N/A")]
+    if stale_fields:
+        approximate = results.setdefault("approximate", {"fields": []})
+        approximate["fields"] = list(dict.fromkeys(approximate["fields"] + stale_fields))
+        approximate["incremental"] = True
+    build_analysis_text(results, previous["suspicious_ts_flag"], previous["original_ts_str"])
+    results["incremental"] = dict(diff, base_file_hash=previous["file_hash"], recomputed_fields=changed_fields)
+    return results, bars, diff
 
 
 @app.route('/')
@@ -534,7 +757,299 @@ def home():
     return render_template('index.html', page_data=page_data, analysis_results=analysis_results_data,
         ai_analysis=ai_analysis_text, composition_stats=composition_stats_data)
 
+def degraded_analysis(notes, midi_meta, reason, results=None):
+    """
+    Análise degradada a partir da tabela de notas (sem music21), quando a tarefa do pool é
+    interrompida: completa 'results' (ou os campos padrão) com os valores por compasso de
+    bar_analysis.py, sem sobrescrever o que a etapa 1 já calculou. Retorna (resultados, BarAnalysis).
+    """
+    results = results if results is not None else empty_analysis_results()
+    bars = BarAnalysis.build(notes, bar_length_from_meta(midi_meta))
+    for field, value in bars.derived().items():
+        if results.get(field, "N/A") == "N/A":
+            results[field] = value
+    if results["bpm"] == "N/A":
+        bpms = [bpm for _, bpm in midi_meta["tempos"] if 30 <= bpm <= 280]
+        results["bpm"] = round(statistics.median(bpms)) if bpms else 120
+    if results["time_signature"] == "N/A":
+        time_signatures = midi_meta["time_signatures"]
+        results["time_signature"] = f"{time_signatures[0][1]}/{time_signatures[0][2]}" if time_signatures else "4/4"
+    build_analysis_text(results)
+    results["analysis_degraded"] = reason
+    return results, bars
+
+
+def upload_cache_key(file_content):
+    """
+    Chave de cache do upload: impressão digital canônica do conteúdo musical (ver
+    corpus.canonical_fingerprint), igual para o mesmo MIDI reexportado; o MD5 dos bytes
+    fica como fallback. Retorna (chave, notas, meta); notas e meta são None se o Mido falhar.
+    """
+    try:
+        notes, midi_meta = corpus.extract_notes(file_content)
+    except Exception as e:
+        app.logger.warning(f"Falha ao extrair as notas com o Mido ({e}); usando o MD5 do arquivo como chave.")
+        return hashlib.md5(file_content).hexdigest(), None, None
+    if len(notes):
+        return corpus.canonical_fingerprint(notes, midi_meta), notes, midi_meta
+    return hashlib.md5(file_content).hexdigest(), notes, midi_meta
+
+
+def prepare_upload(file_content, filename, user_id, file_hash, notes, midi_meta, profile=None):
+    """
+    Etapa 1 do pipeline de upload (sem dependência do Flask, usada também por asgi_app.py):
+    reanálise incremental de uma versão editada, ou a análise do prompt com music21.
+    Retorna o 'job' do upload: analysis_data, textos das mãos e o estado da etapa 2.
+    Se a análise falhar, job["error"] traz a mensagem. Com 'profile' (RequestProfile), a
+    análise no pool de processos também é perfilada.
+    """
+    job = {"file_hash": file_hash, "filename": filename, "user_id": user_id, "file_content": file_content,
+           "profile": profile,
+           "notes": notes, "midi_meta": midi_meta,
+           "meta_key": None, "previous_version": None, "analysis_state": None, "original_stream": None,
+           "bar_analysis": None, "error": None, "started": time.perf_counter(),
+           "deadline": time.monotonic() + GENERATION_DEADLINE_SECONDS}
+
+    # Versão editada de um upload anterior? Então só os compassos alterados são reanalisados
+    if ANALYSIS_DIFF_ENABLED and notes is not None and len(notes):
+        job["meta_key"] = analysis_meta_key(midi_meta)
+        job["previous_version"] = ANALYSIS_VERSIONS.match(user_id, filename, notes, job["meta_key"])
+
+    previous_version = job["previous_version"]
+    if previous_version is not None:
+        job["analysis"], job["bar_analysis"], diff = incremental_analysis(previous_version, notes)
+        app.logger.info(f"Reanálise incremental sobre {previous_version['file_hash']}: "
+                        f"{diff['changed_bars']} de {diff['total_bars']} compassos recalculados.")
+        rh_notes, lh_notes = corpus.split_hands(notes)
+        job["rh"] = json.dumps(corpus.notes_to_events(rh_notes, 64), indent=2)
+        job["lh"] = json.dumps(corpus.notes_to_events(lh_notes, 64), indent=2)
+        job["suspicious_ts_flag"] = previous_version["suspicious_ts_flag"]
+        job["original_ts_str"] = previous_version["original_ts_str"]
+        if job["analysis"].get("approximate"):
+            ANALYSIS_REFINEMENTS.schedule(file_hash, file_content)
+        return job
+
+    if ANALYSIS_POOL is not None:
+        return prepare_upload_in_pool(job, file_content)
+
+    # Salva o conteúdo em um arquivo temporário para análise
+    temp_file_path = None
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.mid') as tmp:
+            tmp.write(file_content)
+            temp_file_path = tmp.name
+
+        # CHAMADA DA FUNÇÃO ROBUSTA (etapa 1: só o que o prompt precisa)
+        # Esta função trata compasso, bpm, tonalidade, etc.
+        analysis_data, original_stream, analysis_state = analyze_prompt_features(temp_file_path)
+    finally:
+        # Garante que o arquivo temporário seja excluído
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+    job["analysis"] = analysis_data
+
+    # TRATAMENTO DE EXCEÇÃO: Verifica se a análise teve sucesso
+    if not original_stream or not original_stream.flat.notesAndRests:
+        job["error"] = "Falha ao analisar o arquivo ou arquivo está vazio."
+        return job
+
+    # Separa as partes e converte para texto (JSON)
+    rh_part_orig, lh_part_orig = separate_piano_parts(original_stream)
+    job["rh"] = midi_stream_to_text(rh_part_orig)
+    job["lh"] = midi_stream_to_text(lh_part_orig)
+    job["original_stream"], job["analysis_state"] = original_stream, analysis_state
+    job["suspicious_ts_flag"] = bool(analysis_state and analysis_state["suspicious_ts_flag"])
+    job["original_ts_str"] = analysis_state["original_ts_str"] if analysis_state else ""
+    return job
+
+
+def prepare_upload_in_pool(job, file_content):
+    """
+    Etapa 1 num processo do pool de análise: a thread da requisição só espera o resultado
+    parcial. Se a tarefa for interrompida antes dele, usa a análise degradada da tabela de notas.
+    """
+    try:
+        profile = job["profile"]
+        task = ANALYSIS_POOL.submit("upload", file_content, ANALYSIS_BUDGET_SECONDS, ANALYSIS_SAMPLE_BARS,
+                                    profile=profile.worker_options() if profile is not None else None)
+        stage1 = task.partial()
+    except AnalysisAborted as e:
+        app.logger.warning(f"Análise do upload interrompida na etapa 1: {e.reason}")
+        notes = job["notes"]
+        if notes is None or not len(notes):
+            job["analysis"], job["error"] = empty_analysis_results(), e.reason
+            return job
+        job["analysis"], job["bar_analysis"] = degraded_analysis(notes, job["midi_meta"], e.reason)
+        rh_notes, lh_notes = corpus.split_hands(notes)
+        job["rh"] = json.dumps(corpus.notes_to_events(rh_notes, 64), indent=2)
+        job["lh"] = json.dumps(corpus.notes_to_events(lh_notes, 64), indent=2)
+        job["suspicious_ts_flag"], job["original_ts_str"] = False, ""
+        return job
+
+    if stage1 is None:
+        # Terminou sem a etapa 1: arquivo vazio ou ilegível para o music21
+        final = task.result()
+        job["analysis"], job["error"] = final["analysis"], final["error"]
+        return job
+    job["analysis"], job["rh"], job["lh"] = stage1["analysis"], stage1["rh"], stage1["lh"]
+    job["suspicious_ts_flag"], job["original_ts_str"] = stage1["suspicious_ts_flag"], stage1["original_ts_str"]
+    job["analysis_task"] = task
+    return job
+
+
+def finish_upload_analysis(job):
+    """
+    Etapa 2 do pipeline de upload (em paralelo com a geração): análise detalhada com
+    music21 e registro da versão para a reanálise incremental dos próximos reenvios.
+    """
+    analysis_data, notes = job["analysis"], job["notes"]
+    if job["analysis_state"] is not None:
+        analyze_detailed_features(job["original_stream"], analysis_data, job["analysis_state"],
+                                  ANALYSIS_BUDGET_SECONDS, ANALYSIS_SAMPLE_BARS)
+    elif job.get("analysis_task") is not None:
+        try:
+            analysis_data.update(job["analysis_task"].result()["analysis"])
+            if job["profile"] is not None:
+                job["profile"].add_worker_profile(job["analysis_task"].profile)
+        except AnalysisAborted as e:
+            # Etapa 2 interrompida: mantém a etapa 1 e completa com os valores por compasso
+            app.logger.warning(f"Análise detalhada interrompida: {e.reason}")
+            if notes is not None and len(notes):
+                _, job["bar_analysis"] = degraded_analysis(notes, job["midi_meta"], e.reason, analysis_data)
+            else:
+                analysis_data["analysis_degraded"] = e.reason
+            build_analysis_text(analysis_data, job["suspicious_ts_flag"], job["original_ts_str"])
+    if analysis_data.get("approximate"):
+        # Orçamento de tempo estourado: a análise completa roda em segundo plano
+        ANALYSIS_REFINEMENTS.schedule(job["file_hash"], job["file_content"])
+    if ANALYSIS_DIFF_ENABLED and notes is not None and len(notes):
+        bar_analysis = job["bar_analysis"]
+        if bar_analysis is None:
+            # Primeira versão: guarda as características por compasso para os próximos reenvios
+            bar_analysis = BarAnalysis.build(notes, bar_length_from_meta(job["midi_meta"]))
+        bar_derived = bar_analysis.derived()
+        analysis_data["key_changes"] = bar_derived["key_changes"]
+        ANALYSIS_VERSIONS.add(job["user_id"], job["filename"], {
+            "file_hash": job["file_hash"], "meta_key": job["meta_key"], "bars": bar_analysis,
+            "derived": bar_derived, "results": copy.deepcopy(analysis_data),
+            "suspicious_ts_flag": job["suspicious_ts_flag"], "original_ts_str": job["original_ts_str"],
+        })
+    return analysis_data
+
+
+def build_upload_response(job, generated_text, generation_source, style_examples, num_candidates, url_builder, deferred=None):
+    """
+    Etapa final do pipeline de upload: melhor de N, MIDI da continuação, pool de variações
+    e cache. 'url_builder(endpoint, **valores)' monta as URLs (url_for no Flask).
+    Com 'deferred' (GenerationDeferred), a resposta traz só a análise e a geração adiada.
+    Retorna o dict da resposta.
+    """
+    file_hash, analysis_data = job["file_hash"], job["analysis"]
+
+    # Melhor de N: pontua as variantes e guarda as demais
+    candidate_scores, runner_ups = None, []
+    if generated_text and num_candidates > 1:
+        generated_text, candidate_scores, runner_ups = select_best_candidate(
+            generated_text, analysis_data, job["rh"], job["lh"]
+        )
+
+    generated_midi_url = None
+    if generated_text:
+        PAYLOAD_LOG.log(app.logger, "generated_json", generated_text, "Convertendo o JSON gerado em MIDI.", file_hash=file_hash)
+        continuation_path = write_continuation_midi(generated_text, analysis_data.get('bpm', 120), f"continuation_{file_hash}.mid")
+        generated_midi_url = url_builder('static', filename=continuation_path)
+
+        # Começa a pré-gerar variações; candidatos não escolhidos entram primeiro, sem custo
+        VARIATION_POOL.register(file_hash, {
+            "file_hash": file_hash, "analysis": analysis_data, "rh": job["rh"], "lh": job["lh"],
+            "style_examples": style_examples, "generation_source": generation_source,
+        }, job["user_id"], seed_texts=runner_ups)
+
+    # Prepara a resposta final
+    final_response = {
+        "status": "success", "filename": job["filename"], "message": "Análise e geração concluídas.",
+        "analysis": analysis_data, "generated_midi_url": generated_midi_url,
+        "generation_source": generation_source if generated_text else None,
+        "candidates": candidate_scores,
+        "file_hash": file_hash,
+        "variations_url": url_builder('next_variation', file_hash=file_hash) if generated_text else None,
+        "refinement": None,
+        "generation_status": "done" if generated_text else ("deferred" if deferred else "failed"),
+        "generation_deferred": None
+    }
+    if deferred is not None:
+        final_response["message"] = "Análise concluída; geração adiada. Tente novamente em instantes."
+        final_response["generation_deferred"] = {"reason": deferred.reason, "retry_after": math.ceil(deferred.retry_after)}
+    if analysis_data.get("approximate"):
+        # Análise aproximada: o cliente busca os valores refinados ou espera o evento SSE
+        final_response["refinement"] = {
+            "status": "pending", "url": url_builder('refined_analysis', file_hash=file_hash),
+            "events_url": url_builder('analysis_events', file_hash=file_hash),
+        }
+    # Armazena a resposta no cache (a não ser que a análise tenha sido degradada ou a geração adiada)
+    if not analysis_data.get("analysis_degraded") and deferred is None:
+        MIDI_GENERATION_CACHE[file_hash] = final_response
+    refinement = ANALYSIS_REFINEMENTS.get(file_hash) if final_response["refinement"] else None
+    if refinement is not None and refinement["status"] == "ready":
+        # O refinamento terminou antes da resposta
+        apply_refined_analysis(analysis_data, refinement["analysis"])
+        final_response["refinement"] = None
+    return final_response
+
+
+def parse_num_candidates(value):
+    """Quantos candidatos gerar nesta chamada (1 = comportamento tradicional), limitado a GENERATION_MAX_CANDIDATES."""
+    try:
+        num_candidates = int(value if value is not None else GENERATION_CANDIDATES)
+    except ValueError:
+        num_candidates = GENERATION_CANDIDATES
+    return max(1, min(GENERATION_MAX_CANDIDATES, num_candidates))
+
+
+def debug_access_allowed():
+    """Acesso de depuração: modo debug ou o cabeçalho X-Debug-Token igual a DEBUG_PAYLOADS_TOKEN."""
+    return app.debug or bool(DEBUG_PAYLOADS_TOKEN and request.headers.get('X-Debug-Token') == DEBUG_PAYLOADS_TOKEN)
+
+
+def start_request_profile():
+    """RequestProfile para esta requisição (cabeçalho X-Profile ou amostragem), ou None."""
+    mode = (request.headers.get('X-Profile') or "").lower()
+    if mode and debug_access_allowed():
+        mode = mode if mode in PROFILE_MODES else PROFILING["mode"]
+    elif PROFILING["sample_rate"] > 0 and random.random() < PROFILING["sample_rate"]:
+        mode = PROFILING["mode"]
+    else:
+        return None
+    return RequestProfile(mode, PROFILE_INTERVAL_SECONDS)
+
+
+def profiled(view):
+    """
+    Profiling opcional da rota: sem perfil para a requisição, só chama a view. Com perfil, a
+    view o encontra em g.profile; ao final os arquivos vão para PROFILE_DIR e o id para o
+    cabeçalho X-Profile-Id da resposta.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        profile = start_request_profile()
+        if profile is None:
+            return view(*args, **kwargs)
+        g.profile = profile
+        try:
+            with profile.track("request"):
+                response = app.make_response(view(*args, **kwargs))
+        finally:
+            summary = profile.finish(PROFILE_DIR)
+            prune_profiles(PROFILE_DIR, PROFILE_KEEP)
+            app.logger.info(f"Perfil {summary['id']} gravado ({summary['total_ms']:.0f} ms).",
+                            extra={"structured": {"event": "profile", **summary}})
+        response.headers["X-Profile-Id"] = profile.id
+        return response
+    return wrapper
+
+
 @app.route('/upload_midi', methods=['POST'])
+@profiled
 def upload_midi_file():
     """Rota para upload, análise e geração de continuação do MIDI."""
     
@@ -549,120 +1064,503 @@ def upload_midi_file():
         if not is_initial_midi_valid(file.stream):
              return jsonify({"status": "error", "filename": file.filename, "message": "Arquivo não parece ser um MIDI válido."}), 400
 
-        temp_file_path = None
+        generated_text = None
+        profile = g.get("profile")
         try:
             file.stream.seek(0)
             file_content = file.stream.read()
-            # Cria um hash do conteúdo do arquivo para usar como chave de cache
-            file_hash = hashlib.md5(file_content).hexdigest()
-
-            # Verifica se o resultado já está no cache
-            if file_hash in MIDI_GENERATION_CACHE:
+            with profile_stage(profile, "cache_key"):
+                file_hash, notes, midi_meta = upload_cache_key(file_content)
+            if profile is not None:
+                profile.tags.update(file_hash=file_hash, filename=file.filename)
+
+            # Verifica se o resultado já está no cache ('fresh=1' força uma nova geração)
+            fresh = wants_fresh_output()
+            if file_hash in MIDI_GENERATION_CACHE and not fresh:
                 cached_response = MIDI_GENERATION_CACHE[file_hash]
                 cached_response['filename'] = file.filename
                 return jsonify(cached_response)
 
-            # Salva o conteúdo em um arquivo temporário para análise
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mid') as tmp:
-                tmp.write(file_content)
-                temp_file_path = tmp.name
-            
-            # CHAMADA DA FUNÇÃO ROBUSTA
-            # Esta função trata compasso, bpm, tonalidade, etc.
-            analysis_data, original_stream = analyze_midi_with_music21(temp_file_path)
-            
-            # TRATAMENTO DE EXCEÇÃO: Verifica se a análise teve sucesso
-            if not original_stream or not original_stream.flat.notesAndRests:
-                return jsonify({"status": "error", "message": "Falha ao analisar o arquivo ou arquivo está vazio.", "analysis": analysis_data}), 500
-
-            # Separa as partes e converte para texto (JSON)
-            rh_part_orig, lh_part_orig = separate_piano_parts(original_stream)
-            music_as_text_rh = midi_stream_to_text(rh_part_orig)
-            music_as_text_lh = midi_stream_to_text(lh_part_orig)
-
-            # Gera a continuação
-            generated_text = generate_music_continuation_with_gemini(analysis_data, music_as_text_rh, music_as_text_lh)
-            
-            generated_midi_url = None
-            combined_midi_url = None # Esta variável não está sendo usada, mas foi mantida
-
-            if generated_text:
-                app.logger.info(f"--- Tentando decodificar o seguinte JSON\n{generated_text}\n------------------------------------")
-                generated_parts_json = json.loads(generated_text)
-                generated_text_rh = json.dumps(generated_parts_json.get("right_hand", []))
-                generated_text_lh = json.dumps(generated_parts_json.get("left_hand", []))
-
-                bpm = analysis_data.get('bpm', 120)
-                if not isinstance(bpm, (int, float)): bpm = 120
-                
-                # Cria duas streams separadas para as partes geradas
-                # text_to_midi_stream é robusto e retorna None em caso de falha de JSON
-                raw_generated_part_rh = text_to_midi_stream(generated_text_rh, bpm)
-                if raw_generated_part_rh is None:
-                    app.logger.error("Falha ao converter RH text_to_midi_stream. Criando parte vazia.")
-                    raw_generated_part_rh = stream.Part() # Cria uma parte vazia como fallback
-
-                raw_generated_part_lh = text_to_midi_stream(generated_text_lh, bpm)
-                if raw_generated_part_lh is None:
-                    app.logger.error("Falha ao converter LH text_to_midi_stream. Criando parte vazia.")
-                    raw_generated_part_lh = stream.Part() # Cria uma parte vazia como fallback
-
-                # Constrói o arquivo MIDI "somente da continuação"
-                continuation_stream = stream.Stream()
-                continuation_stream.insert(0, tempo.MetronomeMark(number=bpm)) # Adiciona o BPM
-
-                # Normaliza os offsets para começar do 0 para o player independente
-                first_offset_rh = raw_generated_part_rh.flatten().notesAndRests.first().offset if raw_generated_part_rh.flatten().notesAndRests else float('inf')
-                first_offset_lh = raw_generated_part_lh.flatten().notesAndRests.first().offset if raw_generated_part_lh.flatten().notesAndRests else float('inf')
-                min_first_offset = min(first_offset_rh, first_offset_lh)
-                
-                # Só faz o shift se houver notas e o offset não for infinito
-                if min_first_offset != float('inf') and min_first_offset > 0:
-                    raw_generated_part_rh.shiftElements(-min_first_offset)
-                    raw_generated_part_lh.shiftElements(-min_first_offset)
-                
-                # Insere as partes na stream de continuação
-                if list(raw_generated_part_rh.flatten().notesAndRests):
-                    continuation_stream.insert(0, raw_generated_part_rh)
-                if list(raw_generated_part_lh.flatten().notesAndRests):
-                    continuation_stream.insert(0, raw_generated_part_lh)
-                
-                # Salva o arquivo MIDI gerado
-                output_dir = os.path.join('static', 'generated')
-                os.makedirs(output_dir, exist_ok=True)
-                continuation_filename = f"continuation_{file_hash}.mid"
-                continuation_filepath = os.path.join(output_dir, continuation_filename)
-                continuation_stream.write('midi', fp=continuation_filepath)
-                generated_midi_url = url_for('static', filename=f'generated/{continuation_filename}')
-
-            # Prepara a resposta final
-            final_response = {
-                "status": "success", "filename": file.filename, "message": "Análise e geração concluídas.",
-                "analysis": analysis_data, "generated_midi_url": generated_midi_url
-            }
-            # Armazena a resposta no cache
-            MIDI_GENERATION_CACHE[file_hash] = final_response
-            return jsonify(final_response), 200
+            with profile_stage(profile, "analysis_stage1"):
+                job = prepare_upload(file_content, file.filename, current_user_id(), file_hash, notes, midi_meta, profile)
+            if job["error"]:
+                return jsonify({"status": "error", "message": job["error"], "analysis": job["analysis"]}), 500
+            num_candidates = parse_num_candidates(request.form.get('candidates'))
+
+            # Gera a continuação em paralelo com o resto da análise (etapa 2).
+            # A geração recebe uma cópia: a etapa 2 continua preenchendo analysis_data.
+            app.logger.info(f"Etapa 1 da análise em {(time.perf_counter() - job['started']) * 1000:.0f} ms; iniciando a geração.")
+            generation_stage = run_generation_stage if profile is None else profile.wrap(run_generation_stage, "generation")
+            generation_future = GENERATION_EXECUTOR.submit(
+                generation_stage, dict(job["analysis"]), job["rh"], job["lh"], num_candidates, not fresh,
+                job["user_id"], job["deadline"]
+            )
+            with profile_stage(profile, "analysis_stage2"):
+                finish_upload_analysis(job)
+            app.logger.info(f"Análise completa em {(time.perf_counter() - job['started']) * 1000:.0f} ms; aguardando a geração.")
+            with profile_stage(profile, "generation_wait"):
+                generated_text, generation_source, style_examples, deferred = collect_generation(generation_future)
+            app.logger.info(f"Pipeline concluído em {(time.perf_counter() - job['started']) * 1000:.0f} ms.")
+
+            with profile_stage(profile, "response"):
+                final_response = build_upload_response(job, generated_text, generation_source, style_examples, num_candidates,
+                                                       url_for, deferred)
+            response = jsonify(final_response)
+            if deferred is not None:
+                response.headers["Retry-After"] = str(final_response["generation_deferred"]["retry_after"])
+            return response, 200
 
         except json.JSONDecodeError as e:
-            app.logger.error(f"Erro Crítico de Decodificação de JSON: {e}")
-            app.logger.error(f"Resposta (JSON) que causou o erro: {generated_text}")
+            PAYLOAD_LOG.log(app.logger, "generated_json", generated_text, f"Erro Crítico de Decodificação de JSON: {e}",
+                            level=logging.ERROR)
             return jsonify({"status": "error", "filename": file.filename, "message": f"Erro ao ler a resposta da geração: {str(e)}"}), 500
         except Exception as e:
             app.logger.error(f"Erro geral no upload ou análise: {e}", exc_info=True)
             return jsonify({"status": "error", "filename": file.filename, "message": f"Erro no processamento: {str(e)}"}), 500
-        finally:
-            # Garante que o arquivo temporário seja excluído
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
 
     return jsonify({"status": "error", "message": "Falha no upload."}), 500
 
 
+# Upload em lote (/batch/upload, ver batch_upload.py): cada arquivo numa thread de BATCH_EXECUTOR
+# (a análise em si vai para o pool de processos); as gerações do lote rodam num executor próprio de
+# BATCH_GENERATION_CONCURRENCY threads, somando todos os lotes em andamento, para não ocupar as
+# threads de GENERATION_EXECUTOR que atendem /upload_midi
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "50"))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", str(5 * 1024 * 1024)))
+BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_WORKERS", "4")), thread_name_prefix="batch")
+BATCH_GENERATION_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_GENERATION_CONCURRENCY", "2")),
+                                               thread_name_prefix="batch-generation")
+
+
+def app_url(endpoint, **values):
+    """URLs fora do contexto de requisição (threads do lote, asgi_app.py), equivalente ao url_for."""
+    return app.url_map.bind("").build(endpoint, values)
+
+
+def process_batch_file(index, filename, file_content, user_id, deduper, generate, num_candidates, fresh):
+    """
+    Um arquivo do lote: mesmo pipeline de /upload_midi (cache, análise em duas etapas e, com
+    'generate', a geração). Retorna a linha do resultado (dict) para o NDJSON.
+    """
+    started = time.perf_counter()
+    line = {"index": index, "filename": filename}
+    try:
+        if not is_initial_midi_valid(io.BytesIO(file_content)):
+            return {**line, "status": "error", "message": "Arquivo não parece ser um MIDI válido."}
+        file_hash, notes, midi_meta = upload_cache_key(file_content)
+        line["file_hash"] = file_hash
+        first = deduper.claim(file_hash, index, filename)
+        if first is not None:
+            return {**line, "status": "duplicate", "duplicate_of": first}
+
+        cached_response = MIDI_GENERATION_CACHE.get(file_hash) if not fresh else None
+        if cached_response is not None:
+            result = cached_response if generate else {"status": "success", "analysis": cached_response["analysis"]}
+        else:
+            job = prepare_upload(file_content, filename, user_id, file_hash, notes, midi_meta)
+            if job["error"]:
+                return {**line, "status": "error", "message": job["error"], "analysis": job["analysis"]}
+            if generate:
+                generation_future = BATCH_GENERATION_EXECUTOR.submit(
+                    run_generation_stage, dict(job["analysis"]), job["rh"], job["lh"], num_candidates, not fresh,
+                    user_id, job["deadline"]
+                )
+                finish_upload_analysis(job)
+                generated_text, generation_source, style_examples, deferred = collect_generation(generation_future)
+                result = build_upload_response(job, generated_text, generation_source, style_examples, num_candidates,
+                                               app_url, deferred)
+            else:
+                result = {"status": "success", "analysis": finish_upload_analysis(job)}
+        line.update({k: v for k, v in result.items() if k not in ("filename", "message")})
+        line["cached"] = cached_response is not None
+    except Exception as e:
+        app.logger.error(f"Erro no arquivo {filename} do lote: {e}", exc_info=True)
+        line.update({"status": "error", "message": f"Erro no processamento: {str(e)}"})
+    line["elapsed_ms"] = round((time.perf_counter() - started) * 1000)
+    return line
+
+
+@app.route('/batch/upload', methods=['POST'])
+def batch_upload():
+    """
+    Upload em lote: vários arquivos em 'midi_files' (ou 'midi_file'), MIDIs ou .zip. Analisa em
+    paralelo, ignora duplicatas de conteúdo e devolve uma linha JSON por arquivo (NDJSON) assim
+    que cada um termina, e uma linha final com o resumo. 'generate=1' também gera as continuações.
+    """
+    uploads = request.files.getlist('midi_files') + request.files.getlist('midi_file')
+    uploads = [(f.filename, f.read()) for f in uploads if f.filename]
+    if not uploads:
+        return jsonify({"status": "error", "message": "Nenhum arquivo enviado."}), 400
+    try:
+        files, skipped = collect_batch_files(uploads, BATCH_MAX_FILES, BATCH_MAX_FILE_BYTES)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    generate = str(request.form.get('generate') or request.args.get('generate')).lower() in ("1", "true", "yes")
+    fresh = wants_fresh_output()
+    num_candidates = parse_num_candidates(request.form.get('candidates'))
+    user_id, deduper = current_user_id(), BatchDeduper()
+    started = time.perf_counter()
+    futures = [
+        BATCH_EXECUTOR.submit(process_batch_file, index, filename, content, user_id, deduper, generate, num_candidates, fresh)
+        for index, (filename, content) in enumerate(files)
+    ]
+    app.logger.info(f"Lote com {len(files)} arquivo(s) ({len(skipped)} ignorado(s)), geração: {generate}.")
+
+    def results():
+        counts = Counter(line["status"] for line in skipped)
+        for line in skipped:
+            yield json.dumps(line) + "\n"
+        for future in as_completed(futures):
+            line = future.result()
+            counts[line["status"]] += 1
+            yield json.dumps(line) + "\n"
+        yield json.dumps({"status": "done", "files": len(files), "summary": dict(counts),
+                          "elapsed_ms": round((time.perf_counter() - started) * 1000)}) + "\n"
+
+    return Response(results(), mimetype='application/x-ndjson')
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Métricas dos caches: respostas por arquivo e respostas do Gemini por prompt."""
+    return jsonify({
+        "upload_cache": {"entries": len(MIDI_GENERATION_CACHE)},
+        "prompt_cache": PROMPT_CACHE.stats(),
+    }), 200
+
+
+@app.route('/generation/stats', methods=['GET'])
+def generation_stats():
+    """Controle de admissão (em andamento, fila, admitidas, adiadas, descartadas), reserva e consertos do JSON das chamadas ao modelo."""
+    return jsonify({"backend": GENERATION_BACKEND, "deadline_seconds": GENERATION_DEADLINE_SECONDS,
+                    **GENERATION_ADMISSION.stats(), "hedging": GENERATION_HEDGER.stats(),
+                    "json_repair": GENERATION_REPAIR_STATS.stats()}), 200
+
+
+def require_debug_access():
+    """Rotas de depuração: 404 sem o acesso de depuração (debug_access_allowed)."""
+    if not debug_access_allowed():
+        abort(404)
+
+
+@app.route('/debug/payloads', methods=['GET'])
+def debug_payloads():
+    """Últimos payloads guardados (sem o conteúdo; filtro opcional 'kind') e o estado da fila de logs."""
+    require_debug_access()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), PAYLOAD_LOG.stats()["capacity"])
+    return jsonify({"payloads": PAYLOAD_LOG.recent(request.args.get('kind'), limit),
+                    "payload_log": PAYLOAD_LOG.stats(), "log_queue": LOG_HANDLER.stats()}), 200
+
+
+@app.route('/debug/payloads/<int:payload_id>', methods=['GET'])
+def debug_payload(payload_id):
+    """Um payload completo pelo id que aparece no log ('payload_id')."""
+    require_debug_access()
+    entry = PAYLOAD_LOG.get(payload_id)
+    if entry is None:
+        return jsonify({"status": "error", "message": "Payload não está mais no buffer."}), 404
+    return jsonify(entry), 200
+
+
+def find_profile(profile_id):
+    """Resumo (.json) do perfil pelo id, ou None."""
+    if len(profile_id) != 12 or any(c not in '0123456789abcdef' for c in profile_id):
+        return None
+    matches = glob.glob(os.path.join(PROFILE_DIR, f"*_{profile_id}.json"))
+    if not matches:
+        return None
+    with open(matches[0], encoding="utf-8") as f:
+        return json.load(f)
+
+
+@app.route('/debug/profiling', methods=['GET', 'POST'])
+def debug_profiling():
+    """Amostragem do profiling ('sample_rate', 'mode'; POST altera) e os perfis mais recentes."""
+    require_debug_access()
+    if request.method == 'POST':
+        params = request.get_json(silent=True) or request.form
+        try:
+            if 'sample_rate' in params:
+                PROFILING["sample_rate"] = min(max(float(params['sample_rate']), 0.0), 1.0)
+        except ValueError:
+            return jsonify({"status": "error", "message": "sample_rate inválido."}), 400
+        if params.get('mode') in PROFILE_MODES:
+            PROFILING["mode"] = params['mode']
+    metas = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), reverse=True)[:20]
+    recent = []
+    for path in metas:
+        with open(path, encoding="utf-8") as f:
+            meta = json.load(f)
+        recent.append({k: meta.get(k) for k in ("id", "mode", "file_hash", "filename", "total_ms", "started_at")})
+    return jsonify({**PROFILING, "interval_ms": PROFILE_INTERVAL_SECONDS * 1000, "recent": recent}), 200
+
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def debug_profile(profile_id):
+    """Resumo de um perfil (tempos das etapas e arquivos) pelo id do cabeçalho X-Profile-Id."""
+    require_debug_access()
+    meta = find_profile(profile_id)
+    if meta is None:
+        return jsonify({"status": "error", "message": "Perfil não encontrado."}), 404
+    meta["urls"] = {name.rsplit('.', 1)[1]: url_for('debug_profile_file', profile_id=profile_id, kind=name.rsplit('.', 1)[1])
+                    for name in meta["files"]}
+    return jsonify(meta), 200
+
+
+@app.route('/debug/profiles/<profile_id>/<kind>', methods=['GET'])
+def debug_profile_file(profile_id, kind):
+    """Um arquivo do perfil: svg (flamegraph), collapsed (pilhas colapsadas), pstats, txt ou json."""
+    require_debug_access()
+    meta = find_profile(profile_id)
+    names = [name for name in (meta or {}).get("files", []) if name.endswith("." + kind)]
+    if not names:
+        return jsonify({"status": "error", "message": "Arquivo do perfil não encontrado."}), 404
+    mimetypes = {"svg": "image/svg+xml", "json": "application/json", "pstats": "application/octet-stream"}
+    return send_file(os.path.join(PROFILE_DIR, names[0]), mimetype=mimetypes.get(kind, "text/plain"))
+
+
+@app.route('/analysis/stats', methods=['GET'])
+def analysis_stats():
+    """Estado do pool de processos de análise (tarefas concluídas, mortas por tempo/memória, reciclagens) e dos refinamentos."""
+    refinements = {"budget_seconds": ANALYSIS_BUDGET_SECONDS, **ANALYSIS_REFINEMENTS.stats()}
+    if ANALYSIS_POOL is None:
+        return jsonify({"enabled": False, "refinements": refinements}), 200
+    return jsonify({"enabled": True, **ANALYSIS_POOL.stats(), "refinements": refinements}), 200
+
+
+@app.route('/analysis/<file_hash>/refined', methods=['GET'])
+def refined_analysis(file_hash):
+    """Análise completa de um upload cuja análise saiu aproximada por causa do orçamento de tempo."""
+    refinement = ANALYSIS_REFINEMENTS.get(file_hash)
+    if refinement is None:
+        return jsonify({"status": "error", "message": "Nenhum refinamento para este arquivo."}), 404
+    if refinement["status"] == "pending":
+        response = jsonify({"status": "pending", "message": "Análise completa em andamento. Tente novamente em instantes."})
+        response.headers["Retry-After"] = "5"
+        return response, 202
+    if refinement["status"] == "failed":
+        return jsonify({"status": "error", "message": f"Falha na análise completa: {refinement['error']}"}), 500
+    return jsonify({"status": "success", "file_hash": file_hash, "analysis": refinement["analysis"],
+                    "seconds": refinement["seconds"]}), 200
+
+
+@app.route('/analysis/<file_hash>/events', methods=['GET'])
+def analysis_events(file_hash):
+    """Server-Sent Events: um evento 'refined' (ou 'failed') quando a análise completa terminar."""
+    if ANALYSIS_REFINEMENTS.get(file_hash) is None:
+        return jsonify({"status": "error", "message": "Nenhum refinamento para este arquivo."}), 404
+
+    def events():
+        while True:
+            refinement = ANALYSIS_REFINEMENTS.wait(file_hash, ANALYSIS_EVENTS_KEEPALIVE_SECONDS)
+            if refinement is None or refinement["status"] == "failed":
+                error = refinement["error"] if refinement else "Refinamento descartado."
+                yield f"event: failed\ndata: {json.dumps({'file_hash': file_hash, 'error': error})}\n\n"
+                return
+            if refinement["status"] == "ready":
+                data = {"file_hash": file_hash, "analysis": refinement["analysis"], "seconds": refinement["seconds"]}
+                yield f"event: refined\ndata: {json.dumps(data)}\n\n"
+                return
+            yield ": aguardando\n\n" # Mantém a conexão aberta
+
+    return Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+
+@app.route('/variations/<file_hash>/next', methods=['GET', 'POST'])
+def next_variation(file_hash):
+    """Entrega a próxima variação pré-gerada de um arquivo já enviado e repõe o pool em segundo plano."""
+    variation, state = VARIATION_POOL.next(file_hash, current_user_id())
+    pool_status = VARIATION_POOL.status(file_hash)
+    if state == "ready":
+        return jsonify({
+            "status": "success", "file_hash": file_hash,
+            "generated_midi_url": url_for('static', filename=variation["midi_path"]),
+            "temperature": variation["temperature"], "generation_source": variation["generation_source"],
+            "pool": pool_status,
+        }), 200
+    if state == "unknown":
+        return jsonify({"status": "error", "message": "Arquivo desconhecido. Envie o MIDI novamente em /upload_midi."}), 404
+    if state == "pending":
+        response = jsonify({"status": "pending", "message": "Gerando novas variações. Tente novamente em instantes.", "pool": pool_status})
+        response.headers["Retry-After"] = "2"
+        return response, 202
+    return jsonify({"status": "error", "message": "Limite de variações atingido para este arquivo ou usuário.", "pool": pool_status}), 429
+
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """Cria uma sessão de composição a partir de um MIDI; a análise completa roda só aqui."""
+    if 'midi_file' not in request.files:
+        return jsonify({"status": "error", "message": "Nenhum arquivo enviado."}), 400
+    file = request.files['midi_file']
+    if file.filename == '':
+        return jsonify({"status": "error", "message": "Nenhum arquivo selecionado."}), 400
+    if not is_initial_midi_valid(file.stream):
+        return jsonify({"status": "error", "filename": file.filename, "message": "Arquivo não parece ser um MIDI válido."}), 400
+
+    temp_file_path = None
+    try:
+        file_content = file.stream.read()
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.mid') as tmp:
+            tmp.write(file_content)
+            temp_file_path = tmp.name
+        analysis_data, original_stream = analyze_midi_with_music21(temp_file_path)
+        notes, _ = corpus.extract_notes(file_content)
+        if not len(notes):
+            return jsonify({"status": "error", "filename": file.filename, "message": "O arquivo MIDI não contém notas.", "analysis": analysis_data}), 400
+
+        session = CompositionSession(notes, analysis_data.get('bpm', 120), analysis_data.get('time_signature'))
+        SESSION_STORE.add(session)
+        return jsonify({
+            "status": "success", "filename": file.filename, "analysis": analysis_data,
+            "session": session.summary(),
+            "extend_url": url_for('extend_session', session_id=session.id),
+        }), 201
+    except Exception as e:
+        app.logger.error(f"Erro ao criar sessão: {e}", exc_info=True)
+        return jsonify({"status": "error", "filename": file.filename, "message": f"Erro no processamento: {str(e)}"}), 500
+    finally:
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Estado atual da peça acumulada na sessão."""
+    session = SESSION_STORE.get(session_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Sessão não encontrada ou expirada."}), 404
+    return jsonify({"status": "success", "session": session.summary(),
+                    "piece_midi_url": url_for('session_midi', session_id=session_id)}), 200
+
+
+@app.route('/sessions/<session_id>/extend', methods=['POST'])
+def extend_session(session_id):
+    """Gera a próxima continuação da peça da sessão e a anexa, sem reenvio nem nova análise completa."""
+    session = SESSION_STORE.get(session_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Sessão não encontrada ou expirada."}), 404
+
+    params = request.get_json(silent=True) or request.form
+    try:
+        num_candidates = max(1, min(GENERATION_MAX_CANDIDATES, int(params.get('candidates', GENERATION_CANDIDATES))))
+        temperature = float(params['temperature']) if params.get('temperature') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Parâmetros 'candidates'/'temperature' inválidos."}), 400
+
+    with session.lock:
+        try:
+            start = time.perf_counter()
+            analysis_data, music_text_rh, music_text_lh = session.prompt_inputs()
+            app.logger.info(f"Prompt da sessão {session_id} montado em {(time.perf_counter() - start) * 1000:.1f} ms.")
+
+            style_examples = retrieve_style_examples(music_text_rh, music_text_lh) if GENERATION_BACKEND == "gemini" else ""
+            generated_text, generation_source = generate_continuation(
+                analysis_data, music_text_rh, music_text_lh, style_examples, num_candidates, temperature,
+                use_cache=not wants_fresh_output(params), client=current_user_id(),
+                deadline=time.monotonic() + GENERATION_DEADLINE_SECONDS
+            )
+            if not generated_text:
+                return jsonify({"status": "error", "message": "A geração falhou. Tente novamente."}), 502
+            candidate_scores = None
+            if num_candidates > 1:
+                # Numa sessão os demais candidatos são descartados (não há pool de variações)
+                generated_text, candidate_scores, _ = select_best_candidate(
+                    generated_text, analysis_data, music_text_rh, music_text_lh
+                )
+
+            continuation_path = write_continuation_midi(
+                generated_text, session.bpm, f"session_{session_id}_{session.extensions + 1}.mid"
+            )
+            new_notes = session.extend(generated_text)
+        except GenerationDeferred as e:
+            retry_after = math.ceil(e.retry_after)
+            response = jsonify({"status": "deferred", "message": "Geração adiada. Tente novamente em instantes.",
+                                "reason": e.reason, "retry_after": retry_after})
+            response.headers["Retry-After"] = str(retry_after)
+            return response, 429 if e.reason == "rate_limited" else 503
+        except json.JSONDecodeError as e:
+            app.logger.error(f"Erro de decodificação de JSON na sessão {session_id}: {e}")
+            return jsonify({"status": "error", "message": f"Erro ao ler a resposta da geração: {str(e)}"}), 500
+        except Exception as e:
+            app.logger.error(f"Erro ao estender a sessão {session_id}: {e}", exc_info=True)
+            return jsonify({"status": "error", "message": f"Erro no processamento: {str(e)}"}), 500
+
+        return jsonify({
+            "status": "success", "generated_midi_url": url_for('static', filename=continuation_path),
+            "generation_source": generation_source, "candidates": candidate_scores, "new_notes": new_notes,
+            "session": session.summary(), "piece_midi_url": url_for('session_midi', session_id=session_id),
+        }), 200
+
+
+@app.route('/sessions/<session_id>/midi', methods=['GET'])
+def session_midi(session_id):
+    """A peça acumulada da sessão (original + todas as extensões) como um único MIDI."""
+    session = SESSION_STORE.get(session_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Sessão não encontrada ou expirada."}), 404
+    with session.lock:
+        midi_bytes = session.to_midi_bytes()
+    return send_file(io.BytesIO(midi_bytes), mimetype='audio/midi', as_attachment=True,
+                     download_name=f"session_{session_id}.mid")
+
+
+def get_similarity_index():
+    """Carrega o índice de similaridade uma única vez; retorna None se ainda não foi construído."""
+    global SIMILARITY_INDEX
+    if SIMILARITY_INDEX is None:
+        try:
+            SIMILARITY_INDEX = SimilarityIndex(CORPUS_INDEX_DIR)
+            app.logger.info(f"Índice de similaridade carregado: {len(SIMILARITY_INDEX)} peças.")
+        except FileNotFoundError:
+            app.logger.warning(f"Índice de similaridade não encontrado em {CORPUS_INDEX_DIR}.")
+            return None
+    return SIMILARITY_INDEX
+
+
+@app.route('/similar', methods=['POST'])
+def similar_pieces():
+    """Retorna as peças do corpus (Datasets/) mais parecidas com o MIDI enviado."""
+
+    if 'midi_file' not in request.files:
+        return jsonify({"status": "error", "message": "Nenhum arquivo enviado."}), 400
+    file = request.files['midi_file']
+    if file.filename == '':
+        return jsonify({"status": "error", "message": "Nenhum arquivo selecionado."}), 400
+    if not is_initial_midi_valid(file.stream):
+        return jsonify({"status": "error", "filename": file.filename, "message": "Arquivo não parece ser um MIDI válido."}), 400
+
+    try:
+        k = int(request.form.get('k', 5))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parâmetro 'k' deve ser um número inteiro."}), 400
+    k = max(1, min(SIMILARITY_MAX_K, k))
+
+    index = get_similarity_index()
+    if index is None:
+        return jsonify({"status": "error", "message": "Índice do corpus indisponível. Execute 'python similarity.py build'."}), 503
+
+    try:
+        notes, _ = corpus.extract_notes(file.stream.read())
+        if not len(notes):
+            return jsonify({"status": "error", "filename": file.filename, "message": "O arquivo MIDI não contém notas."}), 400
+        results = index.query(notes, k)
+    except Exception as e:
+        app.logger.error(f"Erro na busca por similaridade: {e}", exc_info=True)
+        return jsonify({"status": "error", "filename": file.filename, "message": f"Erro na busca: {str(e)}"}), 500
+
+    return jsonify({"status": "success", "filename": file.filename, "results": results}), 200
+
+
 if __name__ == '__main__':
     # Configurações de ambiente do music21
     us = environment.UserSettings()
     us['warnings'] = 0 # Desativa os avisos do music21
     
+    # Pré-aquece o pool de análise (só no processo que atende, não no monitor do reloader)
+    if ANALYSIS_POOL is not None and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        ANALYSIS_POOL.start()
+
     # Inicia o servidor Flask em modo de depuração
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""
+Ponto de entrada ASGI (FastAPI) da aplicação.
+
+No app Flask (app.py), cada geração em andamento prende uma thread ou um
+processo do servidor enquanto espera a API remota. Aqui o upload é assíncrono:
+  - a chamada ao modelo é aguardada (generate_content_async), sem prender thread,
+    então milhares de gerações pendentes cabem em poucos processos;
+  - o trabalho de CPU (NumPy, escrita do MIDI) vai para um executor
+    (ASGI_ANALYSIS_WORKERS threads), sem bloquear o event loop; a análise com o
+    music21 em si roda no pool de processos de app.py (analysis_pool.py).
+As etapas do pipeline são as mesmas do Flask (prepare_upload, finish_upload_analysis,
+build_upload_response em app.py), assim como os caches, o pool de variações e as
+sessões. As demais rotas continuam sendo servidas pelo app Flask, montado em '/'.
+
+Uso:
+    uvicorn asgi_app:api --workers 4 --port 8000
+
+Com GENERATION_BACKEND=fake o modelo é substituído pelo falso de fake_backend.py
+(latência simulada); ver load_test.py.
+"""
+import io
+import os
+import json
+import time
+import asyncio
+from functools import partial
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.middleware.wsgi import WSGIMiddleware
+from fastapi.responses import JSONResponse
+
+import app as flask_app
+from app import (
+    GENERATION_BACKEND, REMOTE_GENERATION_SOURCE, MIDI_GENERATION_CACHE, PROMPT_CACHE, ANALYSIS_POOL,
+    GENERATION_ADMISSION, GENERATION_HEDGER, GenerationDeferred, CallDeadlineExceeded, model_call_deadline, model_request_options,
+    build_generation_prompt, get_generative_model, extract_generated_json, lookup_prompt_cache,
+    generate_music_continuation_locally, retrieve_style_examples, upload_cache_key, prepare_upload,
+    finish_upload_analysis, build_upload_response, parse_num_candidates, is_initial_midi_valid, app_url, client_identity,
+)
+
+logger = flask_app.app.logger
+
+# Threads para o trabalho de CPU (análise, recuperação de exemplos, escrita do MIDI)
+ANALYSIS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ASGI_ANALYSIS_WORKERS", "4")), thread_name_prefix="asgi-analysis"
+)
+
+# Gerações remotas aguardando resposta neste processo (só o event loop altera)
+GENERATION_STATS = {"pending": 0, "peak_pending": 0, "completed": 0, "failed": 0}
+
+@asynccontextmanager
+async def lifespan(_):
+    # Pré-aquece o pool de processos de análise de cada worker do servidor
+    if ANALYSIS_POOL is not None:
+        ANALYSIS_POOL.start()
+    yield
+    if ANALYSIS_POOL is not None:
+        ANALYSIS_POOL.shutdown()
+
+
+api = FastAPI(title="Dark Music Analyzer", lifespan=lifespan)
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """Executa fn no executor de CPU e aguarda o resultado."""
+    return await asyncio.get_running_loop().run_in_executor(ANALYSIS_EXECUTOR, partial(fn, *args, **kwargs))
+
+
+async def generate_continuation_async(analysis_data, music_text_rh, music_text_lh, num_candidates=1, temperature=None, use_cache=True,
+                                      client=None, deadline=None):
+    """
+    Versão assíncrona de run_generation_stage (app.py): mesmo prompt, cache, controle de admissão,
+    prazo com reserva e fallback local, mas a chamada ao modelo (e a espera na fila) é aguardada.
+    Retorna (texto JSON, origem, exemplos de estilo); levanta GenerationDeferred se não for admitida.
+    """
+    if GENERATION_BACKEND == "markov":
+        generated_text = await run_cpu(generate_music_continuation_locally, analysis_data, music_text_rh, music_text_lh,
+                                       num_candidates, temperature or 1.0)
+        return generated_text, "markov", ""
+
+    style_examples = ""
+    if GENERATION_BACKEND == "gemini":
+        style_examples = await run_cpu(retrieve_style_examples, music_text_rh, music_text_lh)
+    prompt = build_generation_prompt(analysis_data, music_text_rh, music_text_lh, style_examples, num_candidates)
+    generation_config = {"temperature": temperature} if temperature is not None else None
+    cache_key, cached = lookup_prompt_cache(prompt, generation_config, use_cache)
+    if cached is not None:
+        return cached, REMOTE_GENERATION_SOURCE, style_examples
+
+    generated_text = None
+    model = get_generative_model()
+    call_deadline = model_call_deadline(deadline)
+
+    async def attempt():
+        response = await model.generate_content_async(prompt, generation_config=generation_config,
+                                                      request_options=model_request_options(call_deadline))
+        return extract_generated_json(response.text)
+
+    slot = await GENERATION_ADMISSION.admit_async(client, deadline)
+    GENERATION_STATS["pending"] += 1
+    GENERATION_STATS["peak_pending"] = max(GENERATION_STATS["peak_pending"], GENERATION_STATS["pending"])
+    try:
+        # A vaga fica com a primeira tentativa até ela terminar; a reserva pede a sua (try_admit)
+        generated_text = await GENERATION_HEDGER.call_async(attempt, call_deadline, slot, GENERATION_ADMISSION.try_admit)
+    except CallDeadlineExceeded:
+        logger.warning("A API de geração não respondeu dentro do prazo.")
+    except Exception as e:
+        logger.error(f"Erro ao chamar a API de geração: {e}")
+    finally:
+        GENERATION_STATS["pending"] -= 1
+        GENERATION_STATS["completed" if generated_text else "failed"] += 1
+
+    if generated_text:
+        PROMPT_CACHE.put(cache_key, generated_text)
+        return generated_text, REMOTE_GENERATION_SOURCE, style_examples
+    # Fallback: API fora do ar ou resposta inválida -> motor local
+    logger.warning("Geração remota falhou. Usando o motor Markov local.")
+    generated_text = await run_cpu(generate_music_continuation_locally, analysis_data, music_text_rh, music_text_lh,
+                                   num_candidates, temperature or 1.0)
+    return generated_text, "markov", style_examples
+
+
+@api.post("/upload_midi")
+async def upload_midi_file(request: Request, midi_file: UploadFile = File(None),
+                           candidates: str = Form(None), fresh: str = Form(None)):
+    """Upload, análise e geração da continuação (mesma resposta da rota do Flask)."""
+    if midi_file is None:
+        return JSONResponse({"status": "error", "message": "Nenhum arquivo enviado."}, status_code=400)
+    if not midi_file.filename:
+        return JSONResponse({"status": "error", "message": "Nenhum arquivo selecionado."}, status_code=400)
+
+    file_content = await midi_file.read()
+    filename = midi_file.filename
+    if not await run_cpu(is_initial_midi_valid, io.BytesIO(file_content)):
+        return JSONResponse({"status": "error", "filename": filename, "message": "Arquivo não parece ser um MIDI válido."}, status_code=400)
+
+    user_id = client_identity(request.headers.get('X-User-Id'), request.client.host if request.client else None)
+    fresh = str(fresh or request.query_params.get('fresh')).lower() in ("1", "true", "yes")
+    try:
+        file_hash, notes, midi_meta = await run_cpu(upload_cache_key, file_content)
+        if file_hash in MIDI_GENERATION_CACHE and not fresh:
+            cached_response = MIDI_GENERATION_CACHE[file_hash]
+            cached_response['filename'] = filename
+            return JSONResponse(cached_response)
+
+        job = await run_cpu(prepare_upload, file_content, filename, user_id, file_hash, notes, midi_meta)
+        if job["error"]:
+            return JSONResponse({"status": "error", "message": job["error"], "analysis": job["analysis"]}, status_code=500)
+        num_candidates = parse_num_candidates(candidates)
+
+        # Geração (aguardando a API) em paralelo com a etapa 2 da análise (no executor)
+        generation = asyncio.ensure_future(generate_continuation_async(
+            dict(job["analysis"]), job["rh"], job["lh"], num_candidates, use_cache=not fresh,
+            client=user_id, deadline=job["deadline"]
+        ))
+        await run_cpu(finish_upload_analysis, job)
+        deferred = None
+        try:
+            generated_text, generation_source, style_examples = await generation
+        except GenerationDeferred as e:
+            logger.warning(f"Geração adiada ({e.reason}); respondendo só com a análise.")
+            generated_text, generation_source, style_examples, deferred = None, None, "", e
+        logger.info(f"Pipeline assíncrono concluído em {(time.perf_counter() - job['started']) * 1000:.0f} ms.")
+
+        final_response = await run_cpu(build_upload_response, job, generated_text, generation_source,
+                                       style_examples, num_candidates, app_url, deferred)
+        headers = {"Retry-After": str(final_response["generation_deferred"]["retry_after"])} if deferred else None
+        return JSONResponse(final_response, headers=headers)
+
+    except json.JSONDecodeError as e:
+        logger.error(f"Erro Crítico de Decodificação de JSON: {e}")
+        return JSONResponse({"status": "error", "filename": filename, "message": f"Erro ao ler a resposta da geração: {str(e)}"}, status_code=500)
+    except Exception as e:
+        logger.error(f"Erro geral no upload ou análise: {e}", exc_info=True)
+        return JSONResponse({"status": "error", "filename": filename, "message": f"Erro no processamento: {str(e)}"}, status_code=500)
+
+
+@api.get("/asgi/stats")
+async def asgi_stats():
+    """Gerações pendentes (agora e o pico) deste processo; com vários workers, cada um responde o seu."""
+    return {"pid": os.getpid(), "backend": GENERATION_BACKEND, **GENERATION_STATS}
+
+
+# Demais rotas (página inicial, estáticos, variações, sessões, /similar, /cache/stats) pelo app Flask
+api.mount("/", WSGIMiddleware(flask_app.app))
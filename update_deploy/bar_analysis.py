@@ -0,0 +1,351 @@
+"""
+Análise por compasso com atualização incremental, para reenvios de versões editadas.
+
+BarAnalysis guarda, para cada compasso da tabela de notas (ver corpus.py):
+histograma de classes de altura, contagem de notas e de onsets, extensão,
+durações, acorde dominante e um hash do conteúdo relativo ao início do
+compasso; mais a tonalidade local de cada janela de WINDOW_BARS compassos e
+os agregados globais.
+
+updated(notes) compara a sequência de hashes de compassos da versão nova com
+a anterior (difflib, então compassos inseridos ou removidos não deslocam o
+resto) e recalcula só os compassos e janelas afetados. Os agregados globais
+são atualizados subtraindo a contribuição dos compassos removidos e somando
+a dos novos.
+
+A tonalidade é a mesma estimativa de note_table.py (PieceStats), e o acorde e a
+nota finais saem de music_analysis.final_chord_fields (as notas que soam no
+último trecho da peça, como o último acorde do chordify), no mesmo formato da
+análise com music21. A densidade rítmica daqui (grupos de onsets por compasso)
+é só uma estimativa: a do music21 conta notas, acordes e pausas por compasso.
+"""
+import time
+import difflib
+import threading
+from collections import Counter, OrderedDict, deque
+
+import numpy as np
+from music21 import chord, key
+
+import corpus
+from music_analysis import final_chord_fields
+from note_table import estimate_key, key_text
+
+WINDOW_BARS = 4 # Janela da tonalidade local
+
+# Tríades (e sétima da dominante) para o acorde de cada compasso
+CHORD_TEMPLATES = {
+    "major": (0, 4, 7), "minor": (0, 3, 7), "diminished": (0, 3, 6),
+    "augmented": (0, 4, 8), "dominant-seventh": (0, 4, 7, 10),
+}
+_TEMPLATE_NAMES = list(CHORD_TEMPLATES)
+_TEMPLATES = np.zeros((len(CHORD_TEMPLATES), 12, 12))
+for _q, _intervals in enumerate(CHORD_TEMPLATES.values()):
+    for _root in range(12):
+        _TEMPLATES[_q, _root, [(_root + i) % 12 for i in _intervals]] = 1.0 / len(_intervals)
+
+_ROMAN = ['I', '♭II', 'II', '♭III', 'III', 'IV', '♯IV', 'V', '♭VI', 'VI', '♭VII', 'VII']
+# Nomes de duração do music21 (Duration.type) para o resumo rítmico
+_DURATION_TYPES = {4.0: "whole", 2.0: "half", 1.0: "quarter", 0.5: "eighth", 0.25: "16th", 0.125: "32nd"}
+
+# Campos derivados dos agregados, no mesmo formato da análise com music21
+DERIVED_FIELDS = ("key", "num_bars", "last_offset", "melodic_range", "chord_complexity",
+                  "harmonic_progression_preview", "rhythmic_pattern_summary",
+                  "final_chord_analysis", "final_melody_analysis", "key_changes")
+# Campos que o music21 calcula de outro jeito: o valor daqui só indica que o campo mudou
+ESTIMATED_FIELDS = ("rhythmic_density",)
+
+
+def key_index(estimate):
+    """Índice 0-23 (0-11 maior, 12-23 menor) de uma estimativa de note_table.estimate_key; -1 sem notas."""
+    return -1 if estimate is None else estimate[0] + 12 * estimate[1]
+
+
+def key_name(index):
+    """Índice 0-23 no formato da análise (ex: 'F♯ Menor')."""
+    return key_text((index % 12, index >= 12))
+
+
+def _bar_hashes(notes, bar_length):
+    """Hash de cada compasso: soma (mod 2^64) de um hash por nota, com onset relativo ao compasso."""
+    bars = (notes['onset'] // bar_length).astype(np.int64)
+    num_bars = int(bars.max()) + 1 if len(notes) else 0
+    rel = np.round((notes['onset'] - bars * bar_length) / corpus.QUANTIZE_GRID).astype(np.uint64)
+    dur = np.round(notes['duration'] / corpus.QUANTIZE_GRID).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        h = (rel * np.uint64(0x9E3779B97F4A7C15)) ^ (dur * np.uint64(0xC2B2AE3D27D4EB4F)) \
+            ^ (notes['pitch'].astype(np.uint64) * np.uint64(0x165667B19E3779F9)) \
+            ^ (notes['velocity'].astype(np.uint64) * np.uint64(0x27D4EB2F165667C5))
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        hashes = np.zeros(num_bars, dtype=np.uint64)
+        np.add.at(hashes, bars, h)
+    return bars, hashes
+
+
+class BarAnalysis:
+
+    def __init__(self, bar_length):
+        self.bar_length = bar_length
+        self.num_bars = 0
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.chroma = np.zeros((0, 12))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.onset_groups = np.zeros(0, dtype=np.int64)
+        self.low = np.zeros(0, dtype=np.int64)
+        self.high = np.zeros(0, dtype=np.int64)
+        self.durations = []
+        self.chords = []          # (raiz, qualidade) ou None por compasso
+        self.last_notes = None    # Notas que soam no último trecho (acorde e nota final)
+        self.local_keys = np.zeros(0, dtype=np.int64)
+        self.total_chroma = np.zeros(12)
+        self.total_counts = 0
+        self.total_groups = 0
+        self.total_durations = Counter()
+        self.end = 0.0
+
+    @classmethod
+    def build(cls, notes, bar_length):
+        analysis = cls(bar_length)
+        bars, hashes = _bar_hashes(notes, bar_length)
+        analysis._allocate(len(hashes))
+        analysis.hashes = hashes
+        analysis._compute_bars(notes, bars, range(len(hashes)))
+        analysis._compute_windows(range(analysis._num_windows()))
+        analysis._finish(notes, analysis.total_from_bars())
+        return analysis
+
+    def updated(self, notes):
+        """
+        Nova BarAnalysis para 'notes', reaproveitando os compassos iguais aos desta.
+        Retorna (análise, resumo do diff).
+        """
+        new = BarAnalysis(self.bar_length)
+        bars, hashes = _bar_hashes(notes, self.bar_length)
+        new._allocate(len(hashes))
+        new.hashes = hashes
+        new_to_old = np.full(len(hashes), -1, dtype=np.int64)
+        changed_new, removed_old = [], []
+
+        matcher = difflib.SequenceMatcher(None, self.hashes.tolist(), hashes.tolist(), autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                new_to_old[j1:j2] = np.arange(i1, i2)
+                for name in ("chroma", "counts", "onset_groups", "low", "high"):
+                    getattr(new, name)[j1:j2] = getattr(self, name)[i1:i2]
+                new.durations[j1:j2] = self.durations[i1:i2]
+                new.chords[j1:j2] = self.chords[i1:i2]
+            else:
+                changed_new.extend(range(j1, j2))
+                removed_old.extend(range(i1, i2))
+
+        new._compute_bars(notes, bars, changed_new)
+
+        # Janela reaproveitável: todos os compassos vêm, em sequência, da mesma janela da versão anterior
+        dirty_windows = []
+        for w in range(new._num_windows()):
+            mapped = new_to_old[w:w + WINDOW_BARS]
+            if (mapped >= 0).all() and (np.diff(mapped) == 1).all() and mapped[0] < len(self.local_keys):
+                new.local_keys[w] = self.local_keys[mapped[0]]
+            else:
+                dirty_windows.append(w)
+        new._compute_windows(dirty_windows)
+
+        # Agregados: anterior - compassos removidos + compassos novos
+        totals = {
+            "chroma": self.total_chroma - self.chroma[removed_old].sum(axis=0) + new.chroma[changed_new].sum(axis=0),
+            "counts": self.total_counts - int(self.counts[removed_old].sum()) + int(new.counts[changed_new].sum()),
+            "groups": self.total_groups - int(self.onset_groups[removed_old].sum()) + int(new.onset_groups[changed_new].sum()),
+            "durations": self.total_durations.copy(),
+        }
+        for i in removed_old:
+            totals["durations"].subtract(self.durations[i])
+        for j in changed_new:
+            totals["durations"].update(new.durations[j])
+        totals["durations"] = +totals["durations"] # Descarta contagens zeradas
+        new._finish(notes, totals)
+
+        diff = {"total_bars": len(hashes), "changed_bars": len(changed_new), "removed_bars": len(removed_old),
+                "reused_bars": int((new_to_old >= 0).sum()), "recomputed_windows": len(dirty_windows)}
+        return new, diff
+
+    def overlap(self, notes):
+        """Fração de compassos iguais (na ordem) entre esta versão e 'notes'."""
+        _, hashes = _bar_hashes(notes, self.bar_length)
+        if not len(hashes) or not len(self.hashes):
+            return 0.0
+        matcher = difflib.SequenceMatcher(None, self.hashes.tolist(), hashes.tolist(), autojunk=False)
+        matched = sum(block.size for block in matcher.get_matching_blocks())
+        return matched / max(len(hashes), len(self.hashes))
+
+    def _allocate(self, num_bars):
+        self.num_bars = num_bars
+        self.chroma = np.zeros((num_bars, 12))
+        self.counts = np.zeros(num_bars, dtype=np.int64)
+        self.onset_groups = np.zeros(num_bars, dtype=np.int64)
+        self.low = np.full(num_bars, 127, dtype=np.int64)
+        self.high = np.full(num_bars, -1, dtype=np.int64)
+        self.durations = [Counter() for _ in range(num_bars)]
+        self.chords = [None] * num_bars
+        self.local_keys = np.full(self._num_windows(), -1, dtype=np.int64)
+
+    def _num_windows(self):
+        return max(self.num_bars - WINDOW_BARS + 1, 1 if self.num_bars else 0)
+
+    def _compute_bars(self, notes, bars, bar_indices):
+        """Recalcula os compassos 'bar_indices' a partir das notas (agrupadas por compasso)."""
+        bar_indices = list(bar_indices)
+        if not bar_indices or not len(notes):
+            return
+        order = np.argsort(bars, kind='stable')
+        sorted_bars = bars[order]
+        starts = np.searchsorted(sorted_bars, bar_indices, side='left')
+        ends = np.searchsorted(sorted_bars, bar_indices, side='right')
+        for b, start, end in zip(bar_indices, starts, ends):
+            bar_notes = notes[order[start:end]]
+            if not len(bar_notes):
+                continue
+            pitch = bar_notes['pitch'].astype(np.int64)
+            chroma = np.bincount(pitch % 12, weights=bar_notes['duration'], minlength=12)
+            self.chroma[b] = chroma
+            self.counts[b] = len(bar_notes)
+            self.onset_groups[b] = len(np.unique(bar_notes['onset']))
+            self.low[b], self.high[b] = pitch.min(), pitch.max()
+            self.durations[b] = Counter(np.round(bar_notes['duration'].astype(np.float64), 4).tolist())
+            scores = _TEMPLATES @ (chroma / chroma.sum())
+            quality, root = np.unravel_index(int(np.argmax(scores)), scores.shape)
+            self.chords[b] = (int(root), _TEMPLATE_NAMES[quality]) if scores[quality, root] >= 0.15 else (int(root), "other")
+
+    def _compute_windows(self, windows):
+        for w in windows:
+            self.local_keys[w] = key_index(estimate_key(self.chroma[w:w + WINDOW_BARS].sum(axis=0)))
+
+    def total_from_bars(self):
+        durations = Counter()
+        for c in self.durations:
+            durations.update(c)
+        return {"chroma": self.chroma.sum(axis=0), "counts": int(self.counts.sum()),
+                "groups": int(self.onset_groups.sum()), "durations": durations}
+
+    def _finish(self, notes, totals):
+        self.total_chroma = totals["chroma"]
+        self.total_counts = totals["counts"]
+        self.total_groups = totals["groups"]
+        self.total_durations = totals["durations"]
+        if len(notes):
+            ends = notes['onset'] + notes['duration']
+            self.end = float(ends.max())
+            # Último ponto (onset ou fim de nota) antes do fim: o último acorde do chordify
+            points = np.concatenate((notes['onset'], ends))
+            last_point = points[points < self.end - 1e-6].max()
+            self.last_notes = notes[(notes['onset'] <= last_point + 1e-6) & (ends > last_point + 1e-6)]
+
+    def derived(self):
+        """Campos da análise calculados a partir dos agregados (mesmo formato da análise com music21)."""
+        fields = {}
+        estimate = estimate_key(self.total_chroma)
+        fields["key"] = key_text(estimate)
+        piece_key = key_index(estimate)
+        fields["num_bars"] = self.num_bars if self.num_bars else "N/A"
+        fields["last_offset"] = round(self.end, 4)
+
+        occupied = self.high >= 0
+        if occupied.any():
+            octave_span = (self.high[occupied].max() - self.low[occupied].min()) / 12.0
+            if octave_span < 1.5: fields["melodic_range"] = "1-2 Oitavas"
+            elif octave_span < 3: fields["melodic_range"] = "2-3 Oitavas"
+            else: fields["melodic_range"] = f"~ {round(octave_span)} Oitavas"
+
+        chords = [c for c in self.chords if c is not None]
+        if chords:
+            qualities = set(q for _, q in chords)
+            fields["chord_complexity"] = "Simples" if len(qualities) <= 2 else "Moderada" if len(qualities) <= 4 else "Complexa"
+            preview, seen = [], set()
+            for root, quality in chords:
+                if (root, quality) in seen:
+                    continue
+                seen.add((root, quality))
+                preview.append(self._chord_label(root, quality, piece_key))
+                if len(preview) >= 4:
+                    break
+            fields["harmonic_progression_preview"] = " -> ".join(preview)
+
+        if self.num_bars:
+            per_bar = self.total_groups / self.num_bars
+            fields["rhythmic_density"] = "Baixa" if per_bar < 8 else "Média" if per_bar < 20 else "Alta"
+        if self.total_durations:
+            most_common = self.total_durations.most_common(1)[0][0]
+            duration_type = _DURATION_TYPES.get(most_common)
+            fields["rhythmic_pattern_summary"] = f"Predominância de {duration_type}s" if duration_type else f"Duração QL: {most_common}"
+
+        if self.last_notes is not None and len(self.last_notes):
+            # Pelo nome (grafia do parse MIDI do music21): com inteiros o Chord soletra 70 como A#
+            pitches = sorted(set(int(p) for p in self.last_notes['pitch']))
+            last_chord = chord.Chord([corpus.pitch_name(p) for p in pitches])
+            key_obj = None
+            if estimate is not None:
+                tonic, minor = estimate
+                key_obj = key.Key(corpus.PITCH_CLASS_NAMES[tonic], 'minor' if minor else 'major')
+            fields.update(final_chord_fields(last_chord, key_obj))
+
+        # Mudanças de tonalidade local (janelas de WINDOW_BARS compassos)
+        changes, previous = [], None
+        for w, k in enumerate(self.local_keys.tolist()):
+            if k >= 0 and k != previous:
+                changes.append({"bar": w + 1, "key": key_name(k)})
+                previous = k
+        fields["key_changes"] = changes
+        return fields
+
+    @staticmethod
+    def _chord_label(root, quality, piece_key):
+        """Grau romano relativo à tônica (ou o nome da raiz, sem tonalidade)."""
+        if piece_key < 0:
+            return f"{corpus.PITCH_CLASS_NAMES[root]} {quality}"
+        figure = _ROMAN[(root - piece_key % 12) % 12]
+        if quality in ("minor", "diminished"):
+            figure = figure.lower()
+        suffix = {"diminished": "°", "augmented": "+", "dominant-seventh": "7"}.get(quality, "")
+        return figure + suffix
+
+
+class AnalysisVersions:
+    """
+    Últimas versões analisadas por usuário, para casar um reenvio com a versão anterior:
+    primeiro pelo nome do arquivo, depois pela maior sobreposição de compassos.
+    """
+
+    def __init__(self, per_user=5, max_users=500, min_overlap=0.5):
+        self.per_user = per_user
+        self.max_users = max_users
+        self.min_overlap = min_overlap
+        self._lock = threading.Lock()
+        self._users = OrderedDict() # usuário -> deque de versões (mais recente por último)
+
+    def add(self, user, filename, version):
+        """'version' é um dict com file_hash, meta_key, bars (BarAnalysis), results e derived."""
+        version = dict(version, filename=filename, stored_at=time.time())
+        with self._lock:
+            versions = self._users.setdefault(user, deque(maxlen=self.per_user))
+            self._users.move_to_end(user)
+            for i, existing in enumerate(versions):
+                if existing["filename"] == filename:
+                    del versions[i]
+                    break
+            versions.append(version)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def match(self, user, filename, notes, meta_key):
+        """A versão anterior mais provável deste upload, ou None (mesmo andamento/compasso obrigatório)."""
+        with self._lock:
+            candidates = [v for v in self._users.get(user, ()) if v["meta_key"] == meta_key]
+        same_name = [v for v in candidates if v["filename"] == filename]
+        if same_name and same_name[-1]["bars"].overlap(notes) >= self.min_overlap:
+            return same_name[-1]
+        best, best_overlap = None, self.min_overlap
+        for version in candidates:
+            overlap = version["bars"].overlap(notes)
+            if overlap >= best_overlap:
+                best, best_overlap = version, overlap
+        return best
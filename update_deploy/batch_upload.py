@@ -0,0 +1,77 @@
+"""
+Upload em lote: vários MIDIs (ou arquivos .zip com MIDIs) numa só requisição.
+
+collect_batch_files() junta os arquivos enviados e abre os .zip, com limites de
+quantidade e de tamanho por arquivo (um .zip pode declarar um tamanho e
+descompactar outro, então a leitura também é limitada). BatchDeduper marca como
+duplicata os arquivos do lote com o mesmo hash de conteúdo de um anterior, que
+então só é analisado uma vez.
+
+O módulo não conhece Flask: a rota /batch/upload (app.py) analisa cada arquivo
+numa thread e devolve os resultados em NDJSON, na ordem em que ficam prontos.
+"""
+import io
+import zipfile
+import threading
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+
+def is_zip_upload(filename, content):
+    return (filename or "").lower().endswith('.zip') or content[:4] == b"PK\x03\x04"
+
+
+def collect_batch_files(uploads, max_files=50, max_file_bytes=5 * 1024 * 1024):
+    """
+    'uploads' é uma lista de (nome, conteúdo). Retorna (arquivos, ignorados): arquivos é a
+    lista de (nome, conteúdo) dos MIDIs, com os .zip abertos; ignorados traz uma linha de
+    resultado ({"filename", "status": "skipped", "message"}) para cada arquivo descartado.
+    Levanta ValueError se o lote passar de max_files MIDIs ou se um .zip for ilegível.
+    """
+    files, skipped = [], []
+
+    def add(filename, content):
+        if len(files) >= max_files:
+            raise ValueError(f"O lote passa do limite de {max_files} arquivos.")
+        files.append((filename, content))
+
+    for filename, content in uploads:
+        if not is_zip_upload(filename, content):
+            if len(content) > max_file_bytes:
+                skipped.append({"filename": filename, "status": "skipped", "message": "Arquivo grande demais."})
+            else:
+                add(filename, content)
+            continue
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(content))
+        except zipfile.BadZipFile:
+            raise ValueError(f"Arquivo zip inválido: {filename}")
+        with archive:
+            for member in archive.infolist():
+                name = member.filename
+                if member.is_dir() or name.startswith('__MACOSX/') or not name.lower().endswith(MIDI_EXTENSIONS):
+                    continue
+                if member.file_size > max_file_bytes:
+                    skipped.append({"filename": name, "status": "skipped", "message": "Arquivo grande demais."})
+                    continue
+                with archive.open(member) as f:
+                    data = f.read(max_file_bytes + 1)
+                if len(data) > max_file_bytes:
+                    skipped.append({"filename": name, "status": "skipped", "message": "Arquivo grande demais."})
+                    continue
+                add(name, data)
+    return files, skipped
+
+
+class BatchDeduper:
+    """Primeiro arquivo de cada hash de conteúdo no lote; os seguintes são duplicatas dele."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._first = {}   # hash -> (posição, nome) do primeiro arquivo
+
+    def claim(self, file_hash, index, filename):
+        """None se o arquivo na posição 'index' é o primeiro com este hash; senão o nome do primeiro."""
+        with self._lock:
+            first_index, first_name = self._first.setdefault(file_hash, (index, filename))
+        return None if first_index == index else first_name
@@ -0,0 +1,83 @@
+"""
+Mede o efeito da reserva (hedging.py) na latência das chamadas ao modelo, com o
+backend falso (fake_backend.py) e uma cauda de latência injetada.
+
+Roda --calls chamadas, --concurrency ao mesmo tempo, duas vezes com o mesmo
+modelo falso: sem reserva (só o prazo) e com reserva no quantil --quantile,
+orçamento --budget. Para cada modo mostra p50/p95/p99, quantas chamadas
+estouraram o prazo (e cairiam no gerador local) e quantas reservas foram
+disparadas e venceram.
+
+Uso:
+    python bench_hedging.py --calls 1000 --concurrency 16 --latency 0.2 --jitter 0.05 \\
+        --tail-probability 0.05 --tail-seconds 2 --deadline 1.5
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fake_backend import FakeGenerativeModel
+from hedging import HedgedCaller, CallDeadlineExceeded
+
+
+def run_mode(args, caller):
+    model = FakeGenerativeModel(latency=args.latency, jitter=args.jitter,
+                                tail_probability=args.tail_probability, tail_seconds=args.tail_seconds)
+
+    def one(_):
+        started = time.monotonic()
+        deadline = started + args.deadline
+
+        def attempt():
+            return model.generate_content("Último offset (tempo final): 0.0",
+                                          request_options={"timeout": max(0.01, deadline - time.monotonic())})
+        try:
+            caller.call(attempt, deadline)
+            fallback = False
+        except CallDeadlineExceeded:
+            fallback = True
+        return time.monotonic() - started, fallback
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one, range(args.calls)))
+    elapsed = time.perf_counter() - started
+    latencies = np.array([latency for latency, _ in results])
+    return latencies, sum(fallback for _, fallback in results), elapsed
+
+
+def report(name, latencies, fallbacks, elapsed, stats):
+    print(f"{name:<12} p50 {np.percentile(latencies, 50):.3f} s | p95 {np.percentile(latencies, 95):.3f} s | "
+          f"p99 {np.percentile(latencies, 99):.3f} s | prazo estourado {fallbacks} | "
+          f"reservas {stats['hedged']} (venceram {stats['hedge_wins']}, sem ficha {stats['budget_denied']}) | {elapsed:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência das chamadas ao modelo com e sem reserva (backend falso).")
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2, help="Latência base do modelo falso (s)")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--tail-probability", type=float, default=0.05, help="Fração das respostas na cauda")
+    parser.add_argument("--tail-seconds", type=float, default=2.0, help="Atraso extra das respostas na cauda (s)")
+    parser.add_argument("--deadline", type=float, default=1.5, help="Prazo de cada chamada (s)")
+    parser.add_argument("--quantile", type=float, default=0.9)
+    parser.add_argument("--budget", type=float, default=0.1)
+    args = parser.parse_args()
+
+    workers = 2 * args.concurrency + 8
+    modes = [
+        ("sem reserva", HedgedCaller(max_workers=workers, min_samples=args.calls + 1)),
+        ("com reserva", HedgedCaller(max_workers=workers, hedge_quantile=args.quantile, hedge_budget=args.budget)),
+    ]
+    print(f"{args.calls} chamadas, concorrência {args.concurrency}, latência {args.latency} s "
+          f"+ cauda de {args.tail_seconds} s em {args.tail_probability:.0%}, prazo {args.deadline} s")
+    for name, caller in modes:
+        latencies, fallbacks, elapsed = run_mode(args, caller)
+        report(name, latencies, fallbacks, elapsed, caller.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Modo de múltiplos candidatos: pontuação rápida e seleção do melhor de N.
+
+O backend gera N continuações numa única chamada (variantes no mesmo prompt do
+Gemini, ou N amostras do motor Markov) e score_candidates avalia todas de uma
+vez, com as notas de todos os candidatos numa única tabela (ver corpus.NOTE_DTYPE)
+e agregações por candidato via np.bincount / ufunc.at:
+
+  - key_fit:    fração da duração das notas dentro da escala da tonalidade detectada;
+  - continuity: o primeiro evento deve começar em last_offset (nem antes, nem muito depois);
+  - range:      sobreposição da tessitura do candidato com a do trecho original;
+  - density:    notas por quarterLength comparadas com as do trecho original;
+  - cadence:    o acorde final deve criar expectativa (dominante), não repousar na tônica.
+"""
+import json
+
+import numpy as np
+
+import corpus
+
+# Graus da escala relativos à tônica (menor inclui a sensível da menor harmônica)
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+MINOR_SCALE = (0, 2, 3, 5, 7, 8, 10, 11)
+# Notas da tríade de dominante (V): quinta, sensível e segundo grau
+DOMINANT_DEGREES = (7, 11, 2)
+
+WEIGHTS = {"key_fit": 0.3, "continuity": 0.2, "range": 0.2, "density": 0.15, "cadence": 0.15}
+
+
+def parse_candidates(text):
+    """
+    Extrai a lista de candidatos de uma resposta JSON: {"variants": [...]}, uma lista,
+    ou um único objeto {"right_hand", "left_hand"} (quando o modelo ignora o pedido de variantes).
+    """
+    data = json.loads(text)
+    if isinstance(data, dict) and isinstance(data.get("variants"), list):
+        data = data["variants"]
+    elif isinstance(data, dict):
+        data = [data]
+    return [c for c in data if isinstance(c, dict) and ("right_hand" in c or "left_hand" in c)]
+
+
+def candidate_notes(candidate):
+    """Tabela de notas das duas mãos de um candidato (part 0 = direita, 1 = esquerda)."""
+    return np.concatenate((
+        corpus.events_to_notes(candidate.get("right_hand") or [], part=0),
+        corpus.events_to_notes(candidate.get("left_hand") or [], part=1),
+    ))
+
+
+def reference_profile(music_text_rh, music_text_lh):
+    """Tessitura e densidade do trecho original (os mesmos textos enviados ao gerador)."""
+    notes = candidate_notes({"right_hand": music_text_rh and json.loads(music_text_rh),
+                             "left_hand": music_text_lh and json.loads(music_text_lh)})
+    if not len(notes):
+        return {"low": 48, "high": 84, "density": 2.0, "notes": notes}
+    span = float((notes['onset'] + notes['duration']).max() - notes['onset'].min())
+    return {
+        "low": int(notes['pitch'].min()), "high": int(notes['pitch'].max()),
+        "density": len(notes) / max(span, 1.0), "notes": notes,
+    }
+
+
+def score_candidates(candidates, reference, last_offset, tonic, minor=False):
+    """
+    Pontua todos os candidatos de uma vez. Retorna um dict de arrays (um valor por
+    candidato) com cada critério em [0, 1] e o total ponderado em "score".
+    """
+    n = len(candidates)
+    tables = [candidate_notes(c) for c in candidates]
+    counts = np.array([len(t) for t in tables])
+    idx = np.repeat(np.arange(n), counts)
+    notes = np.concatenate(tables) if n else np.zeros(0, dtype=corpus.NOTE_DTYPE)
+
+    onset = notes['onset']
+    duration = np.maximum(notes['duration'].astype(np.float64), 1e-3)
+    end = onset + duration
+    pitch = notes['pitch'].astype(np.int64)
+    degree = (pitch - tonic) % 12
+
+    # Tonalidade: duração dentro da escala / duração total
+    scale = np.zeros(12, dtype=bool)
+    scale[list(MINOR_SCALE if minor else MAJOR_SCALE)] = True
+    total_duration = np.bincount(idx, weights=duration, minlength=n)
+    key_fit = np.bincount(idx, weights=duration * scale[degree], minlength=n) / np.maximum(total_duration, 1e-9)
+
+    # Continuidade: distância do primeiro evento a last_offset, mais a fração de notas antes dele
+    first = np.full(n, np.inf)
+    np.minimum.at(first, idx, onset)
+    last_end = np.full(n, -np.inf)
+    np.maximum.at(last_end, idx, end)
+    early = np.bincount(idx, weights=(onset < last_offset - 1e-6), minlength=n) / np.maximum(counts, 1)
+    continuity = np.exp(-np.abs(first - last_offset)) * (1.0 - early)
+
+    # Tessitura: interseção / união dos intervalos de altura
+    low = np.full(n, 127)
+    np.minimum.at(low, idx, pitch)
+    high = np.zeros(n, dtype=np.int64)
+    np.maximum.at(high, idx, pitch)
+    overlap = np.minimum(high, reference["high"]) - np.maximum(low, reference["low"]) + 1
+    union = np.maximum(high, reference["high"]) - np.minimum(low, reference["low"]) + 1
+    range_fit = np.clip(overlap, 0, None) / union
+
+    # Densidade: razão entre a menor e a maior (1 = mesma densidade do original)
+    density = counts / np.maximum(last_end - first, 1.0)
+    density_fit = np.minimum(density, reference["density"]) / np.maximum(np.maximum(density, reference["density"]), 1e-9)
+
+    # Cadência: notas soando no fim; penaliza baixo na tônica (a regra do prompt pede a dominante)
+    final = end >= last_end[idx] - 0.25
+    dominant = np.zeros(12, dtype=bool)
+    dominant[list(DOMINANT_DEGREES)] = True
+    final_count = np.bincount(idx, weights=final, minlength=n)
+    cadence = np.bincount(idx, weights=final & dominant[degree], minlength=n) / np.maximum(final_count, 1)
+    final_bass = np.full(n, 127)
+    np.minimum.at(final_bass, idx[final], pitch[final])
+    cadence = np.where((final_bass - tonic) % 12 == 0, cadence * 0.25, cadence)
+
+    scores = {"key_fit": key_fit, "continuity": continuity, "range": range_fit,
+              "density": density_fit, "cadence": cadence}
+    total = sum(WEIGHTS[name] * values for name, values in scores.items())
+    scores["score"] = np.where(counts > 0, total, 0.0) # Candidato sem notas nunca é escolhido
+    return scores
+
+
+def rank_candidates(candidates, reference, last_offset, tonic, minor=False):
+    """Ordena os candidatos do melhor para o pior. Retorna (ordem, pontuações por candidato)."""
+    scores = score_candidates(candidates, reference, last_offset, tonic, minor)
+    order = [int(i) for i in np.argsort(-scores["score"], kind='stable')]
+    details = [{name: round(float(values[i]), 3) for name, values in scores.items()} for i in range(len(candidates))]
+    return order, details
@@ -0,0 +1,326 @@
+"""
+Leitura dos corpora MIDI de Datasets/ diretamente dos arquivos zip.
+
+Os jobs em lote (índices, treinamento, etc.) não usam o music21: o parse
+com o Mido é ordens de grandeza mais rápido e suficiente para extrair uma
+tabela de notas. A função notes_to_events gera eventos no mesmo formato
+de midi_stream_to_text (app.py), usado nos prompts.
+"""
+import io
+import json
+import os
+import glob
+import hashlib
+import zipfile
+
+import numpy as np
+try:
+    import xxhash # Opcional: hash não criptográfico mais rápido para as impressões digitais
+except ImportError:
+    xxhash = None
+from mido import MidiFile as MidoMidiFile, MidiTrack, Message, MetaMessage, bpm2tempo
+
+DATASETS_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Datasets'))
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+# Canal 10 (índice 9) é reservado para percussão no General MIDI
+DRUM_CHANNEL = 9
+
+# Grade de quantização dos offsets (em quarterLength), semelhante à do music21 (divisores 4 e 3)
+QUANTIZE_GRID = 1.0 / 12.0
+
+# Grafia das alturas igual à do music21 para inteiros MIDI (ex: 61 -> C#4, 70 -> B-4)
+PITCH_CLASS_NAMES = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+
+# Tabela de notas: uma linha por nota, tempos em quarterLength
+NOTE_DTYPE = np.dtype([
+    ('onset', 'f8'), ('duration', 'f4'), ('pitch', 'i2'), ('velocity', 'i2'), ('part', 'i2'),
+])
+
+
+def list_archives(datasets_dir=DATASETS_DIR):
+    """Lista os arquivos zip de Datasets/ em ordem estável."""
+    return sorted(glob.glob(os.path.join(datasets_dir, '*.zip')))
+
+
+def source_id(archive_path, member_name):
+    """Identificador estável de um arquivo do corpus: '<zip>::<caminho interno>'."""
+    return f"{os.path.basename(archive_path)}::{member_name}"
+
+
+def split_source_id(sid):
+    """Inverso de source_id: retorna (nome do zip, caminho interno)."""
+    archive_name, _, member_name = sid.partition('::')
+    return archive_name, member_name
+
+
+def iter_archive_members(archive_paths=None):
+    """
+    Percorre os membros MIDI dos arquivos zip sem lê-los.
+    Gera tuplas (archive_path, ZipInfo).
+    """
+    if archive_paths is None:
+        archive_paths = list_archives()
+    for archive_path in archive_paths:
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(MIDI_EXTENSIONS):
+                    continue
+                yield archive_path, info
+
+
+def read_member(archive_path, member_name):
+    """Lê os bytes de um único membro do zip (usado pelos workers paralelos)."""
+    with zipfile.ZipFile(archive_path) as zf:
+        return zf.read(member_name)
+
+
+def iter_corpus_midis(archive_paths=None):
+    """
+    Lê os MIDIs do corpus em streaming, um zip aberto por vez.
+    Gera tuplas (source_id, bytes).
+    """
+    if archive_paths is None:
+        archive_paths = list_archives()
+    for archive_path in archive_paths:
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(MIDI_EXTENSIONS):
+                    continue
+                yield source_id(archive_path, info.filename), zf.read(info)
+
+
+def extract_notes(midi_bytes):
+    """
+    Converte bytes MIDI em uma tabela de notas (array estruturado NOTE_DTYPE),
+    ordenada por onset e altura. Percussão e eventos meta são ignorados.
+    Retorna (notes, meta), onde meta traz ticks_per_beat, andamentos e compassos.
+    """
+    mid = MidoMidiFile(file=io.BytesIO(midi_bytes))
+    tpb = float(mid.ticks_per_beat or 480)
+
+    rows = []
+    drum_rows = []
+    tempos = []
+    time_signatures = []
+    for track_idx, track in enumerate(mid.tracks):
+        abs_tick = 0
+        open_notes = {} # (canal, altura) -> lista de (tick inicial, velocity, parte)
+        for msg in track:
+            abs_tick += msg.time
+            if msg.type == 'set_tempo':
+                tempos.append((abs_tick / tpb, 60_000_000.0 / msg.tempo))
+            elif msg.type == 'time_signature':
+                time_signatures.append((abs_tick / tpb, msg.numerator, msg.denominator))
+            elif msg.type in ('note_on', 'note_off'):
+                if msg.channel == DRUM_CHANNEL:
+                    if msg.type == 'note_on' and msg.velocity > 0:
+                        drum_rows.append((abs_tick / tpb, 0.0, msg.note, msg.velocity, track_idx))
+                    continue
+                # Em MIDI tipo 0 todas as vozes estão numa faixa: usa o canal como parte
+                part = track_idx if mid.type != 0 else msg.channel
+                slot = (msg.channel, msg.note)
+                if msg.type == 'note_on' and msg.velocity > 0:
+                    open_notes.setdefault(slot, []).append((abs_tick, msg.velocity, part))
+                elif open_notes.get(slot):
+                    start_tick, velocity, part = open_notes[slot].pop(0)
+                    if abs_tick > start_tick:
+                        rows.append((start_tick / tpb, (abs_tick - start_tick) / tpb, msg.note, velocity, part))
+
+    notes = np.array(rows, dtype=NOTE_DTYPE)
+    if len(notes):
+        notes['onset'] = np.round(notes['onset'] / QUANTIZE_GRID) * QUANTIZE_GRID
+        notes['duration'] = np.maximum(np.round(notes['duration'] / QUANTIZE_GRID) * QUANTIZE_GRID, QUANTIZE_GRID)
+        notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+
+    meta = {
+        "ticks_per_beat": int(tpb),
+        "tempos": sorted(tempos),
+        "time_signatures": sorted(time_signatures),
+        "drum_hits": np.array(drum_rows, dtype=NOTE_DTYPE), # Só para a impressão digital
+    }
+    return notes, meta
+
+
+def canonical_fingerprint(notes, meta):
+    """
+    Impressão digital canônica de um MIDI a partir de extract_notes: o mesmo conteúdo
+    musical exportado com outro nome de faixa, eventos meta, running status ou resolução
+    de ticks dá o mesmo valor. Entra tudo o que a análise e o prompt usam: onsets
+    absolutos e durações na grade de quantização, altura, velocity, agrupamento em
+    partes (pela ordem das faixas, ignorando faixas sem notas), andamentos, compassos
+    e percussão. Retorna hex de 32 caracteres (xxh3-128, ou blake2b sem o xxhash).
+    """
+    def steps(table):
+        part_rank = np.unique(table['part'], return_inverse=True)[1].reshape(-1)
+        rows = np.stack((
+            np.round(table['onset'] / QUANTIZE_GRID), np.round(table['duration'] / QUANTIZE_GRID),
+            table['pitch'], table['velocity'], part_rank,
+        ), axis=1).astype(np.int64)
+        return rows[np.lexsort(rows.T[::-1])]
+
+    # Andamentos e compassos repetidos (ex: o mesmo set_tempo em várias faixas) contam uma vez
+    tempos, last_bpm = [], None
+    for offset, bpm in sorted(set((round(o / QUANTIZE_GRID), round(b, 3)) for o, b in meta["tempos"])):
+        if bpm != last_bpm:
+            tempos.append((offset, bpm))
+            last_bpm = bpm
+    time_signatures, last_ts = [], None
+    for offset, numerator, denominator in sorted(set((round(o / QUANTIZE_GRID), n, d) for o, n, d in meta["time_signatures"])):
+        if (numerator, denominator) != last_ts:
+            time_signatures.append((offset, numerator, denominator))
+            last_ts = (numerator, denominator)
+
+    payload = b"".join((
+        steps(notes).tobytes(), b"|", steps(meta.get("drum_hits", notes[:0])).tobytes(), b"|",
+        repr((tempos, time_signatures)).encode(),
+    ))
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(payload)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def notes_to_midi(tracks, bpm=120, numerator=4, denominator=4, ticks_per_beat=480):
+    """
+    Inverso de extract_notes: grava tabelas de notas (uma por faixa) num MidiFile
+    tipo 1, com andamento e compasso na primeira faixa.
+    """
+    mid = MidoMidiFile(type=1, ticks_per_beat=ticks_per_beat)
+    for track_idx, notes in enumerate(tracks):
+        track = MidiTrack()
+        mid.tracks.append(track)
+        if track_idx == 0:
+            track.append(MetaMessage('set_tempo', tempo=bpm2tempo(bpm), time=0))
+            track.append(MetaMessage('time_signature', numerator=numerator, denominator=denominator, time=0))
+        if notes is None or not len(notes):
+            continue
+        channel = track_idx % 16
+        if channel == DRUM_CHANNEL:
+            channel += 1
+        starts = np.round(notes['onset'] * ticks_per_beat).astype(np.int64)
+        ends = np.maximum(np.round((notes['onset'] + notes['duration']) * ticks_per_beat).astype(np.int64), starts + 1)
+        # note_off antes de note_on no mesmo tick, para notas repetidas não se sobreporem
+        events = sorted(
+            [(int(t), 0, int(p), 0) for t, p in zip(ends, notes['pitch'])] +
+            [(int(t), 1, int(p), int(v)) for t, p, v in zip(starts, notes['pitch'], notes['velocity'])]
+        )
+        last_tick = 0
+        for tick, is_on, midi_pitch, velocity in events:
+            kind = 'note_on' if is_on else 'note_off'
+            track.append(Message(kind, channel=channel, note=midi_pitch, velocity=velocity, time=tick - last_tick))
+            last_tick = tick
+    return mid
+
+
+def pitch_name(midi_pitch):
+    """Nome com oitava no formato do music21 (nameWithOctave)."""
+    midi_pitch = int(midi_pitch)
+    return f"{PITCH_CLASS_NAMES[midi_pitch % 12]}{midi_pitch // 12 - 1}"
+
+
+def split_hands(notes):
+    """
+    Equivalente a separate_piano_parts (app.py) para a tabela de notas:
+    com duas ou mais partes, usa as duas primeiras e compara as alturas médias.
+    Retorna (rh_notes, lh_notes); lh_notes pode ser None.
+    """
+    parts = np.unique(notes['part']) if len(notes) else []
+    if len(parts) < 2:
+        return notes, None
+    part1 = notes[notes['part'] == parts[0]]
+    part2 = notes[notes['part'] == parts[1]]
+    if part1['pitch'].mean() > part2['pitch'].mean():
+        return part1, part2
+    return part2, part1
+
+
+def dominant_pitch_class(notes):
+    """Classe de altura com maior duração acumulada (aproximação da tônica)."""
+    if notes is None or not len(notes):
+        return 0
+    chroma = np.bincount(notes['pitch'].astype(np.int64) % 12, weights=notes['duration'], minlength=12)
+    return int(chroma.argmax())
+
+
+def notes_to_events(notes, limit=None):
+    """
+    Converte uma tabela de notas (de uma mão) em eventos no formato de
+    midi_stream_to_text: notas simultâneas viram acordes e lacunas viram pausas.
+    Com 'limit', retorna apenas os últimos eventos.
+    """
+    events = []
+    if notes is None or not len(notes):
+        return events
+
+    onsets = notes['onset']
+    # Índices onde começa um novo grupo de onset
+    boundaries = np.flatnonzero(np.diff(onsets) > 1e-6) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(notes)]))
+
+    cursor = float(onsets[0])
+    for start, end in zip(starts, ends):
+        group = notes[start:end]
+        offset = float(group['onset'][0])
+        if offset - cursor > 1e-6:
+            events.append({"type": "rest", "offset": round(cursor, 4), "quarterLength": round(offset - cursor, 4)})
+        quarter_length = round(float(group['duration'].max()), 4)
+        velocity = int(round(float(group['velocity'].mean())))
+        if len(group) == 1:
+            events.append({"type": "note", "pitch": pitch_name(group['pitch'][0]), "offset": round(offset, 4),
+                           "quarterLength": quarter_length, "velocity": velocity})
+        else:
+            pitches = sorted(set(int(p) for p in group['pitch']))
+            events.append({"type": "chord", "pitches": [pitch_name(p) for p in pitches], "offset": round(offset, 4),
+                           "quarterLength": quarter_length, "velocity": velocity})
+        cursor = max(cursor, offset + quarter_length)
+
+    if limit is not None:
+        events = events[-limit:]
+    return events
+
+
+def events_to_notes(events, part=0):
+    """
+    Inverso de notes_to_events: converte eventos no formato de midi_stream_to_text
+    (lista de dicts ou texto JSON) em uma tabela de notas. Pausas são descartadas.
+    """
+    if isinstance(events, str):
+        events = json.loads(events) if events.strip() else []
+    rows = []
+    for ev in events or []:
+        ev_type = ev.get("type")
+        if ev_type == "note":
+            names = [ev.get("pitch")]
+        elif ev_type == "chord":
+            names = ev.get("pitches") or []
+        else:
+            continue
+        try:
+            offset = float(ev.get("offset", 0.0))
+            duration = float(ev.get("quarterLength", 1.0))
+            velocity = int(ev.get("velocity", 80))
+            for name in names:
+                rows.append((offset, duration, pitch_number(name), velocity, part))
+        except (TypeError, ValueError, KeyError):
+            continue # Evento malformado: ignora
+    notes = np.array(rows, dtype=NOTE_DTYPE)
+    if len(notes):
+        notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+    return notes
+
+
+_STEP_SEMITONES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+_ACCIDENTALS = {'#': 1, '-': -1, 'b': -1, '♯': 1, '♭': -1}
+
+
+def pitch_number(name):
+    """Converte um nome de altura do music21 (ex: 'C#4', 'B-3') no número MIDI."""
+    name = name.strip()
+    step = _STEP_SEMITONES[name[0].upper()]
+    i = 1
+    while i < len(name) and name[i] in _ACCIDENTALS:
+        step += _ACCIDENTALS[name[i]]
+        i += 1
+    octave = int(name[i:]) if i < len(name) else 4 # Sem oitava: music21 assume a 4ª
+    return (octave + 1) * 12 + step
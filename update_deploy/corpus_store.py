@@ -0,0 +1,164 @@
+"""
+Armazenamento deduplicado e endereçado por conteúdo dos corpora de Datasets/.
+
+Os zips "archive (2).zip" (data/) e "archive (3).zip" (midi_songs/) trazem
+os mesmos arquivos com nomes de pasta diferentes. A ingestão identifica
+duplicatas de duas formas:
+  - hash exato dos bytes (SHA-256);
+  - impressão digital do conteúdo de notas (onset, duração e altura,
+    ignorando andamento, velocity, faixas e eventos meta).
+
+Cada peça única é gravada uma única vez em objects/<id[:2]>/<id>.mid, e o
+manifest.json mapeia cada caminho original ('<zip>::<membro>') para o id de
+conteúdo. Os jobs em lote (similarity, phrase_index, markov, shards) usam
+iter_unique_members para percorrer apenas conteúdo único.
+
+Uso:
+    python corpus_store.py ingest [--workers N]
+    python corpus_store.py stats
+"""
+import os
+import json
+import hashlib
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import corpus
+
+logger = logging.getLogger(__name__)
+
+CORPUS_STORE_DIR = os.getenv(
+    "CORPUS_STORE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus_index', 'store')
+)
+
+
+def note_fingerprint(notes):
+    """
+    Impressão digital do conteúdo de notas: (onset, duração, altura) na grade de
+    quantização, relativos à primeira nota e ordenados. Retorna hex de 32 caracteres.
+    """
+    if not len(notes):
+        return None
+    steps = np.stack((
+        np.round((notes['onset'] - notes['onset'].min()) / corpus.QUANTIZE_GRID),
+        np.round(notes['duration'] / corpus.QUANTIZE_GRID),
+        notes['pitch'],
+    ), axis=1).astype(np.int32)
+    steps = steps[np.lexsort(steps.T[::-1])]
+    return hashlib.blake2b(steps.tobytes(), digest_size=16).hexdigest()
+
+
+def _hash_member(task):
+    """Worker da ingestão paralela: (sha256, impressão digital de notas ou None)."""
+    archive_path, member_name = task
+    data = corpus.read_member(archive_path, member_name)
+    sha256 = hashlib.sha256(data).hexdigest()
+    try:
+        notes, _ = corpus.extract_notes(data)
+        return sha256, note_fingerprint(notes)
+    except Exception as e:
+        logger.warning(f"Falha ao ler notas de {member_name} de {archive_path}: {e}")
+        return sha256, None
+
+
+def load_manifest(store_dir=CORPUS_STORE_DIR):
+    """Manifesto do armazenamento; vazio se ainda não houve ingestão."""
+    path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {"paths": {}, "objects": {}}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def object_path(content_id, store_dir=CORPUS_STORE_DIR):
+    return os.path.join(store_dir, 'objects', content_id[:2], f"{content_id}.mid")
+
+
+def ingest(archive_paths=None, store_dir=CORPUS_STORE_DIR, workers=None):
+    """
+    Ingere os zips no armazenamento. Membros já ingeridos com o mesmo CRC são pulados.
+    Retorna (novos caminhos, novos objetos).
+    """
+    manifest = load_manifest(store_dir)
+    paths, objects = manifest["paths"], manifest["objects"]
+    by_sha = {obj["sha256"]: cid for cid, obj in objects.items()}
+
+    pending = []
+    for archive_path, info in corpus.iter_archive_members(archive_paths):
+        sid = corpus.source_id(archive_path, info.filename)
+        if paths.get(sid, {}).get("crc") != info.CRC:
+            pending.append((sid, info.CRC, (archive_path, info.filename)))
+
+    new_objects = 0
+    if pending:
+        logger.info(f"Ingerindo {len(pending)} arquivos...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for (sid, crc, task), (sha256, fingerprint) in zip(pending, pool.map(_hash_member, [t for _, _, t in pending], chunksize=8)):
+                # Duplicata exata, depois duplicata de conteúdo; sem notas legíveis, o id é o próprio SHA-256
+                content_id = by_sha.get(sha256) or fingerprint or sha256
+                if content_id not in objects:
+                    blob_path = object_path(content_id, store_dir)
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    with open(blob_path + ".tmp", 'wb') as f:
+                        f.write(corpus.read_member(*task))
+                    os.replace(blob_path + ".tmp", blob_path)
+                    objects[content_id] = {"sha256": sha256, "first_source": sid, "has_notes": fingerprint is not None}
+                    by_sha[sha256] = content_id
+                    new_objects += 1
+                paths[sid] = {"content_id": content_id, "crc": crc}
+
+    os.makedirs(store_dir, exist_ok=True)
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+    with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    logger.info(f"Armazenamento: {len(paths)} caminhos -> {len(objects)} peças únicas ({new_objects} novas).")
+    return len(pending), new_objects
+
+
+def iter_unique_members(archive_paths=None, store_dir=CORPUS_STORE_DIR):
+    """
+    Como corpus.iter_archive_members, mas gera cada conteúdo uma única vez.
+    Usa o id de conteúdo do manifesto quando o membro já foi ingerido (com o mesmo CRC);
+    caso contrário, deduplica pelo par (CRC, tamanho) do zip, que detecta cópias exatas.
+    """
+    paths = load_manifest(store_dir)["paths"]
+    seen = set()
+    for archive_path, info in corpus.iter_archive_members(archive_paths):
+        entry = paths.get(corpus.source_id(archive_path, info.filename))
+        if entry and entry["crc"] == info.CRC:
+            key = entry["content_id"]
+        else:
+            key = (info.CRC, info.file_size)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield archive_path, info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Armazenamento deduplicado dos corpora MIDI.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_ingest = sub.add_parser("ingest", help="Ingere Datasets/*.zip no armazenamento")
+    p_ingest.add_argument("--datasets", default=corpus.DATASETS_DIR)
+    p_ingest.add_argument("--store", default=CORPUS_STORE_DIR)
+    p_ingest.add_argument("--workers", type=int, default=None)
+    p_stats = sub.add_parser("stats", help="Mostra quantos caminhos e peças únicas existem")
+    p_stats.add_argument("--store", default=CORPUS_STORE_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "ingest":
+        ingest(corpus.list_archives(args.datasets), args.store, args.workers)
+    else:
+        manifest = load_manifest(args.store)
+        print(f"{len(manifest['paths'])} caminhos, {len(manifest['objects'])} peças únicas.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Backend de geração falso, local, para testes de carga (GENERATION_BACKEND=fake).
+
+FakeGenerativeModel imita a interface usada do GenerativeModel
+(generate_content e generate_content_async, resposta com .text): espera uma
+latência configurável, como a API remota, e responde com uma continuação
+válida (arpejo na mão direita, baixo na esquerda) a partir do "Último offset"
+do prompt, em cercas ```json. Respeita o formato de variantes do melhor de N;
+cada variante sai de uma semente própria (prompt, índice), então os N candidatos
+diferem (e as pontuações também).
+
+Latência: FAKE_GENERATION_LATENCY_SECONDS (padrão 2.0) mais um valor uniforme
+em [0, FAKE_GENERATION_JITTER_SECONDS] (padrão 0.5). Para simular a cauda da API,
+uma fração FAKE_GENERATION_TAIL_PROBABILITY das respostas (padrão 0) demora
+FAKE_GENERATION_TAIL_SECONDS a mais (padrão 10). O request_options={"timeout": s}
+do cliente real é respeitado: passou do tempo, levanta TimeoutError. Uma fração
+FAKE_GENERATION_MALFORMED_PROBABILITY das respostas (padrão 0) vem estragada,
+como as do modelo real: cortada num ponto qualquer ou com vírgulas sobrando.
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+
+FAKE_GENERATION_LATENCY_SECONDS = float(os.getenv("FAKE_GENERATION_LATENCY_SECONDS", "2.0"))
+FAKE_GENERATION_JITTER_SECONDS = float(os.getenv("FAKE_GENERATION_JITTER_SECONDS", "0.5"))
+FAKE_GENERATION_TAIL_PROBABILITY = float(os.getenv("FAKE_GENERATION_TAIL_PROBABILITY", "0"))
+FAKE_GENERATION_TAIL_SECONDS = float(os.getenv("FAKE_GENERATION_TAIL_SECONDS", "10"))
+FAKE_GENERATION_MALFORMED_PROBABILITY = float(os.getenv("FAKE_GENERATION_MALFORMED_PROBABILITY", "0"))
+
+_ARPEGGIO = ['C5', 'E5', 'G5', 'E5', 'D5', 'F5', 'A5', 'B4']
+_BASS = ['C3', 'G2', 'D3', 'G2']
+
+
+class _FakeResponse:
+
+    def __init__(self, text):
+        self.text = text
+
+
+def _transpose(name, octaves):
+    return name[:-1] + str(int(name[-1]) + octaves)
+
+
+def _continuation(start, rng):
+    """Uma continuação; rotação do arpejo, oitava, ritmo e ordem do baixo variam com 'rng'."""
+    shift = rng.randrange(len(_ARPEGGIO))
+    octaves = rng.choice((-1, 0, 0, 1))
+    step = rng.choice((0.25, 0.5, 0.5, 1.0))
+    arpeggio = _ARPEGGIO[shift:] + _ARPEGGIO[:shift]
+    right_hand = [{"type": "note", "pitch": _transpose(p, octaves), "offset": start + step * i, "quarterLength": step,
+                   "velocity": rng.randint(60, 90)} for i, p in enumerate(arpeggio)]
+    left_hand = [{"type": "note", "pitch": p, "offset": start + 1.0 * i, "quarterLength": 1.0,
+                  "velocity": rng.randint(50, 70)} for i, p in enumerate(rng.sample(_BASS, len(_BASS)))]
+    return {"right_hand": right_hand, "left_hand": left_hand}
+
+
+def _variant_rng(prompt, index):
+    """Gerador da variante 'index' do prompt: determinístico (inclusive entre processos) e distinto por variante."""
+    return random.Random(f"{index}:{prompt}")
+
+
+class FakeGenerativeModel:
+
+    def __init__(self, model_name="fake", latency=None, jitter=None, tail_probability=None, tail_seconds=None):
+        self.model_name = model_name
+        self.latency = FAKE_GENERATION_LATENCY_SECONDS if latency is None else latency
+        self.jitter = FAKE_GENERATION_JITTER_SECONDS if jitter is None else jitter
+        self.tail_probability = FAKE_GENERATION_TAIL_PROBABILITY if tail_probability is None else tail_probability
+        self.tail_seconds = FAKE_GENERATION_TAIL_SECONDS if tail_seconds is None else tail_seconds
+        self.malformed_probability = FAKE_GENERATION_MALFORMED_PROBABILITY
+
+    def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if random.random() < self.tail_probability:
+            delay += self.tail_seconds
+        return delay
+
+    @staticmethod
+    def _timeout(request_options):
+        return (request_options or {}).get("timeout")
+
+    def _response(self, prompt):
+        match = re.search(r'Último offset \(tempo final\): ([0-9.]+)', prompt)
+        start = float(match.group(1)) if match else 0.0
+        variants = re.search(r'uma lista com (\d+) continuações', prompt)
+        if variants:
+            data = {"variants": [_continuation(start, _variant_rng(prompt, i)) for i in range(int(variants.group(1)))]}
+        else:
+            data = _continuation(start, _variant_rng(prompt, 0))
+        text = json.dumps(data, indent=2)
+        if random.random() < self.malformed_probability:
+            if random.random() < 0.5:
+                return _FakeResponse("```json\n" + text[:random.randint(len(text) // 3, len(text) - 1)])
+            text = text.replace("}\n", "},\n")
+        return _FakeResponse("```json\n" + text + "\n```")
+
+    def generate_content(self, prompt, generation_config=None, request_options=None):
+        delay, timeout = self._delay(), self._timeout(request_options)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Sem resposta em {timeout:g} s.")
+        time.sleep(delay)
+        return self._response(prompt)
+
+    async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+        delay, timeout = self._delay(), self._timeout(request_options)
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            raise TimeoutError(f"Sem resposta em {timeout:g} s.")
+        await asyncio.sleep(delay)
+        return self._response(prompt)
@@ -0,0 +1,218 @@
+"""
+Chamadas ao modelo com prazo e pedido de reserva ("hedging"), para cortar a cauda da latência.
+
+Uma chamada única ao modelo demora o que a resposta mais lenta demorar: o p99
+é o da API. Aqui cada chamada tem um prazo e, se a primeira tentativa não
+respondeu até o quantil hedge_quantile (p90) das latências recentes, uma
+segunda tentativa igual é disparada; vale a que terminar primeiro. Se o prazo
+passa sem resposta, CallDeadlineExceeded avisa o chamador, que cai no gerador
+local.
+
+O número de tentativas extras é limitado por um orçamento: cada chamada rende
+hedge_budget fichas (0.1 = no máximo ~10% de tentativas a mais), acumuladas até
+hedge_burst; cada tentativa extra gasta uma ficha. Assim uma API lenta como um
+todo não recebe o dobro de carga.
+
+As latências vêm de todas as tentativas que terminam, inclusive as que
+perderam, falharam ou passaram do prazo (estas continuam rodando numa thread
+até terminar ou estourar o timeout do cliente; com call_async, a perdedora é
+cancelada e não conta). Enquanto não há
+min_samples latências, a espera até a reserva é initial_hedge_delay (None: sem
+reserva).
+
+Com o controle de admissão (admission.py), cada tentativa ocupa uma vaga
+(context manager) do início até terminar de fato: a primeira usa a vaga dada
+em 'slot'; a reserva pede outra a 'acquire_slot' e não sai sem vaga livre.
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class CallDeadlineExceeded(Exception):
+    """Nenhuma tentativa respondeu até o prazo."""
+
+
+class HedgedCaller:
+
+    def __init__(self, max_workers=16, hedge_quantile=0.9, hedge_budget=0.1, hedge_burst=3, initial_hedge_delay=None,
+                 min_samples=20, window=200):
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.hedge_burst = hedge_burst
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._tokens = float(hedge_burst)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-call")
+        self.stats_counters = {"calls": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0, "slot_denied": 0,
+                               "deadline_exceeded": 0, "failed": 0}
+
+    # --- Latências e orçamento ---
+
+    def _record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _quantile(self, q):
+        """Quantil das latências recentes (chamar com o lock); None com poucas amostras."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def _begin(self):
+        """Conta a chamada, rende as fichas do orçamento e retorna a espera até a reserva (ou None)."""
+        with self._lock:
+            self.stats_counters["calls"] += 1
+            self._tokens = min(float(self.hedge_burst), self._tokens + self.hedge_budget)
+            hedge_delay = self._quantile(self.hedge_quantile)
+        return self.initial_hedge_delay if hedge_delay is None else hedge_delay
+
+    def _take_hedge(self, acquire_slot):
+        """Ficha do orçamento e vaga da reserva: retorna (True, vaga ou None) ou (False, None)."""
+        with self._lock:
+            if self._tokens < 1:
+                self.stats_counters["budget_denied"] += 1
+                return False, None
+            self._tokens -= 1
+        slot = acquire_slot() if acquire_slot is not None else None
+        with self._lock:
+            if acquire_slot is not None and slot is None:
+                self._tokens += 1   # Sem vaga: devolve a ficha
+                self.stats_counters["slot_denied"] += 1
+                return False, None
+            self.stats_counters["hedged"] += 1
+        return True, slot
+
+    def _finish(self, counter):
+        with self._lock:
+            self.stats_counters[counter] += 1
+
+    def _next_timeout(self, started, hedge_delay, hedged, deadline):
+        """Quanto esperar pela próxima tentativa: até o ponto da reserva (se ainda não disparada) ou o prazo."""
+        now = time.monotonic()
+        timeout = None if deadline is None else max(0.0, deadline - now)
+        if not hedged and hedge_delay is not None:
+            until_hedge = max(0.0, started + hedge_delay - now)
+            timeout = until_hedge if timeout is None else min(timeout, until_hedge)
+        return timeout
+
+    def _hedge_due(self, started, hedge_delay, hedged):
+        return not hedged and hedge_delay is not None and time.monotonic() >= started + hedge_delay
+
+    def _raise_failure(self, error, deadline):
+        """Todas as tentativas falharam; se o prazo já passou (ex: timeout do cliente), conta como prazo esgotado."""
+        if deadline is not None and time.monotonic() >= deadline:
+            self._finish("deadline_exceeded")
+            raise CallDeadlineExceeded("Prazo da chamada ao modelo esgotado.") from error
+        self._finish("failed")
+        raise error
+
+    # --- Chamadas ---
+
+    @staticmethod
+    def _hold(slot, start):
+        """Ocupa a vaga enquanto a tentativa de start() roda; ela é liberada quando a tentativa termina."""
+        if slot is None:
+            return start()
+        slot.__enter__()
+        try:
+            future = start()
+        except BaseException:
+            slot.__exit__(None, None, None)
+            raise
+        future.add_done_callback(lambda _: slot.__exit__(None, None, None))
+        return future
+
+    def _timed(self, fn):
+        started = time.monotonic()
+        try:
+            return fn()
+        finally:
+            self._record(time.monotonic() - started)
+
+    def call(self, fn, deadline=None, slot=None, acquire_slot=None):
+        """
+        Executa fn() (sem argumentos, bloqueante) com prazo (time.monotonic; None = sem prazo) e
+        reserva. Retorna o resultado da primeira tentativa que terminar sem exceção; levanta
+        CallDeadlineExceeded se o prazo passar antes, ou a exceção da tentativa se todas falharem.
+        'slot' é a vaga da primeira tentativa e acquire_slot() a da reserva (None: sem vaga livre).
+        """
+        hedge_delay = self._begin()
+        started = time.monotonic()
+        first = self._hold(slot, lambda: self._executor.submit(self._timed, fn))
+        pending, hedged, error = {first}, False, None
+        while pending:
+            done, pending = wait(pending, self._next_timeout(started, hedge_delay, hedged, deadline), FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self._finish("hedge_wins")
+                    return future.result()
+                error = future.exception()
+            if pending and deadline is not None and time.monotonic() >= deadline:
+                self._finish("deadline_exceeded")
+                raise CallDeadlineExceeded("Prazo da chamada ao modelo esgotado.")
+            if pending and self._hedge_due(started, hedge_delay, hedged):
+                hedged = True   # A reserva é considerada uma vez só, com ou sem ficha
+                take, hedge_slot = self._take_hedge(acquire_slot)
+                if take:
+                    pending.add(self._hold(hedge_slot, lambda: self._executor.submit(self._timed, fn)))
+        self._raise_failure(error, deadline)
+
+    async def _timed_async(self, coro_fn):
+        started = time.monotonic()
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._record(time.monotonic() - started)
+            raise
+        self._record(time.monotonic() - started)
+        return result
+
+    async def call_async(self, coro_fn, deadline=None, slot=None, acquire_slot=None):
+        """call() para o event loop: coro_fn() cria a corrotina de uma tentativa; as perdedoras são canceladas."""
+        hedge_delay = self._begin()
+        started = time.monotonic()
+        first = self._hold(slot, lambda: asyncio.ensure_future(self._timed_async(coro_fn)))
+        pending, hedged, error = {first}, False, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self._next_timeout(started, hedge_delay, hedged, deadline),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._finish("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+                if pending and deadline is not None and time.monotonic() >= deadline:
+                    self._finish("deadline_exceeded")
+                    raise CallDeadlineExceeded("Prazo da chamada ao modelo esgotado.")
+                if pending and self._hedge_due(started, hedge_delay, hedged):
+                    hedged = True
+                    take, hedge_slot = self._take_hedge(acquire_slot)
+                    if take:
+                        pending.add(self._hold(hedge_slot, lambda: asyncio.ensure_future(self._timed_async(coro_fn))))
+            self._raise_failure(error, deadline)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            hedge_delay = self._quantile(self.hedge_quantile)
+            median = self._quantile(0.5)
+            return {
+                "hedge_quantile": self.hedge_quantile, "hedge_budget": self.hedge_budget,
+                "hedge_delay_seconds": round(hedge_delay, 3) if hedge_delay is not None else self.initial_hedge_delay,
+                "latency_p50_seconds": round(median, 3) if median is not None else None,
+                "samples": len(self._latencies), "budget_tokens": round(self._tokens, 2),
+                **self.stats_counters,
+            }
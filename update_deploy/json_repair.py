@@ -0,0 +1,338 @@
+"""
+Conserto tolerante do JSON devolvido pelo modelo generativo.
+
+O modelo às vezes devolve JSON truncado (resposta cortada no limite de tokens)
+ou quase válido: vírgula sobrando, chave sem fechar, colchete trocado, texto em
+volta das cercas de markdown. Com json.loads a geração inteira se perde e o
+usuário paga outra chamada. repair_generation() lê a resposta numa passada só,
+em tempo linear, tolerando esses defeitos, e aproveita cada evento completo
+(nota, acorde ou pausa) de right_hand/left_hand, também dentro de "variants".
+O relatório diz o que foi consertado e o que foi descartado.
+
+Primeiro tenta o json do Python (raw_decode, que já ignora o texto depois do
+JSON); só se ele falhar (inclusive com RecursionError, em aninhamento fundo
+demais) entra o leitor tolerante, limitado a MAX_DEPTH níveis, que ainda usa o
+json do Python em cada objeto ou lista bem formado (ex: cada evento antes do
+corte).
+"""
+import re
+import json
+import threading
+from collections import Counter
+
+HANDS = ("right_hand", "left_hand")
+EVENT_TYPES = ("note", "chord", "rest")
+MAX_DEPTH = 32 # Aninhamento máximo aceito (as respostas têm 4 níveis)
+# Cada falha do json do Python custa O(n) (o erro conta as linhas desde o início do texto);
+# depois destas falhas numa resposta, o leitor tolerante segue sozinho
+FAST_PATH_FAILURES = 16
+
+_MISSING = object()
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'\s*')
+_NUMBER = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+_WORD = re.compile(r'[A-Za-z_][A-Za-z0-9_#\-]*')
+_STRING_CHUNK = {'"': re.compile(r'[^"\\]*'), "'": re.compile(r"[^'\\]*")}
+_EVENT_TYPE = re.compile(r'["\']type["\']\s*:\s*["\'](?:note|chord|rest)["\']')
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+
+
+class _TooDeep(Exception):
+    pass
+
+
+class _LenientParser:
+    """
+    Leitor de JSON tolerante, recursivo, que sempre avança. Cada objeto ou lista é tentado
+    primeiro com o json do Python, até FAST_PATH_FAILURES falhas; cada falha relê no máximo o
+    texto todo, então o tempo continua linear.
+    Cada valor volta como (valor, completo); objetos e listas que não fecharam ficam em
+    'incomplete' (por id), para o salvamento descartá-los.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.n = len(text)
+        self.i = 0
+        self.fixes = Counter()
+        self.incomplete = set()
+        self.fast_path_failures = 0
+        self.closers = []         # Fechamentos esperados dos objetos/listas abertos, do mais externo ao atual
+
+    def skip_ws(self):
+        self.i = _WHITESPACE.match(self.text, self.i).end()
+
+    def value(self, depth):
+        self.skip_ws()
+        if self.i >= self.n:
+            return _MISSING, False
+        c = self.text[self.i]
+        if c in '{[' and self.fast_path_failures < FAST_PATH_FAILURES:
+            try:
+                value, self.i = _DECODER.raw_decode(self.text, self.i)
+                return value, True
+            except (ValueError, RecursionError): # RecursionError: aninhamento fundo demais para o json
+                self.fast_path_failures += 1
+        if c == '{':
+            return self.container(depth + 1, {}, '}')
+        if c == '[':
+            return self.container(depth + 1, [], ']')
+        if c in _STRING_CHUNK:
+            return self.string(c)
+        match = _NUMBER.match(self.text, self.i)
+        if match:
+            self.i = match.end()
+            token = match.group(0)
+            number = float(token) if any(ch in token for ch in '.eE') else int(token)
+            return number, self.i < self.n # Número no fim do texto pode ter sido cortado
+        match = _WORD.match(self.text, self.i)
+        if match:
+            self.i = match.end()
+            word = match.group(0)
+            if word in _LITERALS:
+                return _LITERALS[word], True
+            self.fixes["unquoted_string"] += 1
+            return word, self.i < self.n
+        return _MISSING, True
+
+    def string(self, quote):
+        start = self.i + 1
+        j = start
+        chunk = _STRING_CHUNK[quote]
+        while True:
+            j = chunk.match(self.text, j).end()
+            if j >= self.n:
+                self.i = self.n
+                self.fixes["unterminated_string"] += 1
+                return self.decode_string(self.text[start:], quote), False
+            if self.text[j] == '\\':
+                j += 2
+                continue
+            self.i = j + 1
+            return self.decode_string(self.text[start:j], quote), True
+
+    def decode_string(self, raw, quote):
+        if quote == "'":
+            self.fixes["single_quotes"] += 1
+            raw = raw.replace("\\'", "'").replace('"', '\\"')
+        try:
+            return json.loads('"' + raw + '"', strict=False)
+        except ValueError:
+            return raw
+
+    def container(self, depth, result, closer):
+        """Objeto ({}) ou lista ([]) a partir do caractere de abertura."""
+        if depth > MAX_DEPTH:
+            raise _TooDeep()
+        self.closers.append(closer)
+        try:
+            return self._container_items(depth, result, closer)
+        finally:
+            self.closers.pop()
+
+    def _container_items(self, depth, result, closer):
+        is_object = closer == '}'
+        self.i += 1
+        after_comma = False
+        while True:
+            self.skip_ws()
+            if self.i >= self.n:
+                self.fixes["unclosed"] += 1
+                self.incomplete.add(id(result))
+                return result, False
+            c = self.text[self.i]
+            if c == closer:
+                self.i += 1
+                if after_comma:
+                    self.fixes["trailing_comma"] += 1
+                return result, True
+            if c in '}]':
+                if c in self.closers[:-1]:
+                    # Fechamento trocado: fecha este e deixa o caractere para quem o abriu
+                    self.fixes["mismatched_bracket"] += 1
+                    return result, True
+                # Não fecha nada que esteja aberto: ignora
+                self.fixes["stray_closer"] += 1
+                self.i += 1
+                continue
+            if c == ',':
+                self.i += 1
+                after_comma = True
+                continue
+            after_comma = False
+            if is_object:
+                complete = self.member(depth, result)
+            else:
+                item, complete = self.value(depth)
+                if item is _MISSING:
+                    if self.i < self.n:
+                        self.fixes["unexpected_character"] += 1
+                        self.i += 1
+                    continue
+                result.append(item)
+            if not complete:
+                # O texto acabou dentro deste item: este objeto/lista também fica sem fechar
+                self.fixes["unclosed"] += 1
+                self.incomplete.add(id(result))
+                return result, False
+
+    def member(self, depth, result):
+        """Um par "chave": valor do objeto; retorna False se o texto acabou no meio dele."""
+        key, complete = self.value(depth)
+        if key is _MISSING or isinstance(key, (dict, list)):
+            if self.i < self.n and key is _MISSING:
+                self.fixes["unexpected_character"] += 1
+                self.i += 1
+            return self.i < self.n
+        if not complete:
+            return False
+        self.skip_ws()
+        if self.i < self.n and self.text[self.i] == ':':
+            self.i += 1
+        else:
+            self.fixes["missing_colon"] += 1
+        value, complete = self.value(depth)
+        if value is _MISSING:
+            return self.i < self.n
+        result[str(key)] = value
+        return complete
+
+
+def _json_start(text):
+    """Início do JSON na resposta: depois da cerca ```json, se houver, no primeiro '{' (ou '[')."""
+    fence = text.find("```json")
+    offset = fence + 7 if fence >= 0 else 0
+    start = text.find('{', offset)
+    if start < 0:
+        start = text.find('[', offset)
+    return start
+
+
+def _trailing_events(text, end):
+    """Eventos no texto depois do fim do JSON lido (até a cerca de markdown): descartados."""
+    fence = text.find("```", end)
+    return len(_EVENT_TYPE.findall(text, end, fence if fence >= 0 else len(text)))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def valid_event(event):
+    """Evento completo e utilizável: tipo conhecido, altura(s) e duração positiva."""
+    if not isinstance(event, dict) or event.get("type") not in EVENT_TYPES:
+        return False
+    duration = _number(event.get("quarterLength"))
+    if duration is None or duration <= 0:
+        return False
+    if "offset" in event and _number(event["offset"]) is None:
+        return False
+    if event["type"] == "note":
+        return isinstance(event.get("pitch"), str) and bool(event["pitch"])
+    if event["type"] == "chord":
+        pitches = event.get("pitches")
+        return isinstance(pitches, list) and bool(pitches) and all(isinstance(p, str) and p for p in pitches)
+    return True
+
+
+def _salvage_candidate(data, report, incomplete):
+    """{"right_hand", "left_hand"} só com os eventos completos; None se não sobrar nenhum."""
+    cleaned, kept = {}, 0
+    for hand in HANDS:
+        events = data.get(hand)
+        if not isinstance(events, list):
+            events = []
+        good = [e for e in events if id(e) not in incomplete and valid_event(e)]
+        report["dropped"][hand] += len(events) - len(good)
+        cleaned[hand] = good
+        kept += len(good)
+    report["kept"] += kept
+    return cleaned if kept else None
+
+
+def _salvage(data, report, incomplete):
+    if isinstance(data, dict) and isinstance(data.get("variants"), list):
+        variants = data["variants"]
+    elif isinstance(data, list):
+        variants = data
+    elif isinstance(data, dict):
+        candidate = _salvage_candidate(data, report, incomplete)
+        return candidate
+    else:
+        return None
+    salvaged = []
+    for variant in variants:
+        candidate = _salvage_candidate(variant, report, incomplete) if isinstance(variant, dict) else None
+        if candidate is None:
+            report["dropped_variants"] += 1
+        else:
+            salvaged.append(candidate)
+    return {"variants": salvaged} if salvaged else None
+
+
+def repair_generation(text):
+    """
+    Extrai e conserta o JSON de uma resposta do modelo. Retorna (texto JSON normalizado ou None,
+    relatório). O relatório traz "status" (clean, repaired ou unrecoverable), "fixes" (consertos
+    por tipo), "dropped" (eventos descartados por mão e, em "trailing", os que sobraram no texto
+    depois do fim do JSON), "dropped_variants", "kept" e "truncated".
+    """
+    report = {"status": "unrecoverable", "fixes": {}, "dropped": {**{hand: 0 for hand in HANDS}, "trailing": 0},
+              "dropped_variants": 0, "kept": 0, "truncated": False}
+    start = _json_start(text or "")
+    if start < 0:
+        return None, report
+
+    incomplete = set()
+    try:
+        data, end = _DECODER.raw_decode(text, start)
+    except (ValueError, RecursionError):
+        parser = _LenientParser(text)
+        parser.i = start
+        try:
+            data, _ = parser.value(0)
+        except _TooDeep:
+            report["fixes"] = {"too_deep": 1}
+            return None, report
+        end = parser.i
+        incomplete = parser.incomplete
+        report["fixes"] = dict(parser.fixes)
+        report["truncated"] = bool(parser.fixes["unclosed"] or parser.fixes["unterminated_string"])
+        if data is _MISSING:
+            return None, report
+
+    report["dropped"]["trailing"] = _trailing_events(text, end)
+    salvaged = _salvage(data, report, incomplete)
+    if salvaged is None:
+        return None, report
+    dropped = sum(report["dropped"].values()) + report["dropped_variants"]
+    report["status"] = "repaired" if report["fixes"] or dropped else "clean"
+    return json.dumps(salvaged), report
+
+
+class RepairStats:
+    """Contagem dos consertos: respostas limpas, consertadas, perdidas e eventos descartados."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def record(self, report):
+        with self._lock:
+            self._counters["responses"] += 1
+            self._counters[report["status"]] += 1
+            self._counters["dropped_events"] += sum(report["dropped"].values())
+            self._counters["dropped_variants"] += report["dropped_variants"]
+            if report["truncated"]:
+                self._counters["truncated"] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {key: counters.get(key, 0) for key in
+                ("responses", "clean", "repaired", "unrecoverable", "truncated", "dropped_events", "dropped_variants")}
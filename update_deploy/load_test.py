@@ -0,0 +1,144 @@
+"""
+Teste de carga do ponto de entrada ASGI (asgi_app.py) com o backend falso.
+
+Dispara --requests uploads do mesmo MIDI, no máximo --concurrency ao mesmo tempo,
+com fresh=1 (cada upload gera de novo, sem os caches). Enquanto isso consulta
+/asgi/stats para acompanhar as gerações pendentes de cada processo do servidor.
+Ao final mostra status, latências p50/p95/p99, vazão, o pico de gerações pendentes
+(soma dos picos de cada processo) e o resultado da geração de cada upload
+(generation_status: concluída, adiada pelo controle de admissão ou falha). Os
+uploads se dividem entre --clients clientes (X-User-Id; o servidor só os distingue
+com TRUST_USER_ID_HEADER=1), para exercitar o limite por cliente.
+
+Cliente HTTP mínimo sobre asyncio (sem dependências). Cada conexão é um descritor
+de arquivo: aumente o 'ulimit -n' do cliente e do servidor para milhares de conexões.
+
+Uso (limites da admissão abertos, para medir o servidor e não o controle de admissão):
+    GENERATION_BACKEND=fake FAKE_GENERATION_LATENCY_SECONDS=5 \\
+    GENERATION_MAX_CONCURRENT=4000 GENERATION_MAX_QUEUE=4000 GENERATION_RATE_PER_CLIENT=0 \\
+        uvicorn asgi_app:api --workers 4 --port 8000 --backlog 4096
+    python load_test.py --url http://127.0.0.1:8000 --midi static/generated/<arquivo>.mid \\
+        --requests 4000 --concurrency 4000
+"""
+import os
+import time
+import uuid
+import json
+import asyncio
+import argparse
+import resource
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+async def http_request(host, port, method, path, body=b"", headers=None):
+    """Uma requisição HTTP/1.1 com 'Connection: close'. Retorna (status, corpo)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}:{port}", "Connection: close",
+                 f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+        data = await reader.read()
+    finally:
+        writer.close()
+    head, _, payload = data.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), payload
+
+
+def multipart_body(fields, file_field, filename, content):
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: audio/midi\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+async def read_stats(host, port, peaks):
+    """Guarda, por processo do servidor, o maior número de gerações pendentes visto."""
+    try:
+        status, payload = await http_request(host, port, "GET", "/asgi/stats")
+        if status == 200:
+            stats = json.loads(payload)
+            peaks[stats["pid"]] = max(peaks.get(stats["pid"], 0), stats["peak_pending"])
+    except (OSError, ValueError):
+        pass
+
+
+async def poll_stats(host, port, peaks, stop):
+    while not stop.is_set():
+        await read_stats(host, port, peaks)
+        await asyncio.sleep(0.05)
+
+
+async def run(args):
+    url = urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+    with open(args.midi, 'rb') as f:
+        content = f.read()
+    body, content_type = multipart_body({"fresh": "1", "candidates": str(args.candidates)}, "midi_file",
+                                        os.path.basename(args.midi), content)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, statuses, generation = [], {}, {}
+
+    async def one(index):
+        headers = {"Content-Type": content_type, "X-User-Id": f"load-test-{index % args.clients}"}
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status, payload = await http_request(host, port, "POST", "/upload_midi", body, headers)
+            except OSError as e:
+                status, payload = type(e).__name__, b""
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+            try:
+                generation_status = json.loads(payload).get("generation_status") or "-"
+            except ValueError:
+                generation_status = "-"
+            generation[generation_status] = generation.get(generation_status, 0) + 1
+
+    peaks, stop = {}, asyncio.Event()
+    poller = asyncio.ensure_future(poll_stats(host, port, peaks, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await poller
+    # Leituras finais: os picos ficam registrados em cada processo do servidor
+    for _ in range(4 * max(len(peaks), 1)):
+        await read_stats(host, port, peaks)
+
+    latencies = np.array(latencies)
+    print(f"{args.requests} uploads, concorrência {args.concurrency}, {elapsed:.1f} s "
+          f"({args.requests / elapsed:.1f} req/s)")
+    print(f"status: {statuses} | geração: {generation}")
+    print(f"latência p50 {np.percentile(latencies, 50):.2f} s | p95 {np.percentile(latencies, 95):.2f} s | "
+          f"p99 {np.percentile(latencies, 99):.2f} s")
+    print(f"pico de gerações pendentes: {sum(peaks.values())} em {len(peaks)} processo(s) {dict(peaks)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do asgi_app com o backend falso.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--midi", required=True)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=2000)
+    parser.add_argument("--candidates", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=1, help="Clientes distintos (X-User-Id) entre os uploads")
+    args = parser.parse_args()
+
+    # Uma conexão por requisição em andamento: sobe o limite de descritores até o máximo permitido
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.concurrency + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Motor local de continuação por cadeias de Markov de ordem variável.
+
+Treinado sobre os corpora de Datasets/*.zip (lidos em streaming, em paralelo
+por arquivo), sem depender de rede nem de GPU. Serve como alternativa ao
+Gemini quando a API está lenta ou fora do ar.
+
+Tokens: cada evento de uma mão (nota, acorde ou pausa, no formato de
+midi_stream_to_text) vira (tipo, alturas transpostas para a tônica C,
+duração quantizada). Cada mão tem seu próprio modelo.
+
+Contagens: para cada ordem n (1..MAX_ORDER) os contextos de n tokens ficam
+num nível de trie em arrays: hashes de contexto ordenados, ponteiros (CSR)
+para os filhos e, por filho, o id do próximo token e sua contagem.
+A consulta é uma busca binária por nível (searchsorted).
+
+Uso:
+    python markov.py train [--workers N]
+"""
+import os
+import json
+import random
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import corpus
+import corpus_store
+
+logger = logging.getLogger(__name__)
+
+MARKOV_MODEL_DIR = os.getenv(
+    "MARKOV_MODEL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus_index', 'markov')
+)
+
+MAX_ORDER = 4            # Maior contexto considerado
+MIN_CONTEXT_COUNT = 2    # Contextos vistos menos vezes fazem backoff para ordem menor
+MAX_CHORD_NOTES = 4      # Acordes maiores são reduzidos às 4 notas mais agudas
+HANDS = ("rh", "lh")
+
+# Grade de durações (quarterLength); cada evento usa a mais próxima
+DURATION_GRID = np.array([0.25, 1 / 3, 0.5, 2 / 3, 0.75, 1.0, 1.5, 2.0, 3.0, 4.0])
+
+_HASH_MULT = np.uint64(0x100000001B3)
+_HASH_SEED = np.uint64(0xCBF29CE484222325)
+
+
+def transpose_shift(tonic):
+    """Deslocamento (em semitons) que leva a tônica para C pelo caminho mais curto."""
+    shift = -tonic % 12
+    return shift - 12 if shift > 6 else shift
+
+
+def event_to_token(event, shift=0):
+    """Converte um evento de midi_stream_to_text em token (tipo, alturas, índice de duração)."""
+    duration_idx = int(np.abs(DURATION_GRID - float(event.get("quarterLength", 1.0))).argmin())
+    if event["type"] == "note":
+        return ("n", (corpus.pitch_number(event["pitch"]) + shift,), duration_idx)
+    if event["type"] == "chord":
+        pitches = sorted(set(corpus.pitch_number(p) + shift for p in event["pitches"]))[-MAX_CHORD_NOTES:]
+        return ("c", tuple(pitches), duration_idx)
+    return ("r", (), duration_idx)
+
+
+def context_hash(token_ids):
+    """Hash FNV-1a de uma sequência de ids (vetorizado sobre a última dimensão)."""
+    token_ids = np.asarray(token_ids, dtype=np.uint64)
+    h = np.full(token_ids.shape[:-1], _HASH_SEED, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(token_ids.shape[-1]):
+            h = (h ^ token_ids[..., j]) * _HASH_MULT
+    return h
+
+
+def _hand_tokens_for_member(task):
+    """Worker do treino paralelo: sequências de tokens (RH, LH) de um membro do zip, transpostas para C."""
+    archive_path, member_name = task
+    try:
+        notes, _ = corpus.extract_notes(corpus.read_member(archive_path, member_name))
+        if not len(notes):
+            return [], []
+        shift = transpose_shift(corpus.dominant_pitch_class(notes))
+        rh, lh = corpus.split_hands(notes)
+        return ([event_to_token(ev, shift) for ev in corpus.notes_to_events(rh)],
+                [event_to_token(ev, shift) for ev in corpus.notes_to_events(lh)])
+    except Exception as e:
+        logger.warning(f"Falha ao processar {member_name} de {archive_path}: {e}")
+        return [], []
+
+
+def _count_level(sequences, order):
+    """Conta (contexto, próximo) para uma ordem; retorna os arrays de um nível da trie."""
+    contexts, nexts = [], []
+    for seq in sequences:
+        if len(seq) <= order:
+            continue
+        windows = np.lib.stride_tricks.sliding_window_view(seq, order + 1)
+        contexts.append(context_hash(windows[:, :order]))
+        nexts.append(windows[:, order])
+    if not contexts:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint32)
+
+    pairs = np.stack((np.concatenate(contexts), np.concatenate(nexts).astype(np.uint64)), axis=1)
+    unique_pairs, counts = np.unique(pairs, axis=0, return_counts=True) # Ordenado por contexto
+    ctx_keys, starts = np.unique(unique_pairs[:, 0], return_index=True)
+    pointers = np.append(starts, len(unique_pairs)).astype(np.int64)
+    return ctx_keys, pointers, unique_pairs[:, 1].astype(np.int32), counts.astype(np.uint32)
+
+
+def train(model_dir=MARKOV_MODEL_DIR, archive_paths=None, workers=None):
+    """Treina os modelos RH/LH a partir dos zips e grava os arrays em model_dir."""
+    os.makedirs(model_dir, exist_ok=True)
+    tasks = [(archive_path, info.filename) for archive_path, info in corpus_store.iter_unique_members(archive_paths)]
+
+    vocab = {}
+    sequences = {hand: [] for hand in HANDS}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for hand_tokens in pool.map(_hand_tokens_for_member, tasks, chunksize=8):
+            for hand, tokens in zip(HANDS, hand_tokens):
+                if tokens:
+                    sequences[hand].append(np.array([vocab.setdefault(t, len(vocab)) for t in tokens], dtype=np.int64))
+
+    for hand in HANDS:
+        all_ids = np.concatenate(sequences[hand]) if sequences[hand] else np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(model_dir, f"{hand}_unigram.npy"), np.bincount(all_ids, minlength=len(vocab)).astype(np.uint32))
+        for order in range(1, MAX_ORDER + 1):
+            for name, array in zip(("ctx", "ptr", "next", "count"), _count_level(sequences[hand], order)):
+                np.save(os.path.join(model_dir, f"{hand}_o{order}_{name}.npy"), array)
+
+    with open(os.path.join(model_dir, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump({"max_order": MAX_ORDER, "tokens": [[k, list(p), d] for (k, p, d) in vocab]}, f)
+    logger.info(f"Modelo Markov treinado: {len(vocab)} tokens, {len(tasks)} arquivos.")
+    return len(vocab)
+
+
+class MarkovContinuationEngine:
+    """Amostrador de continuações a partir dos arrays gravados por train()."""
+
+    def __init__(self, model_dir=MARKOV_MODEL_DIR):
+        with open(os.path.join(model_dir, 'vocab.json'), encoding='utf-8') as f:
+            vocab = json.load(f)
+        self.max_order = vocab["max_order"]
+        self.tokens = [(k, tuple(p), d) for k, p, d in vocab["tokens"]]
+        self.token_ids = {t: i for i, t in enumerate(self.tokens)}
+        load = lambda name: np.load(os.path.join(model_dir, f"{name}.npy"), mmap_mode='r')
+        self.unigram = {hand: load(f"{hand}_unigram") for hand in HANDS}
+        self.levels = {
+            hand: [None] + [tuple(load(f"{hand}_o{order}_{name}") for name in ("ctx", "ptr", "next", "count"))
+                            for order in range(1, self.max_order + 1)]
+            for hand in HANDS
+        }
+
+    def _next_distribution(self, hand, history):
+        """Distribuição do próximo token com backoff: da maior ordem disponível até o unigrama."""
+        for order in range(min(self.max_order, len(history)), 0, -1):
+            context = history[-order:]
+            if any(t < 0 for t in context):
+                continue # Token fora do vocabulário no contexto
+            ctx_keys, pointers, next_ids, counts = self.levels[hand][order]
+            key = context_hash(np.array(context, dtype=np.int64)[None, :])[0]
+            pos = np.searchsorted(ctx_keys, key)
+            if pos < len(ctx_keys) and ctx_keys[pos] == key:
+                lo, hi = pointers[pos], pointers[pos + 1]
+                if counts[lo:hi].sum() >= MIN_CONTEXT_COUNT:
+                    return np.asarray(next_ids[lo:hi]), np.asarray(counts[lo:hi], dtype=np.float64)
+        unigram = np.asarray(self.unigram[hand], dtype=np.float64)
+        return np.flatnonzero(unigram), unigram[unigram > 0]
+
+    def sample_hand(self, hand, tail_events, start_offset, length_ql, tonic, temperature=1.0, rng=None):
+        """Amostra eventos de uma mão até cobrir length_ql quarterLengths a partir de start_offset."""
+        rng = rng or np.random.default_rng()
+        shift = transpose_shift(tonic)
+        history = [self.token_ids.get(event_to_token(ev, shift), -1) for ev in tail_events if ev.get("type")]
+
+        velocities = [int(ev["velocity"]) for ev in tail_events if ev.get("velocity") is not None]
+        base_velocity = int(np.mean(velocities)) if velocities else 80
+
+        events, offset = [], float(start_offset)
+        end_offset = start_offset + length_ql
+        while offset < end_offset:
+            candidates, weights = self._next_distribution(hand, history)
+            if not len(candidates):
+                break
+            weights = weights ** (1.0 / max(temperature, 1e-3))
+            token_id = int(rng.choice(candidates, p=weights / weights.sum()))
+            history.append(token_id)
+            kind, pitches, duration_idx = self.tokens[token_id]
+            quarter_length = float(DURATION_GRID[duration_idx])
+            pitches = [p - shift for p in pitches] # Volta para a tonalidade da música
+            velocity = max(1, min(127, base_velocity + int(rng.integers(-6, 7))))
+            if kind == "n":
+                events.append({"type": "note", "pitch": corpus.pitch_name(pitches[0]), "offset": round(offset, 4),
+                               "quarterLength": round(quarter_length, 4), "velocity": velocity})
+            elif kind == "c":
+                events.append({"type": "chord", "pitches": [corpus.pitch_name(p) for p in pitches],
+                               "offset": round(offset, 4), "quarterLength": round(quarter_length, 4), "velocity": velocity})
+            else:
+                events.append({"type": "rest", "offset": round(offset, 4), "quarterLength": round(quarter_length, 4)})
+            offset += quarter_length
+        return events
+
+    def generate(self, music_text_rh, music_text_lh, last_offset, length_ql=16.0, temperature=1.0, seed=None, tonic=None):
+        """
+        Gera uma continuação para as duas mãos a partir dos textos de midi_stream_to_text.
+        Retorna um texto JSON no mesmo formato esperado da resposta do Gemini
+        ({"right_hand": [...], "left_hand": [...]}).
+        """
+        rh_tail = json.loads(music_text_rh) if music_text_rh else []
+        lh_tail = json.loads(music_text_lh) if music_text_lh else []
+        if tonic is None:
+            tonic = corpus.dominant_pitch_class(np.concatenate((corpus.events_to_notes(rh_tail), corpus.events_to_notes(lh_tail))))
+        rng = np.random.default_rng(seed if seed is not None else random.getrandbits(32))
+        start = float(last_offset or 0.0)
+        return json.dumps({
+            "right_hand": self.sample_hand("rh", rh_tail, start, length_ql, tonic, temperature, rng),
+            "left_hand": self.sample_hand("lh", lh_tail, start, length_ql, tonic, temperature, rng),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Motor de continuação Markov treinado no corpus.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_train = sub.add_parser("train", help="Treina o modelo a partir de Datasets/*.zip")
+    p_train.add_argument("--datasets", default=corpus.DATASETS_DIR)
+    p_train.add_argument("--model", default=MARKOV_MODEL_DIR)
+    p_train.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    train(args.model, corpus.list_archives(args.datasets), args.workers)
+
+
+if __name__ == '__main__':
+    main()
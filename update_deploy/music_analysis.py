@@ -0,0 +1,543 @@
+"""
+Análise de MIDI com o music21: separação das mãos, texto dos eventos para o
+prompt e a análise em duas etapas (o que o prompt precisa / o restante).
+
+Fica fora de app.py para poder rodar nos processos do pool de análise
+(analysis_pool.py) sem importar o Flask nem o cliente do modelo.
+"""
+import os
+import json
+import math
+import time
+import logging
+import tempfile
+import statistics
+from collections import Counter
+from contextlib import contextmanager
+
+from music21 import converter, tempo, stream, note, chord, roman, meter, duration as m21duration
+
+logger = logging.getLogger(__name__)
+
+# Características harmônicas (chordify): as caras, que com orçamento de tempo podem vir de uma amostra
+HARMONIC_FIELDS = ("chord_complexity", "harmonic_progression_preview", "final_chord_analysis", "final_melody_analysis")
+# Compassos da amostra usados para estimar o custo por nota do chordify da peça inteira
+CHORDIFY_PROBE_BARS = 3
+
+
+def separate_piano_parts(s):
+    """
+    Separa uma stream music21 em partes de mão direita (aguda) e mão esquerda (grave).
+    Retorna (rh_part, lh_part). lh_part pode ser None se for uma stream de parte única.
+    """
+    # Se o arquivo já possui partes, tenta usá-las
+    if len(s.parts) > 1:
+        # Um caso comum para MIDI de piano são duas partes
+        part1 = s.parts[0]
+        part2 = s.parts[1]
+
+        avg_pitch1 = 0
+        avg_pitch2 = 0
+        
+        notes1 = list(part1.flatten().pitches)
+        notes2 = list(part2.flatten().pitches)
+
+        if not notes1 and not notes2: return (None, None)
+        if not notes1: return (part2, None)
+        if not notes2: return (part1, None)
+
+        avg_pitch1 = sum(p.ps for p in notes1) / len(notes1)
+        avg_pitch2 = sum(p.ps for p in notes2) / len(notes2)
+        
+        # Compara as alturas médias para definir mão direita (RH) e esquerda (LH)
+        if avg_pitch1 > avg_pitch2:
+            return (part1, part2) # part1 é RH, part2 é LH
+        else:
+            return (part2, part1) # part2 é RH, part1 é LH
+            
+    # Se for uma stream 'flat' (sem partes), temos que criar as partes dividindo o alcance das notas
+    else:
+        # Por enquanto, se não houver partes, trata como uma única parte (mão direita).
+        return (s, None)
+
+
+def midi_stream_to_text(s, limit=64):
+    """
+    Converte uma stream music21 (ou parte) em uma representação de texto (JSON).
+    O limite aumentado fornece mais contexto para a geração.
+    """
+    if not s:
+        return "[]" # Retorna um array JSON vazio se a parte for None
+        
+    components = []
+    # Itera sobre os últimos 'limit' elementos da stream
+    for element in s.flatten().notesAndRests[-limit:]:
+        velocity = 80 # Velocity padrão
+        if hasattr(element, 'volume') and element.volume.velocity is not None:
+            velocity = element.volume.velocity
+
+        if isinstance(element, note.Note):
+            components.append({
+                "type": "note",
+                "pitch": element.pitch.nameWithOctave,
+                "offset": float(element.offset),
+                "quarterLength": float(element.duration.quarterLength),
+                "velocity": velocity
+            })
+        elif isinstance(element, chord.Chord):
+            # Calcula a velocidade média para acordes
+            avg_velocity = round(sum(n.volume.velocity for n in element if n.volume.velocity is not None) / len(element)) if len(element) > 0 else 80
+            components.append({
+                "type": "chord",
+                "pitches": [p.nameWithOctave for p in element.pitches],
+                "offset": float(element.offset),
+                "quarterLength": float(element.duration.quarterLength),
+                "velocity": avg_velocity
+            })
+        elif isinstance(element, note.Rest):
+            components.append({
+                "type": "rest",
+                "offset": float(element.offset),
+                "quarterLength": float(element.duration.quarterLength),
+            })
+    return json.dumps(components, indent=2)
+
+
+def empty_analysis_results():
+    """Campos da análise com os valores padrão (antes de qualquer etapa)."""
+    return {
+        "bpm": "N/A", "key": "N/A", "time_signature": "N/A", "num_bars": "N/A",
+        "melodic_range": "N/A", "chord_complexity": "N/A", "rhythmic_density": "N/A",
+        "form_structure": "Ainda não implementado", "harmonic_progression_preview": "N/A",
+        "rhythmic_pattern_summary": "N/A", "ai_analysis_text": "Aguardando dados da análise..."
+    }
+
+
+def analyze_prompt_features(file_path):
+    """
+    Etapa 1 da análise: só o que o prompt de geração precisa (BPM, compasso,
+    tonalidade e último offset), com o mesmo tratamento de exceções e validação
+    de sanidade da análise completa.
+    Retorna (results, stream, state); 'state' guarda os objetos que a etapa 2
+    reaproveita e é None se a análise não puder continuar.
+    """
+    results = empty_analysis_results()
+    s = None
+    started = time.monotonic()
+    
+    try:
+        s = converter.parse(file_path)
+        if not s:
+            results["ai_analysis_text"] = "Não foi possível carregar o arquivo com music21."
+            return results, s, None
+        
+        # TRATAMENTO DE EXCEÇÃO: MIDI VAZIO (sem notas) 
+        if not s.flat.notesAndRests:
+            results["ai_analysis_text"] = "O arquivo MIDI foi carregado, mas não contém notas ou pausas."
+            return results, s, None
+
+        # TRATAMENTO DE EXCEÇÃO: BPM 
+        bpm_values = []
+        MIN_BPM = 30  # Limite mínimo razoável
+        MAX_BPM = 280 # Limite máximo razoável
+
+        for el in s.flat.getElementsByClass(tempo.MetronomeMark):
+            if MIN_BPM <= el.number <= MAX_BPM:
+                bpm_values.append(el.number)
+
+        if bpm_values:
+            # Usa a MEDIANA (resistente a outliers)
+            results["bpm"] = round(statistics.median(bpm_values))
+        else:
+            try:
+                # Tenta estimar o tempo se não houver marcação explícita
+                estimated_tempo = s.estimateTempo()
+                if estimated_tempo:
+                    # "Prende" (clamp) o valor estimado dentro dos limites
+                    results["bpm"] = round(max(MIN_BPM, min(MAX_BPM, estimated_tempo.number)))
+                else:
+                    results["bpm"] = 120 # Fallback
+            except Exception:
+                results["bpm"] = 120 # Fallback final
+        
+        # TRATAMENTO DE EXCEÇÃO: Compasso (Inferência e Fallback)
+        ts_obj = None
+        ts_search = s.flat.getElementsByClass(meter.TimeSignature)
+        suspicious_ts_flag = False
+        original_ts_str = ""
+        
+        if ts_search:
+            ts_obj = ts_search[0]
+        else:
+            try:
+                # 1. Tenta INFERIR o compasso
+                logger.info("Compasso não encontrado. Tentando inferir...")
+                ts_obj = meter.bestTimeSignature(s)
+                logger.info(f"Compasso inferido: {ts_obj.ratioString}")
+            except Exception as e:
+                # 2. Se a inferência falhar, usa um FALLBACK
+                logger.warning(f"Falha ao inferir compasso ({e}). Usando 4/4.")
+                ts_obj = meter.TimeSignature('4/4') # Padrão mais comum
+            
+           # 3. Insere o compasso (inferido ou padrão) na stream
+            s.insert(0, ts_obj)
+
+        # NOVO TRATAMENTO: Simplificação de Compasso (Ex: 12/16 -> 3/4) 
+        # Adicionado para tratar compassos com numeradores/denominadores > 8
+        try:
+            num = ts_obj.numerator
+            den = ts_obj.denominator
+            
+            # Se o numerador OU denominador for maior que 8, tenta simplificar
+            if num > 8 or den > 8:
+                common_divisor = math.gcd(num, den)
+                if common_divisor > 1:
+                    new_num = num // common_divisor
+                    new_den = den // common_divisor
+                    simplified_ts_str = f'{new_num}/{new_den}'
+                    logger.info(f"Simplificando compasso de {ts_obj.ratioString} para {simplified_ts_str}")
+                    ts_obj = meter.TimeSignature(simplified_ts_str)
+                    
+                    # Remove o compasso antigo e insere o novo simplificado
+                    s.removeByClass(meter.TimeSignature)
+                    s.insert(0, ts_obj)
+        except Exception as e:
+            logger.warning(f"Falha ao tentar simplificar o compasso: {e}")
+        # FIM DA SIMPLIFICAÇÃO
+
+
+        # NOVO TRATAMENTO: Compassos "Suspeitos" (1/4, 2/4)
+        original_ts_str = ts_obj.ratioString # Guarda o compasso original (ex: "3/4")
+
+        if original_ts_str in ['1/4', '2/4']:
+            logger.warning(f"Compasso musicalmente incomum detectado: {original_ts_str}. Usando 4/4 como padrão de análise.")
+            suspicious_ts_flag = True
+            ts_obj = meter.TimeSignature('4/4') # Define um padrão mais seguro
+            s.insert(0, ts_obj) # Sobrescreve o compasso na stream para os cálculos
+        
+        results["time_signature"] = ts_obj.ratioString # Armazena o compasso SEGURO (ex: 4/4)
+
+        # TRATAMENTO DE EXCEÇÃO: Tonalidade (Validação de Confiança)
+        key_obj = s.analyze('key')
+        
+        # Verifica se a análise de tonalidade é confiável
+        if key_obj and key_obj.correlationCoefficient > 0.70:
+            mode_pt = "Maior" if key_obj.mode == 'major' else "Menor" if key_obj.mode == 'minor' else key_obj.mode
+            results["key"] = f"{key_obj.tonic.name.replace('-', '♭').replace('#', '♯')} {mode_pt}"
+        else:
+            # Se a confiança for baixa (música atonal, curta, etc.), não afirma a tonalidade
+            results["key"] = "Indefinido"
+            key_obj = None # Anula para que a análise de Graus Romanos não seja usada
+
+        if s.highestTime:
+            results["last_offset"] = float(s.highestTime) # Offset final da música
+
+        state = {"key_obj": key_obj, "ts_obj": ts_obj,
+                 "suspicious_ts_flag": suspicious_ts_flag, "original_ts_str": original_ts_str, "started": started}
+        return results, s, state
+
+    except Exception as e:
+        logger.error(f"Erro na análise com music21: {e}")
+        results["ai_analysis_text"] = f"Erro ao processar o arquivo MIDI: {str(e)}"
+        return results, s, None
+
+
+def build_analysis_text(results, suspicious_ts_flag=False, original_ts_str=""):
+    """Texto descritivo da análise a partir dos campos de 'results' (preenche ai_analysis_text)."""
+    analysis_parts = []
+    if results["key"] != "N/A": analysis_parts.append(f"A tonalidade principal parece ser {results['key']}.")
+    if results["bpm"] != "N/A": analysis_parts.append(f"O andamento médio é de aproximadamente {results['bpm']} BPM.")
+    if suspicious_ts_flag:
+        # Caso o compasso seja muito distoante e sem sentido
+        analysis_parts.append(f"Detectado compasso de {original_ts_str}. A estrutura rítmica é provavelmente 3/4 ou 4/4.")
+    elif results["time_signature"] != "N/A":
+        # Caso contrário, usa o compasso normal
+        analysis_parts.append(f"Utiliza um compasso de {results['time_signature']}.")
+    if results["harmonic_progression_preview"] != "N/A" and results["harmonic_progression_preview"]: analysis_parts.append(f"A progressão harmônica inicial observada é: {results['harmonic_progression_preview']}.")
+    if results["rhythmic_pattern_summary"] != "N/A": analysis_parts.append(f"{results['rhythmic_pattern_summary']}.")
+    if results["melodic_range"] != "N/A": analysis_parts.append(f"A melodia se estende por {results['melodic_range'].lower()}.")
+    if analysis_parts:
+        results["ai_analysis_text"] = " ".join(analysis_parts)
+    else:
+        results["ai_analysis_text"] = "Não foi possível extrair informações detalhadas."
+    return results["ai_analysis_text"]
+
+
+def stratified_bar_order(total_bars, sample_bars):
+    """
+    Compassos da amostra estratificada, na ordem de análise: o último (acorde final), os dois
+    primeiros (prévia da progressão) e um compasso do meio de cada um de 'sample_bars' estratos,
+    do mais grosso ao mais fino (ordem de van der Corput): qualquer prefixo cobre a peça toda.
+    """
+    strata = max(1, min(sample_bars, total_bars))
+    bits = max(1, (strata - 1).bit_length())
+    coarse_to_fine = sorted(range(strata), key=lambda i: int(format(i, f'0{bits}b')[::-1], 2))
+    order = [total_bars - 1, 0, 1] + [int((i + 0.5) * total_bars / strata) for i in coarse_to_fine]
+    seen = set()
+    return [bar for bar in order if 0 <= bar < total_bars and not (bar in seen or seen.add(bar))]
+
+
+def budgeted_chords(s, ts_obj, deadline, sample_bars):
+    """
+    Acordes (chordify) até o prazo 'deadline' (time.monotonic). Começa pela amostra estratificada,
+    compasso a compasso; depois dos primeiros CHORDIFY_PROBE_BARS compassos, estima o custo da peça
+    inteira pelo custo por nota da amostra e, se couber no prazo, faz o chordify completo. Senão
+    segue com a amostra até o prazo acabar. Na amostra, notas que atravessam a barra de compasso
+    só contam no compasso em que começam.
+    Retorna (acordes em ordem de offset, compassos analisados, total de compassos).
+    """
+    bar_ql = float(ts_obj.barDuration.quarterLength) if ts_obj else 4.0
+    total_bars = max(1, math.ceil(float(s.highestTime) / bar_ql))
+    flat = s.flatten()
+    total_notes = len(flat.notes)
+    order = stratified_bar_order(total_bars, sample_bars)
+    sampled, sampled_notes, sampling_seconds = [], 0, 0.0
+    for bar in order:
+        window_started = time.monotonic()
+        if window_started >= deadline:
+            break
+        start = bar * bar_ql
+        window = flat.getElementsByOffset(start, start + bar_ql, includeEndBoundary=False, mustBeginInSpan=True,
+                                          classList=[note.Note, chord.Chord]).stream()
+        sampled.append((bar, list(window.chordify().flat.getElementsByClass(chord.Chord))))
+        sampled_notes += len(window.notes)
+        sampling_seconds += time.monotonic() - window_started
+        if len(sampled) == min(CHORDIFY_PROBE_BARS, len(order)):
+            predicted = sampling_seconds / max(sampled_notes, 1) * total_notes
+            if time.monotonic() + predicted <= deadline:
+                return list(s.chordify().flat.getElementsByClass(chord.Chord)), total_bars, total_bars
+    sampled.sort(key=lambda item: item[0])
+    return [c for _, chords in sampled for c in chords], len(sampled), total_bars
+
+
+def final_chord_fields(last_chord, key_obj):
+    """
+    final_chord_analysis e final_melody_analysis a partir do último acorde (music21 Chord)
+    e da tonalidade (None se não for confiável). Usada também por bar_analysis.py.
+    """
+    fields = {}
+    # Só tenta análise de Graus Romanos se a tonalidade for confiável
+    if key_obj:
+        try:
+            rn = roman.romanNumeralFromChord(last_chord, key_obj)
+            fields["final_chord_analysis"] = f"A música termina em um acorde {last_chord.pitchedCommonName}, que funciona como um grau {rn.figure}."
+        except Exception:
+            fields["final_chord_analysis"] = f"A música termina no acorde {last_chord.pitchedCommonName}."
+    else:
+        fields["final_chord_analysis"] = f"A música termina no acorde {last_chord.pitchedCommonName}."
+
+    last_melodic_note = last_chord.pitches[-1] # Nota mais aguda do último acorde
+    if key_obj:
+        scale_degree = key_obj.getScaleDegreeFromPitch(last_melodic_note)
+        degree_names = ["Tônica", "Supertônica", "Mediante", "Subdominante", "Dominante", "Superdominante", "Sensível"]
+        if scale_degree and 1 <= scale_degree <= 7:
+            degree_name = degree_names[scale_degree-1]
+            fields["final_melody_analysis"] = f"A melodia termina na nota {last_melodic_note.name} ({degree_name})."
+        else:
+            fields["final_melody_analysis"] = f"A melodia termina na nota {last_melodic_note.name}."
+    return fields
+
+
+def analyze_detailed_features(s, results, state, budget_seconds=None, sample_bars=32):
+    """
+    Etapa 2 da análise: compassos, extensão, densidade, padrão rítmico, acordes, graus e o
+    texto descritivo. Completa 'results' (da etapa 1) no lugar.
+    Não é necessária para o prompt, então pode rodar em paralelo com a geração.
+
+    Com 'budget_seconds' (contado do início da etapa 1), as características baratas vêm
+    primeiro e as harmônicas (chordify) só usam a peça inteira se o custo previsto couber no
+    orçamento; senão vêm de até 'sample_bars' compassos amostrados, até o prazo acabar (ver
+    budgeted_chords). Nesse caso results["approximate"] lista os campos aproximados e a
+    cobertura da amostra.
+    """
+    key_obj, ts_obj = state["key_obj"], state["ts_obj"]
+    suspicious_ts_flag, original_ts_str = state["suspicious_ts_flag"], state["original_ts_str"]
+    try:
+        # INÍCIO DA ANÁLISE DETALHADA
+
+        # Cálculo de número de compassos
+        last_measure_number = 0
+        for p in s.parts:
+            measures_in_part = p.getElementsByClass(stream.Measure)
+            if measures_in_part:
+                m_numbers = [m.number for m in measures_in_part if m.number is not None]
+                if m_numbers:
+                    last_measure_number = max(last_measure_number, max(m_numbers))
+                elif measures_in_part:
+                    # Fallback para partes sem números de compasso explícitos
+                    last_measure_number = max(last_measure_number, len(measures_in_part))
+        
+        if last_measure_number > 0:
+            results["num_bars"] = last_measure_number
+        elif s.highestTime and ts_obj: # Fallback
+            try:
+                measure_duration_ql = ts_obj.barDuration.quarterLength
+                if measure_duration_ql > 0:
+                    results["num_bars"] = int(round(s.highestTime / measure_duration_ql))
+            except Exception:
+                pass # num_bars permanece "N/A"
+
+        # Análise da extensão melódica
+        all_pitches = s.flat.pitches
+        if all_pitches:
+            min_pitch_val = min(p.ps for p in all_pitches)
+            max_pitch_val = max(p.ps for p in all_pitches)
+            octave_span = (max_pitch_val - min_pitch_val) / 12.0
+            if octave_span < 1.5: results["melodic_range"] = "1-2 Oitavas"
+            elif octave_span < 3: results["melodic_range"] = "2-3 Oitavas"
+            else: results["melodic_range"] = f"~ {round(octave_span)} Oitavas"
+
+        # Análise de densidade rítmica
+        notes_and_rests_count = len(s.flat.notesAndRests)
+        num_bars_for_density = results["num_bars"]
+        if isinstance(num_bars_for_density, int) and num_bars_for_density > 0:
+            elements_per_measure = notes_and_rests_count / num_bars_for_density
+            if elements_per_measure < 8: results["rhythmic_density"] = "Baixa"
+            elif elements_per_measure < 20: results["rhythmic_density"] = "Média"
+            else: results["rhythmic_density"] = "Alta"
+        
+        # Análise de padrões rítmicos (duração mais comum)
+        note_durations_ql = [n.duration.quarterLength for n in s.flat.notes]
+        if note_durations_ql:
+            common_durations = Counter(note_durations_ql).most_common(1)
+            if common_durations:
+                most_common_ql = common_durations[0][0]
+                try:
+                    d_obj = m21duration.Duration(most_common_ql)
+                    results["rhythmic_pattern_summary"] = f"Predominância de {d_obj.type}s"
+                except Exception:
+                    results["rhythmic_pattern_summary"] = f"Duração QL: {most_common_ql}"
+
+        # Acordes: a peça inteira se couber no orçamento, senão uma amostra de compassos
+        if not budget_seconds:
+            chord_stream_list = list(s.chordify().flat.getElementsByClass(chord.Chord))
+        else:
+            chord_stream_list, sampled_bars, total_bars = budgeted_chords(
+                s, ts_obj, state["started"] + budget_seconds, sample_bars
+            )
+            if sampled_bars < total_bars:
+                logger.info(f"Orçamento de {budget_seconds:g} s: acordes de {sampled_bars} de {total_bars} compassos.")
+                # O último compasso é o primeiro da amostra: sem ele, nem o acorde final foi calculado
+                fields = HARMONIC_FIELDS if sampled_bars == 0 else HARMONIC_FIELDS[:2]
+                results["approximate"] = {"fields": list(fields), "sampled_bars": sampled_bars, "total_bars": total_bars}
+
+        last_chord = chord_stream_list[-1] if chord_stream_list else None
+        
+        if last_chord:
+            results.update(final_chord_fields(last_chord, key_obj))
+        
+        # Análise de complexidade harmônica
+        if chord_stream_list:
+            chord_qualities = list(set(c.quality for c in chord_stream_list))
+            if len(chord_qualities) <= 2: results["chord_complexity"] = "Simples"
+            elif len(chord_qualities) <= 4: results["chord_complexity"] = "Moderada"
+            else: results["chord_complexity"] = "Complexa"
+            
+            
+            prog_preview_roman = []
+            
+            
+            distinct_chords_for_preview = []
+            seen_chord_names = set() # Usamos um set para rastrear nomes (ex: "C major triad")
+
+            for ch in chord_stream_list:
+                if len(distinct_chords_for_preview) >= 4:
+                    break # Já temos 4 acordes para a prévia
+
+                current_chord_name = ch.pitchedCommonName
+                if current_chord_name not in seen_chord_names:
+                    # Se for um nome de acorde que ainda não vimos, adiciona
+                    distinct_chords_for_preview.append(ch)
+                    seen_chord_names.add(current_chord_name)
+            
+
+            for ch_preview in distinct_chords_for_preview:
+                if key_obj:
+                    try:
+                        # Tenta obter o grau romano
+                        rn = roman.romanNumeralFromChord(ch_preview, key_obj)
+                        prog_preview_roman.append(rn.figure)
+                    except Exception:
+                        prog_preview_roman.append(ch_preview.pitchedCommonName.replace('-', '♭').replace('#', '♯'))
+                else:
+                    # Se a tonalidade é indefinida, usa o nome do acorde
+                    prog_preview_roman.append(ch_preview.pitchedCommonName.replace('-', '♭').replace('#', '♯'))
+            
+            if prog_preview_roman:
+                results["harmonic_progression_preview"] = " -> ".join(prog_preview_roman)
+
+        # Geração do texto de análise
+        build_analysis_text(results, suspicious_ts_flag, original_ts_str)
+    
+        # FIM DA ANÁLISE DETALHADA
+
+    except Exception as e:
+        logger.error(f"Erro na análise com music21: {e}")
+        results["ai_analysis_text"] = f"Erro ao processar o arquivo MIDI: {str(e)}"
+    
+    return results
+
+
+def analyze_midi_with_music21(file_path, budget_seconds=None, sample_bars=32):
+    """
+    Função de análise de MIDI robusta, com tratamento de exceções 
+    e validação de sanidade para BPM, Compasso e Tonalidade.
+    Executa as duas etapas em sequência (ver analyze_prompt_features e analyze_detailed_features);
+    com 'budget_seconds', as características harmônicas podem vir de uma amostra de compassos.
+    """
+    results, s, state = analyze_prompt_features(file_path)
+    if state is not None:
+        analyze_detailed_features(s, results, state, budget_seconds, sample_bars)
+    return results, s
+
+
+@contextmanager
+def temporary_midi_file(file_content):
+    """Grava o conteúdo num arquivo .mid temporário (o music21 lê do disco) e o apaga ao sair."""
+    temp_file_path = None
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.mid') as tmp:
+            tmp.write(file_content)
+            temp_file_path = tmp.name
+        yield temp_file_path
+    finally:
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+
+
+def analyze_upload_task(file_content, budget_seconds=None, sample_bars=32):
+    """
+    Análise de um upload nos processos do pool (ver analysis_pool.py). É um gerador:
+    produz primeiro o que o prompt precisa (etapa 1: análise, textos das mãos e o estado
+    do compasso), para a geração começar, e retorna a análise completa (etapa 2).
+    """
+    with temporary_midi_file(file_content) as temp_file_path:
+        results, s, state = analyze_prompt_features(temp_file_path)
+
+    if not s or not s.flat.notesAndRests:
+        return {"analysis": results, "error": "Falha ao analisar o arquivo ou arquivo está vazio."}
+
+    rh_part, lh_part = separate_piano_parts(s)
+    yield {
+        "analysis": dict(results), "rh": midi_stream_to_text(rh_part), "lh": midi_stream_to_text(lh_part),
+        "suspicious_ts_flag": bool(state and state["suspicious_ts_flag"]),
+        "original_ts_str": state["original_ts_str"] if state else "",
+    }
+    if state is not None:
+        analyze_detailed_features(s, results, state, budget_seconds, sample_bars)
+    return {"analysis": results, "error": None}
+
+
+def refine_analysis_task(file_content):
+    """
+    Análise completa, sem orçamento de tempo, de um upload cuja análise saiu aproximada.
+    Retorna os resultados; os campos harmônicos substituem os aproximados (ver app.py).
+    """
+    with temporary_midi_file(file_content) as temp_file_path:
+        results, _ = analyze_midi_with_music21(temp_file_path)
+    return results
+
+
+# Tarefas executáveis pelo pool de processos (analysis_pool.py): geradores (com resultados
+# parciais) ou funções comuns
+TASKS = {"upload": analyze_upload_task, "refine": refine_analysis_task}
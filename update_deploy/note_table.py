@@ -0,0 +1,143 @@
+"""
+Tabela de notas expansível com estatísticas incrementais, para sessões de composição.
+
+NoteTable guarda as notas de uma mão num array NOTE_DTYPE (ver corpus.py) com
+capacidade dobrada sob demanda: anexar k notas custa O(k) amortizado, sem
+recopiar a peça inteira. As notas ficam em ordem de onset (cada lote anexado
+começa no fim do anterior), então o final da peça para o prompt sai de uma
+fatia do fim da tabela.
+
+PieceStats acumula, só com as notas novas de cada lote, o que a análise do
+upload calcula sobre a peça inteira: histograma de classes de altura (para a
+tonalidade), notas por compasso, extensão e duração total.
+"""
+import numpy as np
+
+import corpus
+
+# Perfis de Krumhansl-Kessler (tonalidade por correlação com o histograma de classes de altura)
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+_ROTATIONS = np.arange(12)[None, :] - np.arange(12)[:, None] # _ROTATIONS[t, pc] = pc - t
+_KEY_PROFILES = np.concatenate((MAJOR_PROFILE[_ROTATIONS % 12], MINOR_PROFILE[_ROTATIONS % 12]))
+_KEY_PROFILES = _KEY_PROFILES - _KEY_PROFILES.mean(axis=1, keepdims=True)
+
+
+def estimate_key(chroma):
+    """(tônica, menor) por correlação do histograma de classes de altura com os 24 perfis; None sem notas."""
+    if not chroma.any():
+        return None
+    best = int(np.argmax(_KEY_PROFILES @ (chroma - chroma.mean())))
+    return best % 12, best >= 12
+
+
+def key_text(estimate):
+    """Tonalidade de estimate_key no formato da análise do upload (ex: 'F♯ Menor')."""
+    if estimate is None:
+        return "Indefinido"
+    tonic, minor = estimate
+    name = corpus.PITCH_CLASS_NAMES[tonic].replace('-', '♭').replace('#', '♯')
+    return f"{name} {'Menor' if minor else 'Maior'}"
+
+
+class NoteTable:
+
+    def __init__(self, notes=None, capacity=256):
+        self._data = np.zeros(max(capacity, len(notes) if notes is not None else 0), dtype=corpus.NOTE_DTYPE)
+        self._size = 0
+        self._end = 0.0
+        if notes is not None and len(notes):
+            self.append(notes)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def notes(self):
+        """View das notas (sem cópia)."""
+        return self._data[:self._size]
+
+    @property
+    def end(self):
+        """Fim da última nota soando (em quarterLength); 0 se vazia."""
+        return self._end
+
+    def append(self, notes):
+        """Anexa um lote de notas (ordenado aqui por onset e altura)."""
+        if not len(notes):
+            return
+        notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+        needed = self._size + len(notes)
+        if needed > len(self._data):
+            grown = np.zeros(max(needed, 2 * len(self._data)), dtype=corpus.NOTE_DTYPE)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        self._data[self._size:needed] = notes
+        self._size = needed
+        self._end = max(self._end, float((notes['onset'] + notes['duration']).max()))
+
+    def tail_events(self, limit=64):
+        """
+        Os últimos 'limit' eventos no formato de midi_stream_to_text, lendo só o fim da tabela:
+        recua até cobrir 'limit' onsets distintos (cada onset vira pelo menos um evento).
+        """
+        if not self._size:
+            return []
+        window = 4 * limit
+        while True:
+            start = max(0, self._size - window)
+            onsets = self._data['onset'][start:self._size]
+            distinct = 1 + int(np.count_nonzero(np.diff(onsets) > 1e-6))
+            if distinct > limit or start == 0:
+                break
+            window *= 2
+        # Começa num limite de onset para não partir um acorde ao meio
+        tail = self._data[start:self._size]
+        if start > 0:
+            first_full = np.flatnonzero(np.diff(tail['onset']) > 1e-6)
+            tail = tail[first_full[0] + 1:] if len(first_full) else tail
+        return corpus.notes_to_events(tail, limit)
+
+
+class PieceStats:
+
+    def __init__(self, bar_length=4.0):
+        self.bar_length = bar_length
+        self.chroma = np.zeros(12)
+        self.bar_counts = np.zeros(0, dtype=np.int64)
+        self.note_count = 0
+        self.low = None
+        self.high = None
+        self.end = 0.0
+
+    def update(self, notes):
+        """Acumula um lote de notas novas: O(tamanho do lote)."""
+        if not len(notes):
+            return
+        pitch = notes['pitch'].astype(np.int64)
+        self.chroma += np.bincount(pitch % 12, weights=notes['duration'], minlength=12)
+        bars = (notes['onset'] // self.bar_length).astype(np.int64)
+        counts = np.bincount(bars)
+        if len(counts) > len(self.bar_counts):
+            self.bar_counts = np.pad(self.bar_counts, (0, len(counts) - len(self.bar_counts)))
+        self.bar_counts[:len(counts)] += counts
+        self.note_count += len(notes)
+        self.low = int(pitch.min()) if self.low is None else min(self.low, int(pitch.min()))
+        self.high = int(pitch.max()) if self.high is None else max(self.high, int(pitch.max()))
+        self.end = max(self.end, float((notes['onset'] + notes['duration']).max()))
+
+    def key(self):
+        """(tônica, menor) por correlação do histograma acumulado com os 24 perfis; None sem notas."""
+        return estimate_key(self.chroma)
+
+    def key_text(self):
+        """Tonalidade no formato da análise do upload (ex: 'F♯ Menor')."""
+        return key_text(self.key())
+
+    def summary(self):
+        num_bars = int(np.ceil(self.end / self.bar_length)) if self.end else 0
+        return {
+            "key": self.key_text(), "num_bars": num_bars, "notes": self.note_count,
+            "notes_per_bar": round(self.note_count / num_bars, 2) if num_bars else 0.0,
+            "pitch_range": [self.low, self.high], "last_offset": round(self.end, 4),
+        }
@@ -0,0 +1,206 @@
+"""
+Índice de frases do corpus para prompts com recuperação (few-shot).
+
+Cada peça de Datasets/*.zip é dividida em janelas de PHRASE_QL quarterLengths
+(mão direita e esquerda juntas). Para cada frase guardamos o vetor de
+características de similarity.feature_vector e as notas, em arrays NumPy
+abertos com memory-map. Na consulta, o final da música enviada é comparado
+com todas as frases por produto escalar (alguns ms mesmo com dezenas de
+milhares de frases) e as mais próximas são transpostas para a tonalidade da
+consulta e renderizadas numa notação compacta, respeitando um orçamento de tokens.
+
+Uso:
+    python phrase_index.py build [--workers N]
+"""
+import os
+import json
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import corpus
+import corpus_store
+from similarity import feature_vector, FEATURE_DIM
+
+logger = logging.getLogger(__name__)
+
+PHRASE_INDEX_DIR = os.getenv(
+    "PHRASE_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus_index', 'phrases')
+)
+
+PHRASE_QL = 8.0                # Duração de cada frase (2 compassos de 4/4)
+MIN_PHRASE_NOTES = 6           # Janelas quase vazias não viram exemplos
+MAX_PHRASES_PER_PIECE = 48     # Evita que peças longas dominem o índice
+MAX_EXAMPLE_EVENTS = 24        # Eventos por mão na renderização de um exemplo
+CHARS_PER_TOKEN = 4            # Estimativa grosseira usada no orçamento de tokens
+
+
+def split_phrases(notes):
+    """Divide uma peça em janelas de PHRASE_QL; onsets relativos ao início da janela, part 0 = RH, 1 = LH."""
+    rh, lh = corpus.split_hands(notes)
+    hands = rh.copy()
+    hands['part'] = 0
+    if lh is not None:
+        lh = lh.copy()
+        lh['part'] = 1
+        hands = np.concatenate((hands, lh))
+        hands = hands[np.lexsort((hands['pitch'], hands['onset']))]
+
+    window = np.floor(hands['onset'] / PHRASE_QL).astype(np.int64)
+    phrases = []
+    for w in np.unique(window):
+        phrase = hands[window == w].copy()
+        if len(phrase) < MIN_PHRASE_NOTES:
+            continue
+        phrase['onset'] -= w * PHRASE_QL
+        phrases.append(phrase)
+    if len(phrases) > MAX_PHRASES_PER_PIECE:
+        # Amostragem uniforme ao longo da peça
+        keep = np.linspace(0, len(phrases) - 1, MAX_PHRASES_PER_PIECE).astype(np.int64)
+        phrases = [phrases[i] for i in keep]
+    return phrases
+
+
+def _phrases_for_member(task):
+    """Worker do build paralelo: retorna a lista de frases de um membro do zip."""
+    archive_path, member_name = task
+    try:
+        notes, _ = corpus.extract_notes(corpus.read_member(archive_path, member_name))
+        return split_phrases(notes) if len(notes) else []
+    except Exception as e:
+        logger.warning(f"Falha ao processar {member_name} de {archive_path}: {e}")
+        return []
+
+
+def build_phrase_index(index_dir=PHRASE_INDEX_DIR, archive_paths=None, workers=None):
+    """Constrói o índice de frases a partir dos zips. Retorna o número de frases."""
+    os.makedirs(index_dir, exist_ok=True)
+    tasks = [(archive_path, info.filename) for archive_path, info in corpus_store.iter_unique_members(archive_paths)]
+
+    sources, features, tonics, phrase_source, pointers, chunks = [], [], [], [], [0], []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for task, phrases in zip(tasks, pool.map(_phrases_for_member, tasks, chunksize=8)):
+            if not phrases:
+                continue
+            sources.append(corpus.source_id(*task))
+            for phrase in phrases:
+                features.append(feature_vector(phrase))
+                tonics.append(corpus.dominant_pitch_class(phrase))
+                phrase_source.append(len(sources) - 1)
+                pointers.append(pointers[-1] + len(phrase))
+                chunks.append(phrase)
+
+    arrays = {
+        "features": np.array(features, dtype=np.float32).reshape(-1, FEATURE_DIM),
+        "tonics": np.array(tonics, dtype=np.int8),
+        "sources": np.array(phrase_source, dtype=np.int32),
+        "pointers": np.array(pointers, dtype=np.int64),
+        "notes": np.concatenate(chunks) if chunks else np.zeros(0, dtype=corpus.NOTE_DTYPE),
+    }
+    for name, array in arrays.items():
+        tmp_path = os.path.join(index_dir, f"{name}.tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(index_dir, f"{name}.npy"))
+
+    manifest_path = os.path.join(index_dir, 'manifest.json')
+    with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({"phrase_ql": PHRASE_QL, "feature_dim": FEATURE_DIM, "sources": sources}, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    logger.info(f"Índice de frases construído: {len(features)} frases de {len(sources)} peças.")
+    return len(features)
+
+
+def compact_notation(events):
+    """Notação compacta de uma mão: 'C4/1 [C4 E4 G4]/0.5 r/1' (altura/duração em quarterLength)."""
+    tokens = []
+    for ev in events:
+        ql = f"{ev['quarterLength']:g}"
+        if ev["type"] == "note":
+            tokens.append(f"{ev['pitch']}/{ql}")
+        elif ev["type"] == "chord":
+            tokens.append(f"[{' '.join(ev['pitches'])}]/{ql}")
+        else:
+            tokens.append(f"r/{ql}")
+    return " ".join(tokens)
+
+
+class PhraseIndex:
+    """Índice de frases somente-leitura, carregado com memory-map."""
+
+    def __init__(self, index_dir=PHRASE_INDEX_DIR):
+        with open(os.path.join(index_dir, 'manifest.json'), encoding='utf-8') as f:
+            self.source_names = json.load(f)["sources"]
+        load = lambda name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r')
+        self.features = load("features")
+        self.tonics = load("tonics")
+        self.sources = load("sources")
+        self.pointers = load("pointers")
+        self.notes = load("notes")
+
+    def __len__(self):
+        return len(self.features)
+
+    def nearest(self, notes, k=4):
+        """Índices das k frases mais próximas (cosseno) de uma tabela de notas."""
+        if not len(self) or not len(notes):
+            return []
+        scores = np.asarray(self.features @ feature_vector(notes))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(i) for i in top[np.argsort(-scores[top])]]
+
+    def render(self, phrase_id, target_tonic=None):
+        """Renderiza uma frase (RH/LH) em notação compacta, transposta para target_tonic se informado."""
+        phrase = np.array(self.notes[self.pointers[phrase_id]:self.pointers[phrase_id + 1]])
+        if target_tonic is not None:
+            shift = (target_tonic - int(self.tonics[phrase_id])) % 12
+            phrase['pitch'] += shift - 12 if shift > 6 else shift
+        rh = phrase[phrase['part'] == 0]
+        lh = phrase[phrase['part'] == 1]
+        lines = [f"RH: {compact_notation(corpus.notes_to_events(rh)[:MAX_EXAMPLE_EVENTS])}"]
+        if len(lh):
+            lines.append(f"LH: {compact_notation(corpus.notes_to_events(lh)[:MAX_EXAMPLE_EVENTS])}")
+        return "\n".join(lines)
+
+    def style_examples(self, rh_text, lh_text, token_budget=600, k=4):
+        """
+        Seleciona e renderiza as frases mais próximas do final da música
+        (textos JSON de midi_stream_to_text), até o orçamento de tokens.
+        Retorna o texto dos exemplos ou "" se nada couber.
+        """
+        notes = np.concatenate((corpus.events_to_notes(rh_text, 0), corpus.events_to_notes(lh_text, 1)))
+        if not len(notes):
+            return ""
+        notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+        tonic = corpus.dominant_pitch_class(notes)
+
+        examples, used = [], 0
+        for n, phrase_id in enumerate(self.nearest(notes, k), start=1):
+            example = f"Exemplo {n}:\n{self.render(phrase_id, tonic)}"
+            cost = len(example) // CHARS_PER_TOKEN + 1
+            if used + cost > token_budget:
+                break
+            examples.append(example)
+            used += cost
+        return "\n\n".join(examples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice de frases do corpus para prompts few-shot.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="Constrói o índice de frases a partir de Datasets/*.zip")
+    p_build.add_argument("--datasets", default=corpus.DATASETS_DIR)
+    p_build.add_argument("--index", default=PHRASE_INDEX_DIR)
+    p_build.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_phrase_index(args.index, corpus.list_archives(args.datasets), args.workers)
+
+
+if __name__ == '__main__':
+    main()
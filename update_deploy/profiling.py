@@ -0,0 +1,303 @@
+"""
+Profiling sob demanda de uma requisição, com flamegraph.
+
+Quando um MIDI demora, não dá para ver onde o tempo vai dentro do music21
+(converter.parse, chordify, romanNumeralFromChord, stream.write). Aqui uma
+requisição escolhida (cabeçalho X-Profile ou amostragem, ver app.py) roda
+sob um de dois profilers:
+  - "sample" (padrão): uma thread amostra as pilhas das threads da requisição
+    a cada 'interval' segundos (sys._current_frames). Gera as pilhas colapsadas
+    (formato do flamegraph.pl: "a;b;c contagem") e um flamegraph em SVG.
+  - "cprofile": o cProfile em cada thread da requisição; gera o .pstats e um
+    resumo em texto pelas funções de maior tempo acumulado.
+A análise que roda no pool de processos é perfilada lá (WorkerProfiler) e
+volta junto com o resultado, entrando na mesma saída sob a raiz "analysis_pool".
+Cada perfil é gravado em output_dir com o hash do arquivo, o nome e os tempos
+de cada etapa (stage()) num .json.
+
+Desligado, nada disto roda: as rotas só testam se há perfil (None).
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import html
+import zlib
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+MODES = ("sample", "cprofile")
+_NO_STAGE = nullcontext()
+
+
+def _frame_label(code, module, cache):
+    label = cache.get(code)
+    if label is None:
+        label = f"{module}:{getattr(code, 'co_qualname', code.co_name)}".replace(";", ",")
+        cache[code] = label
+    return label
+
+
+class StackSampler:
+    """Amostra periodicamente as pilhas das threads registradas; 'collapsed' conta cada pilha (raiz;...;folha)."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.collapsed = Counter()
+        self.samples = 0
+        self._threads = {}            # ident -> rótulo da raiz
+        self._labels = {}             # code -> rótulo do quadro
+        self._stop = threading.Event()
+        self._thread = None
+
+    def track(self, ident, root):
+        self._threads[ident] = root
+
+    def untrack(self, ident):
+        self._threads.pop(ident, None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="profile-sampler")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return dict(self.collapsed)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, root in list(self._threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code, frame.f_globals.get("__name__", "?"), self._labels))
+                    frame = frame.f_back
+                stack.append(root)
+                self.collapsed[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+
+class _StatsHolder:
+    """Objeto que o pstats.Stats aceita no lugar de um cProfile.Profile (estatísticas já coletadas)."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class WorkerProfiler:
+    """Profiling de uma tarefa no processo do pool: amostras da thread principal ou cProfile."""
+
+    def __init__(self, mode="sample", interval=0.005):
+        self.mode = mode
+        self._sampler = StackSampler(interval) if mode == "sample" else None
+        self._profiler = cProfile.Profile() if mode == "cprofile" else None
+
+    def start(self):
+        if self._sampler is not None:
+            self._sampler.track(threading.get_ident(), "analysis_pool")
+            self._sampler.start()
+        else:
+            self._profiler.enable()
+        return self
+
+    def stop(self):
+        """Dados do perfil, para enviar ao processo da requisição (RequestProfile.add_worker_profile)."""
+        if self._sampler is not None:
+            return {"mode": "sample", "collapsed": self._sampler.stop()}
+        self._profiler.disable()
+        self._profiler.create_stats()
+        return {"mode": "cprofile", "stats": self._profiler.stats}
+
+
+class RequestProfile:
+
+    def __init__(self, mode="sample", interval=0.005):
+        self.mode = mode
+        self.interval = interval
+        self.id = uuid.uuid4().hex[:12]
+        self.tags = {}
+        self.stages = []
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+        self._profilers = []          # cProfile.Profile ou estatísticas vindas do pool
+        self._sampler = StackSampler(interval).start() if mode == "sample" else None
+        self._worker_collapsed = Counter()
+
+    def worker_options(self):
+        """Opções para o pool de análise perfilar a tarefa (ver analysis_pool.py)."""
+        return {"mode": self.mode, "interval": self.interval}
+
+    @contextmanager
+    def track(self, root):
+        """Perfila a thread atual enquanto durar o 'with'; 'root' é a raiz das pilhas dela."""
+        ident = threading.get_ident()
+        profiler = None
+        if self._sampler is not None:
+            self._sampler.track(ident, root)
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                profiler = None # Outro profiler já ativo nesta thread
+        try:
+            yield
+        finally:
+            if self._sampler is not None:
+                self._sampler.untrack(ident)
+            elif profiler is not None:
+                profiler.disable()
+                with self._lock:
+                    self._profilers.append(profiler)
+
+    def wrap(self, fn, root):
+        """fn perfilada na thread em que rodar (ex: a etapa de geração no executor)."""
+        def profiled(*args, **kwargs):
+            with self.track(root):
+                return fn(*args, **kwargs)
+        return profiled
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages.append({"stage": name, "start_ms": round((started - self.started) * 1000, 1),
+                                    "ms": round((time.perf_counter() - started) * 1000, 1)})
+
+    def add_worker_profile(self, data):
+        """Junta o perfil que veio do processo do pool (WorkerProfiler.stop)."""
+        if not data or data.get("mode") != self.mode:
+            return
+        with self._lock:
+            if self.mode == "sample":
+                self._worker_collapsed.update(data["collapsed"])
+            else:
+                self._profilers.append(_StatsHolder(data["stats"]))
+
+    def finish(self, output_dir):
+        """Para o profiler e grava os arquivos; retorna o resumo (id, tempos das etapas, arquivos). Idempotente."""
+        if self.finished is not None:
+            return self.finished
+        total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        base = "_".join([time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at)),
+                         str(self.tags.get("file_hash") or "sem-hash")[:16], self.id])
+        os.makedirs(output_dir, exist_ok=True)
+        files = []
+        if self._sampler is not None:
+            collapsed = Counter(self._sampler.stop())
+            collapsed.update(self._worker_collapsed)
+            samples = sum(collapsed.values())
+            with open(os.path.join(output_dir, base + ".collapsed"), "w", encoding="utf-8") as f:
+                for stack, count in sorted(collapsed.items()):
+                    f.write(f"{stack} {count}\n")
+            title = f"{self.tags.get('filename') or ''} {self.tags.get('file_hash') or ''} ({total_ms:.0f} ms)"
+            with open(os.path.join(output_dir, base + ".svg"), "w", encoding="utf-8") as f:
+                f.write(flamegraph_svg(collapsed, title.strip()))
+            files += [base + ".collapsed", base + ".svg"]
+        else:
+            samples = None
+            with self._lock:
+                profilers = list(self._profilers)
+            if profilers:
+                stats = pstats.Stats(profilers[0])
+                for profiler in profilers[1:]:
+                    stats.add(profiler)
+                stats.dump_stats(os.path.join(output_dir, base + ".pstats"))
+                summary = io.StringIO()
+                stats.stream = summary
+                stats.sort_stats("cumulative").print_stats(40)
+                with open(os.path.join(output_dir, base + ".txt"), "w", encoding="utf-8") as f:
+                    f.write(summary.getvalue())
+                files += [base + ".pstats", base + ".txt"]
+        self.finished = {
+            "id": self.id, "mode": self.mode, **self.tags, "total_ms": total_ms, "stages": self.stages,
+            "samples": samples, "interval_ms": self.interval * 1000, "files": files + [base + ".json"],
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+        }
+        with open(os.path.join(output_dir, base + ".json"), "w", encoding="utf-8") as f:
+            json.dump(self.finished, f, ensure_ascii=False, indent=2)
+        return self.finished
+
+
+def profile_stage(profile, name):
+    """profile.stage(name), ou um contexto vazio sem perfil."""
+    return _NO_STAGE if profile is None else profile.stage(name)
+
+
+def prune_profiles(output_dir, keep):
+    """Apaga os perfis mais antigos de output_dir, mantendo os últimos 'keep' (por .json)."""
+    try:
+        metas = sorted(name for name in os.listdir(output_dir) if name.endswith(".json"))
+    except FileNotFoundError:
+        return
+    for name in metas[:max(0, len(metas) - keep)]:
+        base = name[:-len(".json")]
+        for suffix in (".json", ".collapsed", ".svg", ".pstats", ".txt"):
+            try:
+                os.unlink(os.path.join(output_dir, base + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def flamegraph_svg(collapsed, title="", width=1200, frame_height=16, min_width=0.5):
+    """Flamegraph (raiz embaixo) em SVG a partir das pilhas colapsadas; quadros com menos de min_width px são omitidos."""
+    root = {"count": 0, "children": {}}
+    for stack, count in collapsed.items():
+        node = root
+        node["count"] += count
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, {"count": 0, "children": {}})
+            node["count"] += count
+    total = root["count"] or 1
+    scale = (width - 20) / total
+
+    rects, max_depth = [], 0
+    pending = [("all", root, 10.0, 0)]
+    while pending:
+        name, node, x, depth = pending.pop()
+        w = node["count"] * scale
+        if w < min_width:
+            continue
+        rects.append((name, node["count"], x, depth, w))
+        max_depth = max(max_depth, depth)
+        child_x = x
+        for child_name, child in sorted(node["children"].items()):
+            pending.append((child_name, child, child_x, depth + 1))
+            child_x += child["count"] * scale
+
+    height = (max_depth + 1) * frame_height + 40
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+             f'<rect width="100%" height="100%" fill="#f8f8f8"/>',
+             f'<text x="10" y="20" font-size="14">{html.escape(title)}</text>']
+    for name, count, x, depth, w in rects:
+        y = height - (depth + 1) * frame_height - 4
+        hue = zlib.crc32(name.encode("utf-8")) % 50
+        label = html.escape(name)
+        parts.append(f'<g><title>{label} ({count} amostras, {100 * count / total:.1f}%)</title>'
+                     f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{frame_height - 1}" fill="hsl({hue},80%,60%)"/>')
+        chars = int(w / 7)
+        if chars >= 3:
+            text = name if len(name) <= chars else name[:chars - 2] + ".."
+            parts.append(f'<text x="{x + 3:.1f}" y="{y + frame_height - 4}">{html.escape(text)}</text>')
+        parts.append('</g>')
+    parts.append('</svg>')
+    return "\n".join(parts)
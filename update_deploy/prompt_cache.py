@@ -0,0 +1,78 @@
+"""
+Cache de respostas da geração remota, por prompt.
+
+A continuação depende só do prompt renderizado (campos da análise usados no
+prompt, fim das mãos direita e esquerda, exemplos de estilo e formato da
+resposta), do modelo e das configurações de geração; não do arquivo inteiro.
+Uploads diferentes com o mesmo final e as mesmas características globais
+geram o mesmo prompt e reaproveitam a resposta.
+
+A chave é o hash de (modelo, configurações, prompt). As entradas expiram após
+ttl_seconds e a menos usada é despejada quando o cache enche. stats() traz
+acertos, faltas, desvios (pedidos de resposta nova) e despejos.
+"""
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def prompt_cache_key(model_name, prompt, generation_config=None):
+    """Hash (hex de 32 caracteres) do prompt renderizado com o modelo e as configurações de geração."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(model_name.encode('utf-8'))
+    h.update(b"\0")
+    h.update(json.dumps(generation_config or {}, sort_keys=True).encode('utf-8'))
+    h.update(b"\0")
+    h.update(prompt.encode('utf-8'))
+    return h.hexdigest()
+
+
+class PromptCache:
+
+    def __init__(self, max_entries=256, ttl_seconds=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # chave -> (instante, resposta)
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_bypass(self):
+        """Conta um pedido que ignorou o cache (resposta nova solicitada)."""
+        with self._lock:
+            self.bypasses += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses, "bypasses": self.bypasses,
+                "evictions": self.evictions, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
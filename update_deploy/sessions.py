@@ -0,0 +1,122 @@
+"""
+Sessões de composição: estender uma peça várias vezes sem reenviar o arquivo.
+
+A peça acumulada fica em memória como duas NoteTables (mão direita e esquerda)
+mais as estatísticas incrementais (ver note_table.py). Cada extensão:
+  - monta o prompt a partir do fim das tabelas (custo proporcional ao trecho do prompt,
+    não ao tamanho da peça);
+  - anexa as notas geradas e atualiza tonalidade, compassos e extensão só com elas.
+O music21 roda uma única vez, na criação da sessão.
+"""
+import io
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import corpus
+from note_table import NoteTable, PieceStats
+
+PROMPT_EVENT_LIMIT = 64 # Mesmo limite de midi_stream_to_text
+
+
+class CompositionSession:
+
+    def __init__(self, notes, bpm=120, time_signature="4/4"):
+        self.id = uuid.uuid4().hex
+        self.bpm = bpm if isinstance(bpm, (int, float)) else 120
+        self.time_signature = time_signature if time_signature and time_signature != "N/A" else "4/4"
+        numerator, denominator = (int(x) for x in self.time_signature.split('/'))
+        self.numerator, self.denominator = numerator, denominator
+
+        rh, lh = corpus.split_hands(notes)
+        self.right_hand = NoteTable(rh)
+        self.left_hand = NoteTable(lh)
+        self.stats = PieceStats(bar_length=numerator * 4.0 / denominator)
+        self.stats.update(np.concatenate((self.right_hand.notes, self.left_hand.notes)))
+
+        self.lock = threading.Lock() # Extensões da mesma sessão são sequenciais
+        self.extensions = 0
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    @property
+    def last_offset(self):
+        return max(self.right_hand.end, self.left_hand.end)
+
+    def prompt_inputs(self):
+        """(dados da análise para o prompt, texto da mão direita, texto da mão esquerda)."""
+        analysis = {
+            "key": self.stats.key_text(), "bpm": self.bpm, "time_signature": self.time_signature,
+            "last_offset": round(self.last_offset, 4),
+        }
+        rh_text = json.dumps(self.right_hand.tail_events(PROMPT_EVENT_LIMIT), indent=2)
+        lh_text = json.dumps(self.left_hand.tail_events(PROMPT_EVENT_LIMIT), indent=2)
+        return analysis, rh_text, lh_text
+
+    def extend(self, generated_text):
+        """Anexa uma continuação ({"right_hand", "left_hand"}). Retorna o número de notas novas."""
+        data = json.loads(generated_text)
+        rh_new = corpus.events_to_notes(data.get("right_hand") or [], part=0)
+        lh_new = corpus.events_to_notes(data.get("left_hand") or [], part=1)
+        new_notes = np.concatenate((rh_new, lh_new))
+        if not len(new_notes):
+            return 0
+        # A continuação deve começar no fim da peça; corrige respostas que recomeçam antes
+        start = self.last_offset
+        first = float(new_notes['onset'].min())
+        if first < start - 1e-6:
+            rh_new['onset'] += start - first
+            lh_new['onset'] += start - first
+            new_notes['onset'] += start - first
+        self.right_hand.append(rh_new)
+        self.left_hand.append(lh_new)
+        self.stats.update(new_notes)
+        self.extensions += 1
+        self.updated_at = time.time()
+        return len(new_notes)
+
+    def summary(self):
+        summary = self.stats.summary()
+        summary.update({"session_id": self.id, "bpm": self.bpm, "time_signature": self.time_signature,
+                        "extensions": self.extensions})
+        return summary
+
+    def to_midi_bytes(self):
+        """A peça acumulada inteira como MIDI (uma faixa por mão)."""
+        mid = corpus.notes_to_midi([self.right_hand.notes, self.left_hand.notes],
+                                   self.bpm, self.numerator, self.denominator)
+        buffer = io.BytesIO()
+        mid.save(file=buffer)
+        return buffer.getvalue()
+
+
+class SessionStore:
+    """Sessões em memória, com despejo da menos usada e expiração por inatividade."""
+
+    def __init__(self, max_sessions=100, ttl_seconds=6 * 3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def add(self, session):
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session.id
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if time.time() - session.updated_at > self.ttl_seconds:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
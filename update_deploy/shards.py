@@ -0,0 +1,215 @@
+"""
+Shards de treino tokenizados a partir dos corpora MIDI.
+
+O build lê os MIDIs direto dos zips de Datasets/ (tokenização paralela por
+arquivo, ver tokenizer.py), corta cada peça em janelas de WINDOW tokens
+(a última completada com PAD) e grava shards .npy de SHARD_WINDOWS janelas,
+mais um index.json com os shards e o intervalo de janelas de cada peça.
+
+O carregamento usa memory-map: ShardDataset[i] devolve uma view da janela
+sem cópia, e ShardLoader monta lotes embaralhados com prefetch em threads,
+de modo que o treino não espera por I/O nem por parse de MIDI.
+
+Uso:
+    python shards.py build [--window 512] [--workers N]
+"""
+import os
+import json
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import corpus
+import corpus_store
+import tokenizer
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR = os.getenv(
+    "SHARDS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus_index', 'shards')
+)
+
+WINDOW = 512
+SHARD_WINDOWS = 4096
+
+
+def _tokens_for_member(task):
+    """Worker do build paralelo: tokens de um membro do zip (None se falhar)."""
+    archive_path, member_name = task
+    try:
+        notes, _ = corpus.extract_notes(corpus.read_member(archive_path, member_name))
+        if not len(notes):
+            return None
+        rh, lh = corpus.split_hands(notes)
+        return tokenizer.encode_piece(corpus.notes_to_events(rh), corpus.notes_to_events(lh))
+    except Exception as e:
+        logger.warning(f"Falha ao tokenizar {member_name} de {archive_path}: {e}")
+        return None
+
+
+def _to_windows(tokens, window):
+    """Corta uma sequência em janelas de tamanho fixo, completando a última com PAD."""
+    num_windows = -(-len(tokens) // window)
+    padded = np.full(num_windows * window, tokenizer.PAD, dtype=tokenizer.TOKEN_DTYPE)
+    padded[:len(tokens)] = tokens
+    return padded.reshape(num_windows, window)
+
+
+def build_shards(shards_dir=SHARDS_DIR, archive_paths=None, window=WINDOW, workers=None):
+    """Tokeniza o corpus e grava os shards. Retorna o número total de janelas."""
+    os.makedirs(shards_dir, exist_ok=True)
+    tasks = [(archive_path, info.filename) for archive_path, info in corpus_store.iter_unique_members(archive_paths)]
+
+    shards, pieces = [], []
+    buffer, buffered = [], 0
+    total_windows = 0
+
+    def flush():
+        nonlocal buffer, buffered
+        if not buffered:
+            return
+        name = f"shard_{len(shards):05d}.npy"
+        tmp_path = os.path.join(shards_dir, name + ".tmp.npy")
+        np.save(tmp_path, np.concatenate(buffer))
+        os.replace(tmp_path, os.path.join(shards_dir, name))
+        shards.append({"file": name, "windows": buffered})
+        buffer, buffered = [], 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for task, tokens in zip(tasks, pool.map(_tokens_for_member, tasks, chunksize=8)):
+            if tokens is None:
+                continue
+            windows = _to_windows(tokens, window)
+            # Uma peça pode atravessar a fronteira entre shards; o índice guarda a posição global
+            pieces.append({"source": corpus.source_id(*task), "first_window": total_windows,
+                           "windows": len(windows), "tokens": int(len(tokens))})
+            total_windows += len(windows)
+            while len(windows):
+                take = min(len(windows), SHARD_WINDOWS - buffered)
+                buffer.append(windows[:take])
+                buffered += take
+                windows = windows[take:]
+                if buffered == SHARD_WINDOWS:
+                    flush()
+    flush()
+
+    index = {"window": window, "vocab_size": tokenizer.VOCAB_SIZE, "pad_id": tokenizer.PAD,
+             "total_windows": total_windows, "shards": shards, "pieces": pieces}
+    index_path = os.path.join(shards_dir, 'index.json')
+    with open(index_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+
+    logger.info(f"{total_windows} janelas de {window} tokens em {len(shards)} shards ({len(pieces)} peças).")
+    return total_windows
+
+
+class ShardDataset:
+    """Acesso aleatório às janelas de todos os shards, sem cópia (memory-map)."""
+
+    def __init__(self, shards_dir=SHARDS_DIR):
+        with open(os.path.join(shards_dir, 'index.json'), encoding='utf-8') as f:
+            self.index = json.load(f)
+        self.window = self.index["window"]
+        self.shards = [np.load(os.path.join(shards_dir, s["file"]), mmap_mode='r') for s in self.index["shards"]]
+        self.starts = np.cumsum([0] + [len(s) for s in self.shards])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        """View (somente leitura) da janela i."""
+        shard = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return self.shards[shard][i - self.starts[shard]]
+
+    def take(self, indices, out=None):
+        """Copia as janelas 'indices' para um array (n, window), agrupando as leituras por shard."""
+        indices = np.asarray(indices)
+        if out is None:
+            out = np.empty((len(indices), self.window), dtype=tokenizer.TOKEN_DTYPE)
+        shard_ids = np.searchsorted(self.starts, indices, side='right') - 1
+        for shard in np.unique(shard_ids):
+            mask = shard_ids == shard
+            out[mask] = self.shards[shard][indices[mask] - self.starts[shard]]
+        return out
+
+
+class ShardLoader:
+    """
+    Itera lotes (batch_size, window) de um ShardDataset.
+    Com shuffle, a ordem das janelas muda a cada época (semente + época).
+    Os lotes são montados por num_workers threads com até 'prefetch' lotes adiantados.
+    Sem shuffle, cada lote contíguo dentro de um shard é uma view sem cópia.
+    """
+
+    def __init__(self, dataset, batch_size=32, shuffle=True, seed=0, num_workers=2, prefetch=4, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, 1)
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def __len__(self):
+        n = len(self.dataset)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    def _batch_indices(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(n)
+        else:
+            order = np.arange(n)
+        batches = [order[i:i + self.batch_size] for i in range(0, n, self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def _load(self, indices):
+        if not self.shuffle:
+            first, last = int(indices[0]), int(indices[-1])
+            shard = int(np.searchsorted(self.dataset.starts, first, side='right')) - 1
+            if last < self.dataset.starts[shard + 1]:
+                base = self.dataset.starts[shard]
+                return self.dataset.shards[shard][first - base:last - base + 1]
+        return self.dataset.take(indices)
+
+    def __iter__(self):
+        batches = self._batch_indices()
+        self.epoch += 1
+        if self.num_workers <= 0:
+            for indices in batches:
+                yield self._load(indices)
+            return
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            pending = [pool.submit(self._load, b) for b in batches[:self.prefetch]]
+            next_batch = len(pending)
+            for _ in range(len(batches)):
+                result = pending.pop(0).result()
+                if next_batch < len(batches):
+                    pending.append(pool.submit(self._load, batches[next_batch]))
+                    next_batch += 1
+                yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shards de treino tokenizados a partir de Datasets/*.zip.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="Tokeniza o corpus e grava os shards")
+    p_build.add_argument("--datasets", default=corpus.DATASETS_DIR)
+    p_build.add_argument("--shards", default=SHARDS_DIR)
+    p_build.add_argument("--window", type=int, default=WINDOW)
+    p_build.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_shards(args.shards, corpus.list_archives(args.datasets), args.window, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Busca por similaridade no corpus ("encontre peças parecidas com o meu upload").
+
+Cada arquivo do corpus recebe uma impressão digital com duas partes:
+  - assinatura MinHash dos n-gramas de intervalos da linha melódica
+    (invariante à transposição);
+  - vetor de características de croma, intervalos e ritmo (normalizado L2).
+
+O índice fica em disco como arrays NumPy abertos com memory-map, mais uma
+estrutura LSH (listas invertidas ordenadas por banda) para achar candidatos
+sem varrer o corpus inteiro. A construção é incremental (só refaz membros
+novos ou alterados dos zips) e paralela entre arquivos.
+
+Uso:
+    python similarity.py build [--workers N]
+    python similarity.py query arquivo.mid [-k 5]
+"""
+import os
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import corpus
+import corpus_store
+
+logger = logging.getLogger(__name__)
+
+CORPUS_INDEX_DIR = os.getenv(
+    "CORPUS_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus_index')
+)
+
+NGRAM = 4           # Tamanho dos n-gramas de intervalos
+NUM_PERM = 64       # Número de permutações do MinHash
+LSH_BANDS = 16      # NUM_PERM = LSH_BANDS * LSH_ROWS
+LSH_ROWS = NUM_PERM // LSH_BANDS
+MAX_INTERVAL = 36   # Intervalos maiores que 3 oitavas são saturados
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_EMPTY_SIGNATURE = np.uint64((1 << 61) - 1) # Valor sentinela para peças sem n-gramas
+_rng = np.random.RandomState(1234) # Semente fixa: assinaturas precisam ser reprodutíveis
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_BAND_MIX = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93], dtype=np.uint64)
+
+FEATURE_DIM = 12 + 13 + 8 + 4
+
+
+def melody_line(notes):
+    """Linha melódica aproximada: a nota mais aguda em cada onset."""
+    if not len(notes):
+        return np.zeros(0, dtype=np.int16)
+    onsets = notes['onset']
+    boundaries = np.flatnonzero(np.diff(onsets) > 1e-6) + 1
+    starts = np.concatenate(([0], boundaries))
+    return np.maximum.reduceat(notes['pitch'], starts)
+
+
+def interval_shingles(notes):
+    """Codifica cada n-grama de intervalos melódicos como um inteiro único (7 bits por intervalo)."""
+    intervals = np.clip(np.diff(melody_line(notes).astype(np.int64)), -MAX_INTERVAL, MAX_INTERVAL) + 64
+    if len(intervals) < NGRAM:
+        return np.zeros(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(intervals, NGRAM)
+    shifts = np.arange(NGRAM, dtype=np.int64) * 7
+    return np.unique((windows << shifts).sum(axis=1)).astype(np.uint64)
+
+
+def minhash_signature(shingles):
+    """Assinatura MinHash com NUM_PERM funções hash universais (a*x + b mod p)."""
+    if not len(shingles):
+        return np.full(NUM_PERM, _EMPTY_SIGNATURE, dtype=np.uint64)
+    hashed = (_PERM_A[:, None] * shingles[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return hashed.min(axis=1)
+
+
+def band_keys(signatures):
+    """Chave de cada banda LSH (LSH_BANDS por assinatura); aceita uma ou várias assinaturas."""
+    sig = np.atleast_2d(signatures).reshape(-1, LSH_BANDS, LSH_ROWS)
+    with np.errstate(over='ignore'):
+        return np.bitwise_xor.reduce(sig * _BAND_MIX[:LSH_ROWS], axis=2)
+
+
+def _normalized(hist):
+    total = hist.sum()
+    return hist / total if total > 0 else hist
+
+
+def feature_vector(notes):
+    """
+    Vetor de características (FEATURE_DIM) normalizado L2:
+    croma rotacionado para a classe de altura dominante, histograma de intervalos,
+    histograma de durações e estatísticas de densidade/registro.
+    """
+    vec = np.zeros(FEATURE_DIM, dtype=np.float32)
+    if not len(notes):
+        return vec
+
+    pitches = notes['pitch'].astype(np.int64)
+    durations = notes['duration'].astype(np.float64)
+
+    chroma = np.bincount(pitches % 12, weights=durations, minlength=12)
+    chroma = np.roll(chroma, -int(chroma.argmax())) # Invariante à tonalidade
+
+    intervals = np.abs(np.diff(melody_line(notes).astype(np.int64)))
+    interval_hist = np.bincount(np.minimum(intervals, 12), minlength=13).astype(np.float64)
+
+    # Durações em escala log2, de 1/16 (fusa) a 8 quarterLengths
+    dur_bins = np.clip(np.round(np.log2(durations)).astype(np.int64) + 4, 0, 7)
+    duration_hist = np.bincount(dur_bins, minlength=8).astype(np.float64)
+
+    span = float(notes['onset'][-1] + durations[-1] - notes['onset'][0]) or 1.0
+    distinct_onsets = len(np.unique(notes['onset']))
+    stats = np.array([
+        np.log1p(len(notes) / span) / 3.0,              # Densidade (notas por tempo)
+        min(len(notes) / max(distinct_onsets, 1), 6.0) / 6.0, # Polifonia média
+        pitches.mean() / 127.0,                         # Registro médio
+        min(pitches.std() / 24.0, 1.0),                 # Dispersão de registro
+    ])
+
+    vec[:] = np.concatenate((_normalized(chroma), _normalized(interval_hist), _normalized(duration_hist), stats))
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+def fingerprint_notes(notes):
+    """Impressão digital completa de uma tabela de notas: (assinatura, características)."""
+    return minhash_signature(interval_shingles(notes)), feature_vector(notes)
+
+
+def _fingerprint_member(task):
+    """Worker do build paralelo: lê um membro do zip e calcula a impressão digital."""
+    archive_path, member_name = task
+    try:
+        notes, _ = corpus.extract_notes(corpus.read_member(archive_path, member_name))
+        if not len(notes):
+            return None
+        return fingerprint_notes(notes)
+    except Exception as e:
+        logger.warning(f"Falha ao processar {member_name} de {archive_path}: {e}")
+        return None
+
+
+def build_index(index_dir=CORPUS_INDEX_DIR, archive_paths=None, workers=None):
+    """
+    Constrói (ou atualiza) o índice. Entradas já indexadas cujo CRC e tamanho
+    não mudaram são reaproveitadas; só membros novos ou alterados são processados.
+    Retorna o número de arquivos (re)processados.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    manifest_path = os.path.join(index_dir, 'manifest.json')
+
+    previous = {}
+    previous_failed = {}
+    old_signatures = old_features = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            old_manifest = json.load(f)
+        if old_manifest.get("num_perm") == NUM_PERM and old_manifest.get("feature_dim") == FEATURE_DIM:
+            previous = {e["source"]: (row, e) for row, e in enumerate(old_manifest["entries"])}
+            previous_failed = old_manifest.get("failed", {})
+            old_signatures = np.load(os.path.join(index_dir, 'signatures.npy'), mmap_mode='r')
+            old_features = np.load(os.path.join(index_dir, 'features.npy'), mmap_mode='r')
+
+    entries, signatures, features, pending = [], [], [], []
+    failed = {}
+    for archive_path, info in corpus_store.iter_unique_members(archive_paths):
+        sid = corpus.source_id(archive_path, info.filename)
+        stamp = {"source": sid, "crc": info.CRC, "size": info.file_size}
+        old = previous.get(sid)
+        if old and old[1]["crc"] == info.CRC and old[1]["size"] == info.file_size:
+            entries.append(stamp)
+            signatures.append(old_signatures[old[0]])
+            features.append(old_features[old[0]])
+        elif previous_failed.get(sid) == info.CRC:
+            failed[sid] = info.CRC # Já falhou antes com o mesmo conteúdo: não tenta de novo
+        else:
+            pending.append((stamp, (archive_path, info.filename)))
+
+    if pending:
+        logger.info(f"Indexando {len(pending)} arquivos novos ou alterados...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(_fingerprint_member, [task for _, task in pending], chunksize=8)
+            for (stamp, _), result in zip(pending, results):
+                if result is None:
+                    failed[stamp["source"]] = stamp["crc"]
+                    continue
+                entries.append(stamp)
+                signatures.append(result[0])
+                features.append(result[1])
+
+    signatures = np.array(signatures, dtype=np.uint64).reshape(-1, NUM_PERM)
+    features = np.array(features, dtype=np.float32).reshape(-1, FEATURE_DIM)
+
+    # Listas invertidas: para cada banda, chaves ordenadas e os ids correspondentes
+    keys = band_keys(signatures).T if len(signatures) else np.zeros((LSH_BANDS, 0), dtype=np.uint64)
+    order = np.argsort(keys, axis=1, kind='stable')
+    lsh_keys = np.take_along_axis(keys, order, axis=1)
+    lsh_ids = order.astype(np.int32)
+
+    # Grava em arquivos temporários e troca atomicamente (leitores com mmap continuam válidos)
+    for name, array in (("signatures", signatures), ("features", features), ("lsh_keys", lsh_keys), ("lsh_ids", lsh_ids)):
+        tmp_path = os.path.join(index_dir, f"{name}.tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(index_dir, f"{name}.npy"))
+
+    manifest = {
+        "num_perm": NUM_PERM, "lsh_bands": LSH_BANDS, "feature_dim": FEATURE_DIM,
+        "entries": entries, "failed": failed,
+    }
+    tmp_manifest = manifest_path + ".tmp"
+    with open(tmp_manifest, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, manifest_path)
+
+    logger.info(f"Índice atualizado: {len(entries)} peças ({len(pending)} processadas, {len(failed)} com falha).")
+    return len(pending)
+
+
+class SimilarityIndex:
+    """Índice somente-leitura, carregado com memory-map."""
+
+    def __init__(self, index_dir=CORPUS_INDEX_DIR):
+        with open(os.path.join(index_dir, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        self.sources = [e["source"] for e in manifest["entries"]]
+        self.signatures = np.load(os.path.join(index_dir, 'signatures.npy'), mmap_mode='r')
+        self.features = np.load(os.path.join(index_dir, 'features.npy'), mmap_mode='r')
+        self.lsh_keys = np.load(os.path.join(index_dir, 'lsh_keys.npy'), mmap_mode='r')
+        self.lsh_ids = np.load(os.path.join(index_dir, 'lsh_ids.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.sources)
+
+    def _lsh_candidates(self, signature):
+        """Ids que colidem com a consulta em pelo menos uma banda."""
+        if signature[0] == _EMPTY_SIGNATURE:
+            return np.zeros(0, dtype=np.int32)
+        found = []
+        for band, key in enumerate(band_keys(signature)[0]):
+            keys = self.lsh_keys[band]
+            lo = np.searchsorted(keys, key, side='left')
+            hi = np.searchsorted(keys, key, side='right')
+            if hi > lo:
+                found.append(self.lsh_ids[band, lo:hi])
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int32)
+
+    def query(self, notes, k=5):
+        """
+        Retorna as k peças mais próximas de uma tabela de notas.
+        Pontuação = média entre Jaccard estimado (MinHash) e cosseno das características.
+        """
+        if not len(self):
+            return []
+        signature, features = fingerprint_notes(notes)
+
+        # Candidatos: colisões LSH + os melhores por cosseno (o vetor é pequeno, a varredura é barata)
+        cosine_all = np.asarray(self.features @ features)
+        top_cos = min(len(self), max(4 * k, 32))
+        by_cosine = np.argpartition(-cosine_all, top_cos - 1)[:top_cos]
+        candidates = np.union1d(self._lsh_candidates(signature), by_cosine)
+
+        cand_signatures = np.asarray(self.signatures[candidates])
+        jaccard = (cand_signatures == signature).mean(axis=1)
+        if signature[0] == _EMPTY_SIGNATURE:
+            jaccard[:] = 0.0
+        cosine = cosine_all[candidates]
+        scores = 0.5 * jaccard + 0.5 * cosine
+
+        best = np.argsort(-scores)[:k]
+        results = []
+        for i in best:
+            archive_name, member_name = corpus.split_source_id(self.sources[candidates[i]])
+            results.append({
+                "archive": archive_name, "path": member_name,
+                "score": round(float(scores[i]), 4),
+                "melodic_similarity": round(float(jaccard[i]), 4),
+                "feature_similarity": round(float(cosine[i]), 4),
+            })
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice de similaridade do corpus MIDI.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="Constrói ou atualiza o índice a partir de Datasets/*.zip")
+    p_build.add_argument("--datasets", default=corpus.DATASETS_DIR)
+    p_build.add_argument("--index", default=CORPUS_INDEX_DIR)
+    p_build.add_argument("--workers", type=int, default=None)
+    p_query = sub.add_parser("query", help="Consulta as peças mais parecidas com um arquivo MIDI")
+    p_query.add_argument("midi_file")
+    p_query.add_argument("--index", default=CORPUS_INDEX_DIR)
+    p_query.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "build":
+        build_index(args.index, corpus.list_archives(args.datasets), args.workers)
+    else:
+        index = SimilarityIndex(args.index)
+        with open(args.midi_file, 'rb') as f:
+            notes, _ = corpus.extract_notes(f.read())
+        start = time.perf_counter()
+        results = index.query(notes, args.k)
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        print(f"Consulta em {(time.perf_counter() - start) * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
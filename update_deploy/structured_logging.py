@@ -0,0 +1,209 @@
+"""
+Logs estruturados, assíncronos, com amostragem e truncamento dos payloads.
+
+Logar o JSON gerado inteiro a cada upload (e a resposta inteira do modelo nos
+erros) custa tempo de requisição em E/S síncrona e enche o disco. Aqui:
+  - AsyncLogHandler: a thread da requisição só põe o registro numa fila
+    limitada; uma thread escreve (JSON por linha ou texto). Fila cheia descarta
+    o registro e conta, em vez de bloquear. A thread é criada no primeiro
+    registro de cada processo, então os processos do pool de análise
+    (forkserver) também funcionam.
+  - PayloadLog: payloads grandes (respostas do modelo, JSON gerado) vão para um
+    buffer circular com os últimos N completos, consultável pela rota de
+    depuração; no log só entra uma amostra (sample_rate) e truncada em
+    max_chars. Avisos e erros sempre entram, também truncados, com o id do
+    payload completo no buffer.
+
+Campos estruturados vão em extra={"structured": {...}}.
+"""
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import itertools
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from logging.handlers import QueueListener
+
+TEXT_FORMAT = "[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+
+
+def _truncate(text, max_chars):
+    if max_chars and len(text) > max_chars:
+        return text[:max_chars] + f"... [+{len(text) - max_chars} caracteres]"
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Um objeto JSON por linha: instante, nível, logger, mensagem (truncada), campos estruturados e exceção."""
+
+    def __init__(self, max_message_chars=10000):
+        super().__init__()
+        self.max_message_chars = max_message_chars
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname, "logger": record.name,
+            "message": _truncate(record.getMessage(), self.max_message_chars),
+            "process": record.process, "thread": record.threadName,
+        }
+        entry.update(getattr(record, "structured", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formato de texto do Flask, com a mensagem truncada e a prévia do payload, se houver."""
+
+    def __init__(self, max_message_chars=10000):
+        super().__init__(TEXT_FORMAT)
+        self.max_message_chars = max_message_chars
+
+    def formatMessage(self, record):
+        record.message = _truncate(record.message, self.max_message_chars)
+        structured = getattr(record, "structured", None) or {}
+        text = super().formatMessage(record)
+        if "payload" in structured:
+            text += f" [payload {structured['payload_id']}, {structured['payload_chars']} caracteres]\n{structured['payload']}"
+        return text
+
+
+class AsyncLogHandler(logging.Handler):
+    """Põe os registros numa fila limitada; uma thread (por processo) os entrega a 'target'."""
+
+    def __init__(self, target, queue_size=10000):
+        super().__init__()
+        self.target = target
+        self.queue_size = queue_size
+        self._pid = None
+        self._queue = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._listener = QueueListener(self._queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        """Congela o registro para outra thread: mensagem com os args aplicados e a exceção já em texto."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._ensure_started()
+            self._queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """Esvazia a fila e para a thread (se ela for deste processo)."""
+        if self._listener is not None and self._pid == os.getpid():
+            try:
+                self._listener.stop()
+            except queue.Full:
+                pass
+            self._listener = None
+            self._pid = None
+        super().close()
+
+    def stats(self):
+        return {"queue_size": self.queue_size, "queued": self._queue.qsize() if self._queue is not None else 0,
+                "dropped": self.dropped}
+
+
+def configure_logging(level="INFO", fmt="json", log_file=None, queue_size=10000, max_message_chars=10000):
+    """
+    Troca os handlers do logger raiz por um AsyncLogHandler que escreve em 'log_file' (ou no
+    stderr), em JSON ('fmt'="json") ou texto. Retorna o handler (stats() traz a fila e os descartes).
+    """
+    target = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter(max_message_chars) if fmt == "json" else TextFormatter(max_message_chars))
+    handler = AsyncLogHandler(target, queue_size)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(handler.close)
+    return handler
+
+
+class PayloadLog:
+    """Buffer circular dos últimos payloads completos, com registro amostrado e truncado no log."""
+
+    def __init__(self, capacity=50, sample_rate=0.01, max_chars=2000):
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+        self.stats_counters = {"stored": 0, "logged": 0, "sampled_out": 0, "truncated": 0}
+
+    def log(self, logger, kind, payload, message, level=logging.INFO, **fields):
+        """
+        Guarda 'payload' (texto) no buffer e, se for aviso/erro ou cair na amostra, registra
+        'message' no 'logger' com o payload truncado. Retorna o id do payload no buffer.
+        """
+        payload = "" if payload is None else str(payload)
+        with self._lock:
+            payload_id = next(self._ids)
+            self._entries.append({
+                "id": payload_id, "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                "kind": kind, "level": logging.getLevelName(level), "chars": len(payload),
+                "fields": fields, "payload": payload,
+            })
+            self.stats_counters["stored"] += 1
+            emit = level >= logging.WARNING or random.random() < self.sample_rate
+            self.stats_counters["logged" if emit else "sampled_out"] += 1
+            truncated = emit and len(payload) > self.max_chars
+            if truncated:
+                self.stats_counters["truncated"] += 1
+        if emit:
+            logger.log(level, message, extra={"structured": {
+                "event": kind, **fields, "payload_id": payload_id, "payload_chars": len(payload),
+                "payload_truncated": truncated, "payload": payload[:self.max_chars],
+            }}, stacklevel=2)
+        return payload_id
+
+    def recent(self, kind=None, limit=20):
+        """Resumo (sem o payload) dos últimos payloads, do mais novo ao mais antigo."""
+        with self._lock:
+            entries = [e for e in reversed(self._entries) if kind is None or e["kind"] == kind]
+        return [{k: v for k, v in e.items() if k != "payload"} for e in entries[:limit]]
+
+    def get(self, payload_id):
+        with self._lock:
+            for entry in self._entries:
+                if entry["id"] == payload_id:
+                    return dict(entry)
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {"capacity": self._entries.maxlen, "entries": len(self._entries), "sample_rate": self.sample_rate,
+                    "max_chars": self.max_chars, **self.stats_counters}
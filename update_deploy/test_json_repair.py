@@ -0,0 +1,133 @@
+"""
+Testes do conserto do JSON do modelo (json_repair.py). Módulo puro, sem Flask.
+
+    python -m pytest -q test_json_repair.py
+"""
+import json
+
+from json_repair import repair_generation, RepairStats, valid_event
+
+NOTE = {"type": "note", "pitch": "C4", "quarterLength": 1.0, "offset": 0.0}
+CHORD = {"type": "chord", "pitches": ["C3", "E3", "G3"], "quarterLength": 2.0, "offset": 0.0}
+REST = {"type": "rest", "quarterLength": 1.0, "offset": 1.0}
+
+
+def ev(event):
+    return json.dumps(event)
+
+
+def repaired(text):
+    out, report = repair_generation(text)
+    return (json.loads(out) if out is not None else None), report
+
+
+def test_clean_json_passes_through():
+    data, report = repaired(json.dumps({"right_hand": [NOTE], "left_hand": [CHORD]}))
+    assert data == {"right_hand": [NOTE], "left_hand": [CHORD]}
+    assert report["status"] == "clean"
+    assert sum(report["dropped"].values()) == 0
+
+
+def test_fenced_response_with_prose():
+    text = "Aqui está:\n```json\n" + json.dumps({"right_hand": [NOTE], "left_hand": []}) + "\n```\nEspero que goste."
+    data, report = repaired(text)
+    assert data["right_hand"] == [NOTE]
+    assert report["status"] == "clean"
+
+
+def test_truncated_response_keeps_complete_events():
+    text = '```json\n{"right_hand": [' + ev(NOTE) + ", " + ev(NOTE)[:25]
+    data, report = repaired(text)
+    assert data["right_hand"] == [NOTE]
+    assert data["left_hand"] == []
+    assert report["status"] == "repaired"
+    assert report["truncated"]
+    assert report["dropped"]["right_hand"] == 1
+
+
+def test_truncated_inside_number_drops_event():
+    text = '{"right_hand": [' + ev(NOTE) + ', {"type": "note", "pitch": "D4", "quarterLength": 1'
+    data, report = repaired(text)
+    assert data["right_hand"] == [NOTE]
+    assert report["dropped"]["right_hand"] == 1
+
+
+def test_trailing_commas_and_single_quotes():
+    text = "{'right_hand': [" + ev(NOTE) + ",], 'left_hand': [" + ev(REST) + ",],}"
+    data, report = repaired(text)
+    assert data == {"right_hand": [NOTE], "left_hand": [REST]}
+    assert report["fixes"]["trailing_comma"] >= 1
+    assert report["fixes"]["single_quotes"] >= 1
+
+
+def test_stray_closers_are_skipped():
+    text = '{"right_hand": [' + ev(NOTE) + ']]] , "left_hand": [' + ev(REST) + ']}'
+    data, report = repaired(text)
+    assert data == {"right_hand": [NOTE], "left_hand": [REST]}
+    assert report["fixes"]["stray_closer"] == 2
+    assert sum(report["dropped"].values()) == 0
+
+
+def test_mismatched_closer_of_enclosing_container():
+    text = '{"right_hand": [' + ev(NOTE) + '}, "left_hand": [' + ev(REST) + ']}'
+    data, report = repaired(text)
+    assert data["right_hand"] == [NOTE]
+    assert report["fixes"]["mismatched_bracket"] == 1
+    # O objeto fechou antes da mão esquerda: o evento que sobrou é contado, não perdido em silêncio
+    assert data.get("left_hand", []) == []
+    assert report["dropped"]["trailing"] == 1
+    assert report["status"] == "repaired"
+
+
+def test_events_after_early_close_are_reported():
+    text = '{"right_hand": [' + ev(NOTE) + ']}} , "left_hand": [' + ev(REST) + ', ' + ev(CHORD) + ']}'
+    data, report = repaired(text)
+    assert data["right_hand"] == [NOTE]
+    assert report["dropped"]["trailing"] == 2
+    assert report["status"] == "repaired"
+
+
+def test_invalid_events_are_dropped_and_counted():
+    bad = [{"type": "note", "quarterLength": 1}, {"type": "chord", "pitches": [], "quarterLength": 1},
+           {"type": "note", "pitch": "C4", "quarterLength": 0}, {"type": "drum", "quarterLength": 1}]
+    data, report = repaired(json.dumps({"right_hand": [NOTE] + bad, "left_hand": [REST]}))
+    assert data == {"right_hand": [NOTE], "left_hand": [REST]}
+    assert report["dropped"]["right_hand"] == len(bad)
+
+
+def test_variants_keep_usable_ones():
+    text = json.dumps({"variants": [{"right_hand": [NOTE], "left_hand": []}, {"right_hand": [], "left_hand": []}]})
+    data, report = repaired(text[:-1])
+    assert data == {"variants": [{"right_hand": [NOTE], "left_hand": []}]}
+    assert report["dropped_variants"] == 1
+
+
+def test_deep_nesting_is_unrecoverable_not_an_error():
+    for text in ["[" * 100000, '{"a":' + "[" * 5000, '{"right_hand": [' + ev(NOTE) + '], "x": ' + "[" * 5000 + "]" * 5000 + "}"]:
+        data, report = repaired(text)
+        assert data is None
+        assert report["status"] == "unrecoverable"
+        assert report["fixes"] == {"too_deep": 1}
+
+
+def test_no_json_at_all():
+    data, report = repaired("Desculpe, não posso ajudar com isso.")
+    assert data is None
+    assert report["status"] == "unrecoverable"
+
+
+def test_valid_event():
+    assert valid_event(NOTE) and valid_event(CHORD) and valid_event(REST)
+    assert not valid_event({"type": "note", "pitch": "C4", "quarterLength": True})
+    assert not valid_event({"type": "rest", "quarterLength": 1, "offset": "x"})
+
+
+def test_repair_stats():
+    stats = RepairStats()
+    for text in [json.dumps({"right_hand": [NOTE]}), '{"right_hand": [' + ev(NOTE) + ", " + ev(NOTE)[:10], "nada"]:
+        stats.record(repair_generation(text)[1])
+    counters = stats.stats()
+    assert counters["responses"] == 3
+    assert (counters["clean"], counters["repaired"], counters["unrecoverable"]) == (1, 1, 1)
+    assert counters["truncated"] == 1
+    assert counters["dropped_events"] == 1
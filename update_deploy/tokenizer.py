@@ -0,0 +1,96 @@
+"""
+Tokenizador de eventos musicais para treino de modelos locais.
+
+Usa a mesma codificação de eventos dos prompts (midi_stream_to_text):
+cada evento nota/acorde/pausa com offset, quarterLength e velocity vira uma
+sequência curta de tokens inteiros de vocabulário fixo:
+
+    [SHIFT_k] NOTE PITCH_p DUR_d VEL_v
+    [SHIFT_k] CHORD PITCH_p1 PITCH_p2 ... DUR_d VEL_v
+    [SHIFT_k] REST DUR_d
+
+SHIFT é o avanço de offset desde o evento anterior (omitido quando zero).
+Uma peça é codificada como BOS RH <eventos> LH <eventos> EOS.
+"""
+import numpy as np
+
+import corpus
+
+TIME_STEP = 1.0 / 12.0  # Resolução de offsets e durações (mesma grade de corpus.QUANTIZE_GRID)
+MAX_STEPS = 96          # Maior avanço/duração representável: 8 quarterLengths
+VELOCITY_BINS = 32
+
+PAD, BOS, EOS, RH, LH, NOTE, CHORD, REST = range(8)
+PITCH_BASE = 8
+SHIFT_BASE = PITCH_BASE + 128
+DUR_BASE = SHIFT_BASE + MAX_STEPS
+VEL_BASE = DUR_BASE + MAX_STEPS
+VOCAB_SIZE = VEL_BASE + VELOCITY_BINS
+
+TOKEN_DTYPE = np.uint16 # VOCAB_SIZE cabe com folga em 16 bits
+
+
+def _steps(quarter_length):
+    return int(np.clip(round(float(quarter_length) / TIME_STEP), 1, MAX_STEPS))
+
+
+def encode_events(events):
+    """Codifica uma lista de eventos (uma mão) em ids de tokens."""
+    ids = []
+    cursor = None
+    for ev in events:
+        offset = float(ev.get("offset", 0.0))
+        if cursor is not None and offset - cursor > TIME_STEP / 2:
+            # Avanços maiores que MAX_STEPS são divididos em vários tokens SHIFT
+            remaining = int(round((offset - cursor) / TIME_STEP))
+            while remaining > 0:
+                step = min(remaining, MAX_STEPS)
+                ids.append(SHIFT_BASE + step - 1)
+                remaining -= step
+        cursor = offset
+
+        duration_token = DUR_BASE + _steps(ev.get("quarterLength", 1.0)) - 1
+        velocity_token = VEL_BASE + min(int(ev.get("velocity", 80)) * VELOCITY_BINS // 128, VELOCITY_BINS - 1)
+        if ev["type"] == "note":
+            ids += [NOTE, PITCH_BASE + corpus.pitch_number(ev["pitch"]), duration_token, velocity_token]
+        elif ev["type"] == "chord":
+            ids.append(CHORD)
+            ids += [PITCH_BASE + corpus.pitch_number(p) for p in ev["pitches"]]
+            ids += [duration_token, velocity_token]
+        else:
+            ids += [REST, duration_token]
+    return ids
+
+
+def encode_piece(rh_events, lh_events):
+    """Codifica uma peça inteira: BOS RH <eventos> LH <eventos> EOS."""
+    return np.array([BOS, RH] + encode_events(rh_events) + [LH] + encode_events(lh_events or []) + [EOS], dtype=TOKEN_DTYPE)
+
+
+def decode_events(ids):
+    """Decodifica ids de uma mão de volta para eventos no formato de midi_stream_to_text (offsets relativos ao primeiro evento)."""
+    events = []
+    offset = 0.0
+    current = None
+    for token in (int(t) for t in ids):
+        if SHIFT_BASE <= token < DUR_BASE:
+            offset += (token - SHIFT_BASE + 1) * TIME_STEP
+        elif token in (NOTE, CHORD, REST):
+            current = {"type": {NOTE: "note", CHORD: "chord", REST: "rest"}[token], "offset": round(offset, 4), "pitches": []}
+        elif current is None:
+            continue
+        elif PITCH_BASE <= token < SHIFT_BASE:
+            current["pitches"].append(corpus.pitch_name(token - PITCH_BASE))
+        elif DUR_BASE <= token < VEL_BASE:
+            current["quarterLength"] = round((token - DUR_BASE + 1) * TIME_STEP, 4)
+            if current["type"] == "rest":
+                del current["pitches"]
+                events.append(current)
+                current = None
+        elif VEL_BASE <= token < VOCAB_SIZE and "quarterLength" in current:
+            current["velocity"] = (token - VEL_BASE) * 128 // VELOCITY_BINS + 2
+            if current["type"] == "note":
+                current["pitch"] = current.pop("pitches")[0]
+            events.append(current)
+            current = None
+    return events
@@ -0,0 +1,150 @@
+"""
+Pool de variações pré-geradas para respostas instantâneas de "outra ideia".
+
+Depois da primeira geração de um arquivo, o pool produz em segundo plano mais
+continuações (cada uma com uma temperatura diferente) e as guarda por hash do
+arquivo. next() entrega a próxima pronta na hora e agenda a reposição.
+
+Gasto limitado em dois níveis:
+  - por arquivo: no máximo max_per_file gerações no total;
+  - por usuário: no máximo max_per_user gerações por janela de user_window segundos
+    (usuários sem gasto na janela são esquecidos; no máximo max_users lembrados).
+Variantes já existentes (ex: candidatos não escolhidos no melhor de N, ver
+candidates.py) entram no pool sem gerar nada e não contam no orçamento.
+
+O pool não conhece Flask nem o backend: produce_fn(context, temperature, generated_text)
+gera (se generated_text for None) e renderiza uma variação, retornando um dict
+ou None em caso de falha.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class _FileEntry:
+
+    def __init__(self, context):
+        self.context = context
+        self.ready = deque()      # Variações prontas, na ordem em que serão servidas
+        self.seeds = deque()      # Textos já gerados, aguardando renderização
+        self.in_flight = 0
+        self.generated = 0        # Gerações pagas para este arquivo
+        self.served = 0
+
+
+class VariationPool:
+
+    def __init__(self, produce_fn, pool_size=3, max_per_file=12, max_per_user=30, user_window=3600,
+                 temperatures=(0.7, 0.9, 1.1, 1.3), workers=2, max_files=256, max_users=10000):
+        self._produce_fn = produce_fn
+        self.pool_size = pool_size
+        self.max_per_file = max_per_file
+        self.max_per_user = max_per_user
+        self.user_window = user_window
+        self.temperatures = temperatures
+        self.max_files = max_files
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._files = OrderedDict()     # file_hash -> _FileEntry (ordem = recência, para despejo)
+        self._user_spend = OrderedDict() # usuário -> deque de instantes das gerações pagas (ordem = último gasto)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="variations")
+
+    def register(self, file_hash, context, user, seed_texts=()):
+        """Registra o contexto de geração de um arquivo e começa a encher o pool."""
+        with self._lock:
+            entry = self._files.get(file_hash)
+            if entry is None:
+                entry = self._files[file_hash] = _FileEntry(context)
+                while len(self._files) > self.max_files:
+                    self._files.popitem(last=False)
+            else:
+                self._files.move_to_end(file_hash)
+            entry.seeds.extend(seed_texts)
+        self._refill(file_hash, user)
+
+    def next(self, file_hash, user):
+        """
+        Retorna (variação, estado). Estados: "ready" (variação entregue), "pending" (reposição
+        em andamento), "exhausted" (orçamento esgotado e pool vazio), "unknown" (arquivo não registrado).
+        """
+        with self._lock:
+            entry = self._files.get(file_hash)
+            if entry is None:
+                return None, "unknown"
+            self._files.move_to_end(file_hash)
+            variation = entry.ready.popleft() if entry.ready else None
+            if variation is not None:
+                entry.served += 1
+        started = self._refill(file_hash, user)
+        if variation is not None:
+            return variation, "ready"
+        with self._lock:
+            pending = entry.in_flight > 0 or started
+        return None, "pending" if pending else "exhausted"
+
+    def _user_can_spend(self, user, now):
+        spend = self._user_spend.get(user)
+        if spend is None:
+            return self.max_per_user > 0
+        while spend and spend[0] <= now - self.user_window:
+            spend.popleft()
+        if not spend:
+            del self._user_spend[user]
+        return len(spend) < self.max_per_user
+
+    def _record_spend(self, user, now):
+        spend = self._user_spend.pop(user, None) or deque()
+        spend.append(now)
+        self._user_spend[user] = spend
+        # Na frente ficam os usuários de gasto mais antigo: fora da janela (ou além de max_users), saem
+        while self._user_spend:
+            oldest = next(iter(self._user_spend.values()))
+            if oldest[-1] > now - self.user_window and len(self._user_spend) <= self.max_users:
+                break
+            self._user_spend.popitem(last=False)
+
+    def _refill(self, file_hash, user):
+        """Agenda produções até o pool ter pool_size variações (prontas + em andamento). Retorna quantas agendou."""
+        tasks = []
+        now = time.time()
+        with self._lock:
+            entry = self._files.get(file_hash)
+            if entry is None:
+                return 0
+            while len(entry.ready) + entry.in_flight < self.pool_size:
+                if entry.seeds:
+                    tasks.append((entry.seeds.popleft(), None))
+                elif entry.generated < self.max_per_file and self._user_can_spend(user, now):
+                    temperature = self.temperatures[entry.generated % len(self.temperatures)]
+                    entry.generated += 1
+                    self._record_spend(user, now)
+                    tasks.append((None, temperature))
+                else:
+                    break
+                entry.in_flight += 1
+        for seed_text, temperature in tasks:
+            self._executor.submit(self._produce, file_hash, entry, seed_text, temperature)
+        return len(tasks)
+
+    def _produce(self, file_hash, entry, seed_text, temperature):
+        try:
+            variation = self._produce_fn(entry.context, temperature, seed_text)
+        except Exception as e:
+            logger.error(f"Falha ao produzir variação para {file_hash}: {e}")
+            variation = None
+        with self._lock:
+            entry.in_flight -= 1
+            if variation is not None:
+                entry.ready.append(variation)
+
+    def status(self, file_hash):
+        with self._lock:
+            entry = self._files.get(file_hash)
+            if entry is None:
+                return None
+            return {"ready": len(entry.ready), "in_flight": entry.in_flight, "generated": entry.generated,
+                    "served": entry.served, "max_per_file": self.max_per_file}